@@ -0,0 +1,118 @@
+import csv
+import glob
+import hashlib
+import os
+import sys
+from sqlalchemy import text
+import data
+
+# Where route_map() caches the route geometries, one GeoParquet file per data version
+ROUTE_MAP_CACHE_DIR = 'route_map_cache'
+
+# Airports by IATA code. The primary key is the index the route queries join on;
+# WITHOUT ROWID stores the rows in that index, so a lookup is a single B-tree search.
+CREATE_AIRPORTS_TABLE = """
+CREATE TABLE IF NOT EXISTS airports (
+    IATA_CODE TEXT PRIMARY KEY,
+    AIRPORT TEXT,
+    CITY TEXT,
+    STATE TEXT,
+    COUNTRY TEXT,
+    LATITUDE REAL NOT NULL,
+    LONGITUDE REAL NOT NULL
+) WITHOUT ROWID
+"""
+
+UPSERT_AIRPORT = """
+INSERT INTO airports (IATA_CODE, AIRPORT, CITY, STATE, COUNTRY, LATITUDE, LONGITUDE)
+VALUES (:IATA_CODE, :AIRPORT, :CITY, :STATE, :COUNTRY, :LATITUDE, :LONGITUDE)
+ON CONFLICT (IATA_CODE) DO UPDATE SET
+    AIRPORT = excluded.AIRPORT,
+    CITY = excluded.CITY,
+    STATE = excluded.STATE,
+    COUNTRY = excluded.COUNTRY,
+    LATITUDE = excluded.LATITUDE,
+    LONGITUDE = excluded.LONGITUDE
+"""
+
+COORDINATE_COLUMNS = ['ORIGIN_LONGITUDE', 'ORIGIN_LATITUDE', 'DESTINATION_LONGITUDE', 'DESTINATION_LATITUDE']
+
+
+def load_airports(engine, path):
+    """
+    Create the airports table if needed and load (or update) the airports of a
+    CSV file with the columns IATA_CODE, AIRPORT, CITY, STATE, COUNTRY, LATITUDE
+    and LONGITUDE, like the airports.csv of the 2015 flight delays dataset.
+    Airports without coordinates are skipped. Returns the number of airports loaded.
+    """
+    with open(path, newline='') as f:
+        airports = [
+            {**row, 'IATA_CODE': row['IATA_CODE'].strip().upper(),
+             'LATITUDE': float(row['LATITUDE']), 'LONGITUDE': float(row['LONGITUDE'])}
+            for row in csv.DictReader(f)
+            if row.get('LATITUDE') and row.get('LONGITUDE')
+        ]
+    for row in airports:
+        for column in ('AIRPORT', 'CITY', 'STATE', 'COUNTRY'):
+            row.setdefault(column, None)
+
+    with engine.begin() as connection:
+        connection.execute(text(CREATE_AIRPORTS_TABLE))
+        if airports:
+            connection.execute(text(UPSERT_AIRPORT), airports)
+    return len(airports)
+
+
+def route_geometries(routes):
+    """
+    Turn the DataFrame of FlightData.get_percentage_delayed_flights_for_map()
+    into a GeoDataFrame with one straight LineString per route.
+    All geometries are built in one vectorized call instead of one per route.
+    """
+    import geopandas as gpd
+    import shapely
+
+    coordinates = routes[COORDINATE_COLUMNS].to_numpy(dtype=float).reshape(-1, 2, 2)
+    return gpd.GeoDataFrame(
+        routes.drop(columns=COORDINATE_COLUMNS),
+        geometry=shapely.linestrings(coordinates),
+        crs='EPSG:4326',
+    )
+
+
+def route_map(data_manager, cache_dir=ROUTE_MAP_CACHE_DIR):
+    """
+    Return the route geometries as a GeoDataFrame, read from the GeoParquet cache
+    when it was written for the current data version, or built and cached otherwise.
+    """
+    import geopandas as gpd
+
+    def cache_path():
+        version = hashlib.sha1(repr(data_manager.get_data_version()).encode()).hexdigest()[:16]
+        return os.path.join(cache_dir, f"routes-{version}.parquet")
+
+    path = cache_path()
+    if os.path.exists(path):
+        return gpd.read_parquet(path)
+
+    routes = data_manager.get_percentage_delayed_flights_for_map()
+    if routes.empty:
+        return gpd.GeoDataFrame(routes)
+    routes = route_geometries(routes)
+
+    # Refreshing the summaries may have changed the version, so take it again
+    path = cache_path()
+    os.makedirs(cache_dir, exist_ok=True)
+    for old in glob.glob(os.path.join(cache_dir, 'routes-*.parquet')):
+        os.remove(old)
+    routes.to_parquet(path + '.tmp')
+    os.replace(path + '.tmp', path)
+    return routes
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print("Usage: python airports.py <database URI> <airports CSV file>")
+        sys.exit(1)
+    count = load_airports(data.FlightData(sys.argv[1]).engine, sys.argv[2])
+    print(f"Loaded {count} airports from {sys.argv[2]}")
@@ -0,0 +1,85 @@
+from datetime import datetime
+import encoding
+
+# Request parsing and limits shared by the Flask (flights_api.py) and Quart
+# (flights_api_async.py) apps. The functions take the query string arguments
+# (request.args of either framework) rather than reading the request themselves.
+
+# Largest page size a client may request with ?limit=
+MAX_PAGE_SIZE = 10000
+
+# Most flight IDs a client may look up in one POST /flights/batch request
+MAX_BATCH_IDS = 5000
+
+# Seconds a client is asked to wait (Retry-After) when its query was shed
+OVERLOADED_RETRY_AFTER = 1
+
+
+def pagination_args(args):
+    """
+    Read the keyset pagination parameters (?limit=&after=).
+    Returns (limit, after, error), where error is an error message or None.
+    """
+    limit = args.get('limit')
+    after = args.get('after')
+    try:
+        limit = int(limit) if limit is not None else None
+        after = int(after) if after is not None else None
+    except ValueError:
+        return None, None, "limit and after must be integers."
+    if limit is not None and not 0 < limit <= MAX_PAGE_SIZE:
+        return None, None, f"limit must be between 1 and {MAX_PAGE_SIZE}."
+    return limit, after, None
+
+
+def date_range_args(args):
+    """
+    Read a date (?date=) or an inclusive date range (?start=&end=).
+    Returns (start, end, error), where error is an error message or None.
+    """
+    try:
+        if 'date' in args:
+            start = end = datetime.strptime(args['date'], '%d/%m/%Y')
+        else:
+            start = datetime.strptime(args.get('start'), '%d/%m/%Y')
+            end = datetime.strptime(args.get('end'), '%d/%m/%Y')
+    except (ValueError, TypeError):
+        return None, None, "Invalid date format. Use date=DD/MM/YYYY or start=DD/MM/YYYY&end=DD/MM/YYYY."
+    if end < start:
+        return None, None, "end must not be before start."
+    return start, end, None
+
+
+def batch_ids(body):
+    """
+    Read the flight IDs of a POST /flights/batch JSON body ({"ids": [...]}).
+    Returns (flight_ids, error), where error is an error message or None.
+    """
+    flight_ids = body.get('ids') if isinstance(body, dict) else None
+    if (not isinstance(flight_ids, list)
+            or not all(isinstance(flight_id, int) and not isinstance(flight_id, bool)
+                       for flight_id in flight_ids)):
+        return None, 'A JSON body {"ids": [<flight_id>, ...]} is required.'
+    if len(flight_ids) > MAX_BATCH_IDS:
+        return None, f"At most {MAX_BATCH_IDS} IDs can be requested at once."
+    return flight_ids, None
+
+
+def encode_results(results, args):
+    """
+    The JSON body of a list of records: without the fields repeated under an
+    alias and, with ?format=columns, as one list of values per field
+    (see encoding.encode_records).
+    """
+    return encoding.encode_records(results, columns=args.get('format') == 'columns')
+
+
+def batch_body(flight_ids, flights):
+    """
+    The JSON body of a POST /flights/batch response: the flights found, keyed
+    by their ID as a string, and the requested IDs that weren't.
+    """
+    missing = [flight_id for flight_id in dict.fromkeys(flight_ids) if flight_id not in flights]
+    records = encoding.encode_records(list(flights.values()))
+    return {"flights": {str(flight_id): record for flight_id, record in zip(flights, records)},
+            "missing": missing}
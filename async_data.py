@@ -0,0 +1,324 @@
+import time
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+import coalescing
+import data
+import instrumentation
+import sketches
+import sqlite_engine
+import summaries
+
+# Errors and slow queries are logged like FlightData's
+logger = data.logger
+
+
+class AsyncFlightData:
+    """
+    The asyncio counterpart of data.FlightData: the same query methods, as
+    coroutines running on an aiosqlite engine, so one event loop can keep many
+    queries in flight at once. The SQL and the post-processing are shared with
+    FlightData.
+    """
+
+    def __init__(self, db_uri, use_summaries=False, engine_profile=None,
+                 slow_query_threshold=data.SLOW_QUERY_THRESHOLD, query_limits=None):
+        """
+        Initialize a new async engine using the given database URI.
+        See FlightData for engine_profile, use_summaries, slow_query_threshold
+        and query_limits.
+        """
+        self.engine = sqlite_engine.create_async_sqlite_engine(db_uri, engine_profile)
+        # The summaries are refreshed on a thread with a synchronous engine of their own,
+        # never on the event loop
+        self.summaries = (summaries.DelaySummaries(sqlite_engine.create_sqlite_engine(db_uri, engine_profile))
+                          if use_summaries else None)
+        self.slow_query_threshold = slow_query_threshold
+        self.coalescer = coalescing.AsyncQueryCoalescer(query_limits)
+
+    async def _summaries_ready(self):
+        """
+        Check that the summary tables include every flight (see
+        FlightData._summaries_ready). When they are behind, a refresh is
+        started on a background thread and False is returned.
+        """
+        if self.summaries is None:
+            return False
+        try:
+            async with self.engine.connect() as connection:
+                if await connection.run_sync(self.summaries.is_current):
+                    return True
+        except SQLAlchemyError as e:
+            logger.warning("Could not check summaries: %s: %s", e.__class__.__name__, e)
+            return False
+        self.summaries.refresh_in_background()
+        return False
+
+    async def _execute_query(self, query, params=None, result_format='records'):
+        """
+        Execute an SQL query with the params provided in a dictionary,
+        and return the result in result_format (see data.materialize()).
+        The query is recorded in the metrics and logged if slow, like in
+        FlightData._execute_query (the name is taken before the first await,
+        while the calling method's frame is still the caller).
+        If an exception is raised, log the error, and return an empty result.
+        """
+        name = instrumentation.caller_name()
+        started = time.perf_counter()
+        try:
+            async with self.engine.connect() as connection:
+                connected = time.perf_counter()
+                result = await connection.execute(text(query), params)
+                results = data.materialize(result, result_format)
+                duration = time.perf_counter() - started
+                if duration > self.slow_query_threshold:
+                    await self._log_slow_query(connection, name, query, params, duration)
+        except SQLAlchemyError as e:
+            logger.error("An error occurred in %s: %s: %s", name, e.__class__.__name__, e)
+            instrumentation.record_error(name)
+            return data.empty_result(result_format)
+
+        instrumentation.record_query(name, duration, len(results), connected - started)
+        return results
+
+    async def _log_slow_query(self, connection, name, query, params, duration):
+        """
+        Log a slow query together with its EXPLAIN QUERY PLAN.
+        """
+        try:
+            result = await connection.execute(text("EXPLAIN QUERY PLAN " + query), params)
+            plan = [row.detail for row in result]
+        except SQLAlchemyError:
+            plan = ["(no plan available)"]
+        instrumentation.slow_query_logger.warning(
+            "%s took %.3f s (params %s): %s\nPlan: %s",
+            name, duration, params, " ".join(query.split()), "; ".join(plan),
+        )
+
+    def _stream_query(self, query, params=None, batch_size=data.STREAM_BATCH_SIZE):
+        """
+        Execute an SQL query on a server-side cursor and return an async
+        iterator over the records, fetched in batches of batch_size.
+        If an exception is raised, log the error, and stop the iteration.
+        """
+        return self._stream_rows(instrumentation.caller_name(), query, params, batch_size)
+
+    async def _stream_rows(self, name, query, params, batch_size):
+        started = time.perf_counter()
+        rows = 0
+        try:
+            async with self.engine.connect() as connection:
+                connected = time.perf_counter()
+                result = await connection.stream(
+                    text(query), params, execution_options={'yield_per': batch_size}
+                )
+                async for row in result:
+                    rows += 1
+                    yield dict(row._mapping)
+        except SQLAlchemyError as e:
+            logger.error("An error occurred in %s: %s: %s", name, e.__class__.__name__, e)
+            instrumentation.record_error(name)
+            return
+        instrumentation.record_query(name, time.perf_counter() - started, rows, connected - started)
+
+    @coalescing.coalesced('lookup')
+    async def get_flight_by_id(self, flight_id):
+        """
+        Retrieves a flight using only the flight ID.
+        """
+        return await self._execute_query(data.FLIGHT_BY_ID_QUERY, {'id': flight_id})
+
+    async def get_flights_by_ids(self, flight_ids, chunk_size=data.ID_CHUNK_SIZE):
+        """
+        Retrieves many flights at once (see FlightData.get_flights_by_ids).
+        """
+        flights = {}
+        for query, params in data.flights_by_ids_queries(flight_ids, chunk_size):
+            for record in await self._execute_query(query, params):
+                flights[record['FLIGHT_ID']] = record
+        return flights
+
+    @coalescing.coalesced('lookup')
+    async def get_delayed_flights_by_airline(self, airline_name, limit=None, after=None):
+        """
+        Retrieves delayed flights for a given airline name, optionally one page at a time.
+        """
+        query, params = data.keyset_page(data.DELAYED_FLIGHTS_BY_AIRLINE_QUERY,
+                                         {'airline': airline_name}, limit, after)
+        return await self._execute_query(query, params)
+
+    def iter_delayed_flights_by_airline(self, airline_name, limit=None, after=None):
+        """
+        Like get_delayed_flights_by_airline, but an async iterator over the flights.
+        """
+        query, params = data.keyset_page(data.DELAYED_FLIGHTS_BY_AIRLINE_QUERY,
+                                         {'airline': airline_name}, limit, after)
+        return self._stream_query(query, params)
+
+    @coalescing.coalesced('lookup')
+    async def get_delayed_flights_by_airport(self, airport_code, limit=None, after=None):
+        """
+        Retrieves delayed flights for a given origin airport IATA code, optionally one page at a time.
+        """
+        query, params = data.keyset_page(data.DELAYED_FLIGHTS_BY_AIRPORT_QUERY,
+                                         {'airport': airport_code}, limit, after)
+        return await self._execute_query(query, params)
+
+    def iter_delayed_flights_by_airport(self, airport_code, limit=None, after=None):
+        """
+        Like get_delayed_flights_by_airport, but an async iterator over the flights.
+        """
+        query, params = data.keyset_page(data.DELAYED_FLIGHTS_BY_AIRPORT_QUERY,
+                                         {'airport': airport_code}, limit, after)
+        return self._stream_query(query, params)
+
+    @coalescing.coalesced('range')
+    async def get_top_5_delays_by_date(self, day, month, year):
+        """
+        Retrieve the top 5 delayed flights for a specific date.
+        """
+        params = {**data.date_range_params((year, month, day), (year, month, day)), 'k': 5}
+        if await self._summaries_ready():
+            results = await self._execute_query(summaries.TOP_DELAYS_BY_DATE_RANGE_QUERY, params)
+            if len(results) < params['k']:
+                results = await self._execute_query(summaries.JOINED_TOP_DELAYS_BY_DATE_RANGE_QUERY, params)
+            return results
+        return await self._execute_query(data.TOP_DELAYS_BY_DATE_RANGE_QUERY, params)
+
+    @coalescing.coalesced('range')
+    async def get_top_delays_by_date_range(self, start, end, k=5):
+        """
+        Retrieve the k most delayed flights between the dates start and end, inclusive.
+        """
+        params = {**data.date_range_params((start.year, start.month, start.day), (end.year, end.month, end.day)), 'k': k}
+        if k <= summaries.TOP_DELAYS_MAX_K and await self._summaries_ready():
+            results = await self._execute_query(summaries.TOP_DELAYS_BY_DATE_RANGE_QUERY, params)
+            if len(results) < k:
+                # See FlightData.get_top_delays_by_date_range
+                results = await self._execute_query(summaries.JOINED_TOP_DELAYS_BY_DATE_RANGE_QUERY, params)
+            return results
+        return await self._execute_query(data.TOP_DELAYS_BY_DATE_RANGE_QUERY, params)
+
+    @coalescing.coalesced('range')
+    async def get_delay_rollup(self, start, end, bucket='day', group_by=None):
+        """
+        Fetch the delay metrics per day, week or month (see FlightData.get_delay_rollup).
+        """
+        data.check_rollup_args(bucket, group_by)
+        params = data.date_range_params((start.year, start.month, start.day), (end.year, end.month, end.day))
+        if await self._summaries_ready():
+            return await self._execute_query(summaries.rollup_query(bucket, group_by), params)
+        return await self._execute_query(data.rollup_query(bucket, group_by), params)
+
+    @coalescing.coalesced('range')
+    async def get_delay_percentiles(self, start, end, group_by=None, percentiles=sketches.DEFAULT_PERCENTILES):
+        """
+        Estimate the delay percentiles of a date range (see FlightData.get_delay_percentiles).
+        """
+        sketches.check_sketch_args(group_by, percentiles)
+        params = data.date_range_params((start.year, start.month, start.day), (end.year, end.month, end.day))
+        if await self._summaries_ready():
+            rows = await self._execute_query(sketches.percentile_query(group_by), params)
+        else:
+            rows = sketches.bucket_delays(await self._execute_query(data.delay_histogram_query(group_by), params))
+        return sketches.delay_percentiles(rows, sketches.GROUP_COLUMNS[group_by], percentiles)
+
+    @coalescing.coalesced('range')
+    async def get_distinct_routes(self, start, end, group_by=None):
+        """
+        Estimate the number of distinct routes of a date range (see FlightData.get_distinct_routes).
+        """
+        sketches.check_sketch_args(group_by)
+        params = data.date_range_params((start.year, start.month, start.day), (end.year, end.month, end.day))
+        if await self._summaries_ready():
+            rows = await self._execute_query(sketches.distinct_routes_query(group_by), params)
+        else:
+            rows = sketches.register_routes(await self._execute_query(data.routes_flown_query(group_by), params))
+        return sketches.distinct_routes(rows, sketches.GROUP_COLUMNS[group_by])
+
+    @coalescing.coalesced('aggregate')
+    async def get_top_10_busiest_airlines(self):
+        """
+        Returns the top 10 busiest airlines based on flight counts.
+        """
+        if await self._summaries_ready():
+            return await self._execute_query(summaries.TOP_10_BUSIEST_AIRLINES_QUERY)
+        return await self._execute_query(data.TOP_10_BUSIEST_AIRLINES_QUERY)
+
+    @coalescing.coalesced('aggregate')
+    async def get_average_delay_per_airline(self):
+        """
+        Fetch the average delay per airline, ignoring negative delays.
+        """
+        if await self._summaries_ready():
+            return await self._execute_query(summaries.AVERAGE_DELAY_PER_AIRLINE_QUERY)
+        return await self._execute_query(data.AVERAGE_DELAY_PER_AIRLINE_QUERY)
+
+    @coalescing.coalesced('aggregate')
+    async def get_percentage_delayed_flights_per_airline(self):
+        """
+        Fetch the percentage of delayed flights per airline.
+        """
+        if await self._summaries_ready():
+            results = await self._execute_query(summaries.PERCENTAGE_DELAYED_PER_AIRLINE_QUERY, result_format='dataframe')
+        else:
+            results = await self._execute_query(data.PERCENTAGE_DELAYED_PER_AIRLINE_QUERY, result_format='dataframe')
+        return data.percentage_delays_per_airline(results)
+
+    @coalescing.coalesced('aggregate')
+    async def get_average_delay_per_origin(self):
+        """
+        Fetch the average delay per origin airport, ignoring negative delays.
+        """
+        if await self._summaries_ready():
+            return await self._execute_query(summaries.AVERAGE_DELAY_PER_ORIGIN_QUERY)
+        return await self._execute_query(data.AVERAGE_DELAY_PER_ORIGIN_QUERY)
+
+    @coalescing.coalesced('aggregate')
+    async def get_percentage_delayed_flights_per_hour(self):
+        """
+        Fetch the percentage of delayed flights per hour of the day.
+        """
+        if await self._summaries_ready():
+            results = await self._execute_query(summaries.PERCENTAGE_DELAYED_PER_HOUR_QUERY, result_format='dataframe')
+        else:
+            results = await self._execute_query(data.PERCENTAGE_DELAYED_PER_HOUR_QUERY, result_format='dataframe')
+        return data.percentage_delays_per_hour(results)
+
+    @coalescing.coalesced('aggregate')
+    async def get_percentage_delayed_flights_per_route(self):
+        """
+        Fetch the percentage of delayed flights per origin -> destination route.
+        """
+        if await self._summaries_ready():
+            results = await self._execute_query(summaries.PERCENTAGE_DELAYED_PER_ROUTE_QUERY, result_format='dataframe')
+        else:
+            results = await self._execute_query(data.PERCENTAGE_DELAYED_PER_ROUTE_QUERY, result_format='dataframe')
+        return results
+
+    @coalescing.coalesced('aggregate')
+    async def get_route_matrix(self, top_airports=None, min_flights=1, result_format='records'):
+        """
+        Fetch the routes between the busiest airports (see FlightData.get_route_matrix).
+        """
+        params = {'top_airports': -1 if top_airports is None else top_airports,
+                  'min_flights': min_flights}
+        if await self._summaries_ready():
+            return await self._execute_query(summaries.ROUTE_MATRIX_QUERY, params, result_format)
+        return await self._execute_query(data.ROUTE_MATRIX_QUERY, params, result_format)
+
+    @coalescing.coalesced('aggregate')
+    async def get_percentage_delayed_flights_for_map(self):
+        """
+        Fetch the route aggregates with the coordinates of both airports, as a DataFrame.
+        """
+        if await self._summaries_ready():
+            return await self._execute_query(summaries.ROUTES_FOR_MAP_QUERY, result_format='dataframe')
+        return await self._execute_query(data.ROUTES_FOR_MAP_QUERY, result_format='dataframe')
+
+    async def close(self):
+        """
+        Close all connections of the engines.
+        """
+        await self.engine.dispose()
+        if self.summaries is not None:
+            self.summaries.engine.dispose()
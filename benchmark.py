@@ -0,0 +1,483 @@
+"""
+Benchmark suite for the flights project.
+
+    python benchmark.py generate flights_bench.sqlite3 --rows 1M
+    python benchmark.py run flights_bench.sqlite3 --output results.json
+    python benchmark.py compare baseline.json results.json
+
+`generate` builds a flights/airlines database with realistic distributions,
+`run` times every FlightData method, every API endpoint (through the Flask
+test client) and every CLI option, and `compare` reports regressions
+between two result files.
+"""
+import argparse
+import builtins
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import platform
+import resource
+import shutil
+import sqlite3
+import sys
+import time
+from datetime import date, datetime, timedelta
+import numpy as np
+
+# Rows generated and inserted per batch
+GENERATE_BATCH_SIZE = 500000
+
+# Airlines with their approximate share of US domestic flights
+AIRLINES = [
+    ('Southwest Airlines Co.', 0.22), ('Delta Air Lines Inc.', 0.15),
+    ('American Airlines Inc.', 0.12), ('Skywest Airlines Inc.', 0.10),
+    ('Atlantic Southeast Airlines', 0.10), ('United Air Lines Inc.', 0.09),
+    ('American Eagle Airlines Inc.', 0.05), ('JetBlue Airways', 0.05),
+    ('US Airways Inc.', 0.03), ('Alaska Airlines Inc.', 0.03),
+    ('Spirit Air Lines', 0.02), ('Frontier Airlines Inc.', 0.02),
+    ('Hawaiian Airlines Inc.', 0.01), ('Virgin America', 0.01),
+]
+
+# Airports, busiest first; traffic follows a Zipf-like distribution over this list
+AIRPORTS = [
+    'ATL', 'ORD', 'DFW', 'DEN', 'LAX', 'SFO', 'PHX', 'IAH', 'LAS', 'MSP',
+    'MCO', 'SEA', 'DTW', 'BOS', 'EWR', 'CLT', 'LGA', 'SLC', 'JFK', 'BWI',
+    'MDW', 'DCA', 'FLL', 'SAN', 'MIA', 'PHL', 'TPA', 'DAL', 'HOU', 'BNA',
+    'PDX', 'STL', 'HNL', 'OAK', 'AUS', 'MSY', 'MCI', 'SJC', 'SMF', 'SNA',
+    'RDU', 'IAD', 'CLE', 'SAT', 'PIT', 'IND', 'CMH', 'CVG', 'MKE', 'JAX',
+]
+
+# Relative number of departures per scheduled hour of the day
+HOURLY_DEPARTURES = [1, 0.5, 0.2, 0.2, 0.5, 3, 6, 7, 7, 6, 6, 6,
+                     6, 6, 6, 6, 6, 7, 7, 6, 5, 4, 3, 2]
+
+# Share of flights without a departure delay (cancelled)
+CANCELLED_SHARE = 0.015
+
+# Share of flights that leave late, and the mean of their (exponential) delay
+DELAYED_SHARE = 0.37
+MEAN_DELAY = 32
+
+# Flight IDs looked up per batch in the batch lookup benchmarks
+BATCH_IDS = 500
+
+# Length of the date range of the date-range benchmarks, and the number of
+# top delays they fetch
+RANGE_DAYS = 30
+RANGE_K = 20
+
+# Busiest airports in the route matrix benchmarks
+ROUTE_MATRIX_TOP = 30
+
+SCHEMA = """
+CREATE TABLE airlines (ID INTEGER PRIMARY KEY, AIRLINE TEXT);
+CREATE TABLE flights (
+    ID INTEGER PRIMARY KEY,
+    YEAR INTEGER, MONTH INTEGER, DAY INTEGER, DAY_OF_WEEK INTEGER,
+    AIRLINE INTEGER, FLIGHT_NUMBER INTEGER, TAIL_NUMBER TEXT,
+    ORIGIN_AIRPORT TEXT, DESTINATION_AIRPORT TEXT,
+    SCHEDULED_DEPARTURE TEXT, DEPARTURE_DELAY REAL, ARRIVAL_DELAY REAL,
+    DIVERTED INTEGER, CANCELLED INTEGER
+);
+"""
+
+
+def parse_count(value):
+    """
+    Parse a row count such as 500000, 500K, 1M or 50M.
+    """
+    multipliers = {'K': 1000, 'M': 1000 ** 2, 'B': 1000 ** 3}
+    value = value.strip().upper()
+    if value and value[-1] in multipliers:
+        return int(float(value[:-1]) * multipliers[value[-1]])
+    return int(value)
+
+
+def generate_batch(rng, first_id, count, start, days):
+    """
+    Generate count flights as a list of row tuples, starting at ID first_id.
+    """
+    airline_weights = np.array([share for _, share in AIRLINES])
+    airport_weights = 1 / np.arange(1, len(AIRPORTS) + 1)
+    hour_weights = np.array(HOURLY_DEPARTURES)
+
+    airline = rng.choice(len(AIRLINES), count, p=airline_weights / airline_weights.sum()) + 1
+    origin = rng.choice(len(AIRPORTS), count, p=airport_weights / airport_weights.sum())
+    # Shift the destination so it never equals the origin
+    destination = (origin + rng.choice(len(AIRPORTS) - 1, count,
+                                       p=airport_weights[1:] / airport_weights[1:].sum()) + 1) % len(AIRPORTS)
+    day_offset = rng.integers(0, days, count)
+    hour = rng.choice(24, count, p=hour_weights / hour_weights.sum())
+    minute = rng.integers(0, 12, count) * 5
+    flight_number = rng.integers(1, 7000, count)
+
+    # Most flights leave a few minutes early or on time, the rest late with a long tail;
+    # evening departures are delayed more often
+    late = rng.random(count) < DELAYED_SHARE * (0.7 + hour / 40)
+    delay = np.where(late, np.ceil(rng.exponential(MEAN_DELAY, count)),
+                     np.minimum(np.round(rng.normal(-3, 4, count)), 0))
+    cancelled = rng.random(count) < CANCELLED_SHARE
+    arrival_delay = delay + np.round(rng.normal(-5, 8, count))
+
+    rows = []
+    for i in range(count):
+        day = start + timedelta(days=int(day_offset[i]))
+        is_cancelled = bool(cancelled[i])
+        rows.append((
+            first_id + i, day.year, day.month, day.day, day.isoweekday(),
+            int(airline[i]), int(flight_number[i]),
+            f"N{(first_id + i) % 9000 + 100}", AIRPORTS[origin[i]], AIRPORTS[destination[i]],
+            f"{hour[i]:02d}:{minute[i]:02d}",
+            None if is_cancelled else float(delay[i]),
+            None if is_cancelled else float(arrival_delay[i]),
+            0, int(is_cancelled),
+        ))
+    return rows
+
+
+def generate(path, rows, years=3, seed=42):
+    """
+    Build a new SQLite database at path with `rows` synthetic flights spread over `years` years.
+    """
+    if os.path.exists(path):
+        os.remove(path)
+    rng = np.random.default_rng(seed)
+    start = date(2015, 1, 1)
+    days = (date(2015 + years, 1, 1) - start).days
+
+    connection = sqlite3.connect(path)
+    connection.executescript("PRAGMA journal_mode = OFF; PRAGMA synchronous = OFF;")
+    connection.executescript(SCHEMA)
+    connection.executemany("INSERT INTO airlines VALUES (?, ?)",
+                           [(i, name) for i, (name, _) in enumerate(AIRLINES, start=1)])
+
+    generated = 0
+    while generated < rows:
+        count = min(GENERATE_BATCH_SIZE, rows - generated)
+        batch = generate_batch(rng, generated + 1, count, start, days)
+        connection.executemany(f"INSERT INTO flights VALUES ({', '.join('?' * 15)})", batch)
+        connection.commit()
+        generated += count
+        print(f"Generated {generated}/{rows} flights", file=sys.stderr)
+    connection.close()
+
+
+def peak_rss_mb():
+    """
+    Peak resident set size of this process so far, in MiB.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+
+def row_count(result):
+    """
+    Number of rows in a method or endpoint result.
+    """
+    try:
+        return len(result)
+    except TypeError:
+        return 1
+
+
+def measure(kind, name, func, repeat):
+    """
+    Call func repeat times and return its latency percentiles, throughput and memory.
+    """
+    timings = []
+    rows = 0
+    for _ in range(repeat):
+        started = time.perf_counter()
+        rows = row_count(func())
+        timings.append(time.perf_counter() - started)
+    timings.sort()
+    mean = sum(timings) / len(timings)
+    return {
+        'kind': kind,
+        'name': name,
+        'p50_ms': timings[int(0.50 * (len(timings) - 1))] * 1000,
+        'p95_ms': timings[int(0.95 * (len(timings) - 1))] * 1000,
+        'mean_ms': mean * 1000,
+        'rows': rows,
+        'rows_per_sec': rows / mean if mean else None,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def sample_arguments(path):
+    """
+    Pick an airline, an airport, a date and a flight ID that exist in the
+    database, a batch of flight IDs for the batch lookups, and a date range
+    of RANGE_DAYS days starting at that date.
+    """
+    connection = sqlite3.connect(path)
+    airline = connection.execute(
+        "SELECT airlines.airline FROM flights JOIN airlines ON flights.airline = airlines.id "
+        "WHERE flights.ID = (SELECT MIN(ID) FROM flights)"
+    ).fetchone()[0]
+    flight_id, airport, year, month, day = connection.execute(
+        "SELECT ID, ORIGIN_AIRPORT, YEAR, MONTH, DAY FROM flights ORDER BY ID LIMIT 1"
+    ).fetchone()
+    flight_ids = [row[0] for row in connection.execute(
+        "SELECT ID FROM flights ORDER BY ID LIMIT :count", {'count': BATCH_IDS})]
+    connection.close()
+    start = date(year, month, day)
+    return {'airline': airline, 'airport': airport, 'flight_id': flight_id, 'flight_ids': flight_ids,
+            'year': year, 'month': month, 'day': day,
+            'start': start, 'end': start + timedelta(days=RANGE_DAYS - 1)}
+
+
+def method_benchmarks(data_manager, args):
+    """
+    (name, callable) pairs for every FlightData query method.
+    """
+    return [
+        ('get_flight_by_id', lambda: data_manager.get_flight_by_id(args['flight_id'])),
+        ('get_delayed_flights_by_airline', lambda: data_manager.get_delayed_flights_by_airline(args['airline'])),
+        ('get_delayed_flights_by_airport', lambda: data_manager.get_delayed_flights_by_airport(args['airport'])),
+        ('get_flights_by_ids', lambda: data_manager.get_flights_by_ids(args['flight_ids'])),
+        ('get_top_5_delays_by_date',
+         lambda: data_manager.get_top_5_delays_by_date(args['day'], args['month'], args['year'])),
+        ('get_top_delays_by_date_range',
+         lambda: data_manager.get_top_delays_by_date_range(args['start'], args['end'], RANGE_K)),
+        ('get_delay_rollup',
+         lambda: data_manager.get_delay_rollup(args['start'], args['end'], 'week', 'airline')),
+        ('get_delay_percentiles', lambda: data_manager.get_delay_percentiles(args['start'], args['end'])),
+        ('get_distinct_routes', lambda: data_manager.get_distinct_routes(args['start'], args['end'])),
+        ('get_top_10_busiest_airlines', data_manager.get_top_10_busiest_airlines),
+        ('get_average_delay_per_airline', data_manager.get_average_delay_per_airline),
+        ('get_percentage_delayed_flights_per_airline', data_manager.get_percentage_delayed_flights_per_airline),
+        ('get_average_delay_per_origin', data_manager.get_average_delay_per_origin),
+        ('get_percentage_delayed_flights_per_hour', data_manager.get_percentage_delayed_flights_per_hour),
+        ('get_percentage_delayed_flights_per_route', data_manager.get_percentage_delayed_flights_per_route),
+        ('get_route_matrix', lambda: data_manager.get_route_matrix(top_airports=ROUTE_MATRIX_TOP)),
+    ]
+
+
+def endpoint_benchmarks(api, args):
+    """
+    (name, callable) pairs for every API endpoint. Cached endpoints and the
+    charts are measured both cold (cache cleared before each request) and warm.
+    """
+    client = api.app.test_client()
+
+    def get(url, cold=False):
+        def request():
+            if cold:
+                api.response_cache.clear()
+            response = client.get(url)
+            return response.get_json() if response.is_json else response.get_data()
+        return request
+
+    def chart(url, cold=False):
+        def request():
+            if cold:
+                shutil.rmtree(api.chart_renderer.cache_dir, ignore_errors=True)
+            return client.get(url).get_data()
+        return request
+
+    def post(url, body):
+        def request():
+            return client.post(url, json=body).get_json()
+        return request
+
+    date_arg = f"{args['day']:02d}/{args['month']:02d}/{args['year']}"
+    range_arg = f"start={args['start']:%d/%m/%Y}&end={args['end']:%d/%m/%Y}"
+    benchmarks = [
+        ('GET /flights/delayed_by_airline', get(f"/flights/delayed_by_airline?airline={args['airline']}")),
+        ('GET /flights/delayed_by_airport', get(f"/flights/delayed_by_airport?airport={args['airport']}")),
+        ('GET /flights/<id>', get(f"/flights/{args['flight_id']}")),
+        ('POST /flights/batch', post("/flights/batch", {'ids': args['flight_ids']})),
+        ('GET /flights/delayed_by_date', get(f"/flights/delayed_by_date?date={date_arg}")),
+        ('GET /flights/delayed_by_date (range)', get(f"/flights/delayed_by_date?{range_arg}&k={RANGE_K}")),
+    ]
+    # Named by path and fixed parameters only, so results of databases with
+    # different sample dates can be compared
+    cached = [
+        ('/flights/average_delay_by_airline', '/flights/average_delay_by_airline'),
+        ('/flights/average_delay_by_origin', '/flights/average_delay_by_origin'),
+        ('/flights/top_busiest_airlines', '/flights/top_busiest_airlines'),
+        (f"/flights/route_matrix?top={ROUTE_MATRIX_TOP}", f"/flights/route_matrix?top={ROUTE_MATRIX_TOP}"),
+        ('/flights/delay_rollup?bucket=week&group_by=airline',
+         f"/flights/delay_rollup?{range_arg}&bucket=week&group_by=airline"),
+        ('/flights/delay_percentiles', f"/flights/delay_percentiles?{range_arg}"),
+        ('/flights/distinct_routes', f"/flights/distinct_routes?{range_arg}"),
+    ]
+    for name, url in cached:
+        benchmarks.append((f"GET {name} (cold)", get(url, cold=True)))
+        benchmarks.append((f"GET {name} (warm)", get(url)))
+    # Charts are cached as image files: cold requests query and render them again
+    for name in api.charts.CHARTS:
+        url = f"/charts/{name}.png"
+        benchmarks.append((f"GET {url} (cold)", chart(url, cold=True)))
+        benchmarks.append((f"GET {url} (warm)", chart(url)))
+    return benchmarks
+
+
+def cli_benchmarks(cli, data_manager, args):
+    """
+    (name, callable) pairs for every option of the main-3.py menu, fed with
+    canned input and with the output discarded.
+    """
+    date_arg = f"{args['day']:02d}/{args['month']:02d}/{args['year']}"
+    options = [
+        (1, cli.flight_by_id, [str(args['flight_id'])]),
+        (2, cli.delayed_flights_by_airline, [args['airline']]),
+        (3, cli.delayed_flights_by_airport, [args['airport']]),
+        (4, cli.flights_by_date, [date_arg]),
+        (5, cli.average_delay_per_airline, []),
+        (6, cli.average_delay_per_origin, []),
+        (7, cli.top_10_busiest_airlines, []),
+        (8, cli.plot_percentage_delay_per_airline, []),
+        (9, cli.plot_percentage_delay_per_hour, []),
+    ]
+
+    def run(function, inputs):
+        def option():
+            answers = iter(inputs)
+            original_input = builtins.input
+            builtins.input = lambda prompt='': next(answers)
+            try:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    function(data_manager)
+            finally:
+                builtins.input = original_input
+                if 'matplotlib.pyplot' in sys.modules:
+                    sys.modules['matplotlib.pyplot'].close('all')
+        return option
+
+    return [(f"option {number}: {function.__name__}", run(function, inputs))
+            for number, function, inputs in options]
+
+
+def load_cli():
+    """
+    Import main-3.py (not importable by name because of the dash).
+    """
+    spec = importlib.util.spec_from_file_location(
+        'flights_cli', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main-3.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def run(path, repeat, output, kinds):
+    """
+    Run the benchmarks against the database at path and write the results as JSON.
+    """
+    path = os.path.abspath(path)
+    os.environ['FLIGHTS_DB_URI'] = f"sqlite:///{path}"
+    os.environ.setdefault('MPLBACKEND', 'Agg')  # The plotting options must not open windows
+    args = sample_arguments(path)
+    results = []
+
+    import data
+    import indexes
+    # Create the indexes up front, as the API and CLI do on startup,
+    # so every benchmark runs against the same schema
+    indexes.setup_schema(data.FlightData(os.environ['FLIGHTS_DB_URI']))
+
+    if 'methods' in kinds:
+        data_manager = data.FlightData(os.environ['FLIGHTS_DB_URI'])
+        for name, func in method_benchmarks(data_manager, args):
+            results.append(measure('method', name, func, repeat))
+            print(f"{name}: {results[-1]['p50_ms']:.1f} ms", file=sys.stderr)
+
+    if 'endpoints' in kinds:
+        import flights_api
+        for name, func in endpoint_benchmarks(flights_api, args):
+            results.append(measure('endpoint', name, func, repeat))
+            print(f"{name}: {results[-1]['p50_ms']:.1f} ms", file=sys.stderr)
+
+    if 'cli' in kinds:
+        try:
+            cli = load_cli()
+        except ImportError as e:
+            print(f"Skipping the CLI benchmarks: {e}", file=sys.stderr)
+        else:
+            data_manager = data.FlightData(os.environ['FLIGHTS_DB_URI'])
+            for name, func in cli_benchmarks(cli, data_manager, args):
+                results.append(measure('cli', name, func, repeat))
+                print(f"{name}: {results[-1]['p50_ms']:.1f} ms", file=sys.stderr)
+
+    with sqlite3.connect(path) as connection:
+        flights = connection.execute("SELECT COUNT(*) FROM flights").fetchone()[0]
+    report = {
+        'meta': {
+            'database': path,
+            'flights': flights,
+            'repeat': repeat,
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+        },
+        'results': results,
+    }
+    with open(output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(f"Wrote {len(results)} results to {output}", file=sys.stderr)
+
+
+def compare(baseline_path, current_path, threshold):
+    """
+    Print the p50 latency change of every benchmark present in both result files.
+    Returns the number of benchmarks that got slower by more than threshold (a fraction).
+    """
+    with open(baseline_path) as file:
+        baseline = {(r['kind'], r['name']): r for r in json.load(file)['results']}
+    with open(current_path) as file:
+        current = json.load(file)['results']
+
+    regressions = 0
+    for result in current:
+        before = baseline.get((result['kind'], result['name']))
+        if before is None or not before['p50_ms']:
+            continue
+        change = result['p50_ms'] / before['p50_ms'] - 1
+        flag = ''
+        if change > threshold:
+            flag = '  REGRESSION'
+            regressions += 1
+        print(f"{result['kind']:8} {result['name']:60} {before['p50_ms']:10.2f} -> "
+              f"{result['p50_ms']:10.2f} ms ({change:+.0%}){flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark suite for the flights project.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    generate_parser = commands.add_parser('generate', help="Generate a synthetic flights database.")
+    generate_parser.add_argument('path')
+    generate_parser.add_argument('--rows', type=parse_count, default=parse_count('1M'),
+                                 help="Number of flights, e.g. 1M, 10M, 50M (default 1M).")
+    generate_parser.add_argument('--years', type=int, default=3)
+    generate_parser.add_argument('--seed', type=int, default=42)
+
+    run_parser = commands.add_parser('run', help="Time the queries, endpoints and CLI options.")
+    run_parser.add_argument('path')
+    run_parser.add_argument('--repeat', type=int, default=20)
+    run_parser.add_argument('--output', default='benchmark_results.json')
+    run_parser.add_argument('--only', nargs='+', choices=['methods', 'endpoints', 'cli'],
+                            default=['methods', 'endpoints', 'cli'])
+
+    compare_parser = commands.add_parser('compare', help="Compare two result files.")
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--threshold', type=float, default=0.10,
+                                help="Slowdown counted as a regression (default 0.10 = 10%%).")
+
+    options = parser.parse_args()
+    if options.command == 'generate':
+        generate(options.path, options.rows, options.years, options.seed)
+    elif options.command == 'run':
+        run(options.path, options.repeat, options.output, options.only)
+    else:
+        sys.exit(1 if compare(options.baseline, options.current, options.threshold) else 0)
+
+
+if __name__ == '__main__':
+    main()
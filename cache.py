@@ -0,0 +1,121 @@
+from collections import OrderedDict, namedtuple
+from functools import wraps
+import hashlib
+import threading
+import time
+from flask import Response, request
+
+CacheEntry = namedtuple('CacheEntry', ['body', 'mimetype', 'etag', 'expires_at'])
+
+
+class ResponseCache:
+    """
+    A bounded, thread-safe cache of serialized API responses.
+
+    Entries expire after the TTL given for their endpoint, and once the cache
+    is full the least recently used entry is evicted. Every entry belongs to a
+    data version (see FlightData.get_data_version); when the version changes,
+    the whole cache is invalidated. The version is checked at most once every
+    version_check_interval seconds.
+    """
+
+    def __init__(self, version_func, max_entries=256, version_check_interval=1.0):
+        self.version_func = version_func
+        self.max_entries = max_entries
+        self.version_check_interval = version_check_interval
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._version = None
+        self._version_checked_at = None
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0,
+                      'invalidations': 0, 'not_modified': 0}
+
+    def _check_version(self):
+        """
+        Clear the cache if the data version changed since the last check.
+        Must be called with the lock held.
+        """
+        now = time.monotonic()
+        if (self._version_checked_at is not None
+                and now - self._version_checked_at < self.version_check_interval):
+            return
+        self._version_checked_at = now
+        version = self.version_func()
+        if version != self._version:
+            if self._entries:
+                self.stats['invalidations'] += 1
+            self._entries.clear()
+            self._version = version
+
+    def get(self, key):
+        """
+        Return the cached entry for key, or None if it is missing or stale.
+        """
+        with self._lock:
+            self._check_version()
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires_at <= time.monotonic():
+                del self._entries[key]
+                self.stats['expirations'] += 1
+                entry = None
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return entry
+
+    def put(self, key, body, mimetype, ttl):
+        """
+        Store a serialized response body under key and return its entry.
+        """
+        entry = CacheEntry(body, mimetype, hashlib.sha1(body).hexdigest(), time.monotonic() + ttl)
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats['evictions'] += 1
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def get_stats(self):
+        """
+        Return the counters along with the current size of the cache.
+        """
+        with self._lock:
+            return dict(self.stats, size=len(self._entries), max_entries=self.max_entries)
+
+    def cached(self, ttl):
+        """
+        Decorator for a Flask view returning a JSON response. The response is
+        cached per path and query parameters for ttl seconds, served with an
+        ETag, and answered with 304 Not Modified when the client's
+        If-None-Match matches, without serializing the body again.
+        Error responses are not cached.
+        """
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                key = (request.path, tuple(sorted(request.args.items(multi=True))))
+                entry = self.get(key)
+                if entry is None:
+                    response = view(*args, **kwargs)
+                    if not isinstance(response, Response) or response.status_code != 200:
+                        return response
+                    entry = self.put(key, response.get_data(), response.mimetype, ttl)
+
+                # Weak comparison, as compression makes the ETag weak (see encoding.py)
+                if request.if_none_match.contains_weak(entry.etag):
+                    with self._lock:
+                        self.stats['not_modified'] += 1
+                    response = Response(status=304)
+                else:
+                    response = Response(entry.body, mimetype=entry.mimetype)
+                response.set_etag(entry.etag)
+                return response
+            return wrapper
+        return decorator
@@ -0,0 +1,196 @@
+import glob
+import hashlib
+import os
+import tempfile
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+
+# Where ChartRenderer caches the rendered images
+CHART_CACHE_DIR = 'chart_cache'
+
+# Image formats charts can be rendered to
+CHART_FORMATS = {'png': 'image/png', 'svg': 'image/svg+xml'}
+
+# The route heatmap shows the routes between this many of the busiest airports
+# that have at least HEATMAP_MIN_FLIGHTS flights, and annotates its cells with
+# the percentages when it has at most HEATMAP_ANNOTATE_MAX rows and columns
+HEATMAP_TOP_AIRPORTS = 30
+HEATMAP_MIN_FLIGHTS = 10
+HEATMAP_ANNOTATE_MAX = 15
+
+
+def draw_percentage_delay_per_airline(ax, results):
+    airlines = results['AIRLINE']
+    delay_percentages = results['percentage_delays']
+
+    # Plotting the data
+    ax.bar(airlines, delay_percentages, color='skyblue')
+
+    # Customizing the graph
+    ax.set_title('Percentage of Delayed Flights Per Airline')
+    ax.set_xlabel('Airlines')
+    ax.set_ylabel('Delay Percentage (%)')
+    ax.tick_params(axis='x', labelrotation=45)
+    for label in ax.get_xticklabels():
+        label.set_horizontalalignment('right')
+
+
+def draw_percentage_delay_per_hour(ax, results):
+    hours = results['HOUR']
+    delay_percentages = results['delay_percentage']
+
+    # Plotting the data
+    ax.bar(hours, delay_percentages, color='lightcoral')
+
+    # Customizing the graph
+    ax.set_title('Percentage of Delayed Flights Per Hour of the Day')
+    ax.set_xlabel('Hour of the Day (24-hour format)')
+    ax.set_ylabel('Delay Percentage (%)')
+    ax.set_xticks(range(len(hours)), hours)
+
+
+def draw_heatmap_delay_per_route(ax, results):
+    import seaborn as sns
+
+    # Pivot the reduced set of routes into a matrix of origin -> destination with delay percentage
+    heatmap_data = results.pivot(index="ORIGIN_AIRPORT", columns="DESTINATION_AIRPORT", values="delay_percentage")
+
+    # Cell values are only readable on small matrices
+    sns.heatmap(heatmap_data, ax=ax, annot=max(heatmap_data.shape) <= HEATMAP_ANNOTATE_MAX, fmt=".2f",
+                cmap="YlGnBu", cbar_kws={'label': 'Delay Percentage (%)'})
+
+    ax.set_title('Heatmap of Delayed Flights (Origin -> Destination)')
+    ax.set_xlabel('Destination Airport')
+    ax.set_ylabel('Origin Airport')
+
+
+def route_matrix_data(data_manager, top=HEATMAP_TOP_AIRPORTS, min_flights=HEATMAP_MIN_FLIGHTS):
+    # Only the routes between the busiest airports, aggregated in SQL
+    return data_manager.get_route_matrix(top_airports=top, min_flights=min_flights, result_format='dataframe')
+
+
+# Charts by name: the function fetching their data from a FlightData (taking the
+# chart's integer parameters, listed in 'params', as keyword arguments), the
+# function drawing it on a matplotlib Axes, and the figure size in inches
+CHARTS = {
+    'percentage_delay_per_airline': {
+        'data': lambda data_manager: data_manager.get_percentage_delayed_flights_per_airline(),
+        'params': (),
+        'draw': draw_percentage_delay_per_airline,
+        'figsize': (10, 6),
+    },
+    'percentage_delay_per_hour': {
+        'data': lambda data_manager: data_manager.get_percentage_delayed_flights_per_hour(),
+        'params': (),
+        'draw': draw_percentage_delay_per_hour,
+        'figsize': (10, 6),
+    },
+    'heatmap_delay_per_route': {
+        'data': route_matrix_data,
+        'params': ('top', 'min_flights'),
+        'draw': draw_heatmap_delay_per_route,
+        'figsize': (12, 8),
+    },
+}
+
+
+def render_chart(name, results, image_format, path):
+    """
+    Draw a chart headlessly and save it to path, written to a temporary file
+    of its own next to it first so readers never see a half-written file, even
+    with other workers rendering the same chart. Runs in a ChartRenderer worker.
+    """
+    from matplotlib.figure import Figure  # Renders with Agg, without pyplot's GUI state
+
+    chart = CHARTS[name]
+    fig = Figure(figsize=chart['figsize'])
+    chart['draw'](fig.subplots(), results)
+    fig.tight_layout()
+    tmp = tempfile.NamedTemporaryFile(dir=os.path.dirname(path) or '.', prefix=os.path.basename(path) + '.',
+                                      suffix='.tmp', delete=False)
+    try:
+        with tmp:
+            fig.savefig(tmp, format=image_format)
+        os.replace(tmp.name, path)
+    except BaseException:
+        os.remove(tmp.name)
+        raise
+    return path
+
+
+class ChartRenderer:
+    """
+    Renders the charts to PNG or SVG files on a pool of worker processes, so
+    matplotlib doesn't hold the API threads' GIL, and caches the files on disk
+    keyed by chart, parameters and data version: a repeat request is served
+    from the file without querying or rendering. Concurrent requests for the
+    same image share one rendering.
+    """
+
+    def __init__(self, cache_dir=CHART_CACHE_DIR, workers=2):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.workers = workers
+        self._pool = None
+        self._rendering = {}
+        self._lock = threading.Lock()
+
+    def _executor(self):
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(self.workers)
+        return self._pool
+
+    def cache_path(self, name, params, image_format, version):
+        """
+        Path of the cached image; the parameter and version hashes are separate
+        parts of the name, so older versions of the same image can be found.
+        """
+        params_hash = hashlib.sha1(repr(sorted(params.items())).encode()).hexdigest()[:16]
+        version_hash = hashlib.sha1(repr(version).encode()).hexdigest()[:16]
+        return os.path.join(self.cache_dir, f"{name}-{params_hash}-{version_hash}.{image_format}")
+
+    def render(self, data_manager, name, image_format='png', **params):
+        """
+        Return the path of the chart `name` rendered with the given parameters,
+        or None if there is no data to draw.
+        Raises KeyError for an unknown chart and ValueError for an unknown format.
+        """
+        if name not in CHARTS:
+            raise KeyError(name)
+        if image_format not in CHART_FORMATS:
+            raise ValueError(f"Unknown image format {image_format!r}, expected one of {tuple(CHART_FORMATS)}")
+
+        path = self.cache_path(name, params, image_format, data_manager.get_data_version())
+        if os.path.exists(path):
+            return path
+
+        with self._lock:
+            future = self._rendering.get(path)
+            owner = future is None
+            if owner:
+                future = self._rendering[path] = Future()
+        if owner:
+            try:
+                future.set_result(self._render(data_manager, name, params, image_format, path))
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                with self._lock:
+                    del self._rendering[path]
+        return future.result()
+
+    def _render(self, data_manager, name, params, image_format, path):
+        results = CHARTS[name]['data'](data_manager, **params)
+        if results.empty:
+            return None
+        # Refreshing the summaries may have changed the version, so take it again
+        path = self.cache_path(name, params, image_format, data_manager.get_data_version())
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # Remove the images of older data versions
+        for old in glob.glob(path.rsplit('-', 1)[0] + f"-*.{image_format}"):
+            os.remove(old)
+        return self._executor().submit(render_chart, name, results, image_format, path).result()
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
@@ -0,0 +1,173 @@
+import asyncio
+from concurrent.futures import Future
+from functools import wraps
+import inspect
+import threading
+import instrumentation
+
+# Concurrency limits per query class (the classes are given to the FlightData
+# methods with the coalesced decorator): at most 'limit' queries of a class run
+# at once, and a caller finding them all busy waits up to 'queue_timeout'
+# seconds for a slot (0 sheds it at once, None waits as long as it takes)
+# before QueryOverloaded is raised. Classes without a limit, like 'lookup'
+# (flights by ID, airline or airport), are only coalesced.
+QUERY_LIMITS = {
+    'aggregate': {'limit': 4, 'queue_timeout': 10.0},
+    'range': {'limit': 8, 'queue_timeout': 5.0},
+}
+
+
+class QueryOverloaded(Exception):
+    """
+    Raised when a query class stayed at its concurrency limit for longer than
+    the caller may wait for a slot.
+    """
+
+    def __init__(self, query_class):
+        super().__init__(f"Too many concurrent {query_class} queries, try again later.")
+        self.query_class = query_class
+
+
+def _hashable(value):
+    """
+    A hashable stand-in for an argument value: lists become tuples and sets
+    frozensets, so e.g. percentiles=[50, 90] and (50, 90) are the same call.
+    """
+    if isinstance(value, (list, tuple)):
+        return tuple(_hashable(item) for item in value)
+    if isinstance(value, (set, frozenset)):
+        return frozenset(_hashable(item) for item in value)
+    return value
+
+
+def coalesced(query_class):
+    """
+    Decorator for a FlightData or AsyncFlightData method: concurrent calls with
+    the same arguments share one execution and all get its result (the same
+    object, so callers must not modify it), and the execution counts against
+    the concurrency limit of query_class. The instance's coalescer attribute
+    does the bookkeeping. Calls with arguments that can't be hashed even as
+    tuples aren't coalesced, but still count against the limit.
+    """
+    def decorator(method):
+        signature = inspect.signature(method)
+
+        def call_key(args, kwargs):
+            # Defaults are filled in, so f(x) and f(x, k=5) are the same call
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            key = (method.__name__,) + _hashable(tuple(bound.arguments.values())[1:])
+            try:
+                hash(key)
+            except TypeError:
+                return None
+            return key
+
+        if inspect.iscoroutinefunction(method):
+            @wraps(method)
+            async def wrapper(self, *args, **kwargs):
+                key = call_key((self,) + args, kwargs)
+                return await self.coalescer.run(query_class, key, lambda: method(self, *args, **kwargs))
+        else:
+            @wraps(method)
+            def wrapper(self, *args, **kwargs):
+                key = call_key((self,) + args, kwargs)
+                return self.coalescer.run(query_class, key, lambda: method(self, *args, **kwargs))
+        return wrapper
+    return decorator
+
+
+class QueryCoalescer:
+    """
+    Single-flight execution for the threads of a FlightData: the first caller
+    of a key runs the query, callers of the same key arriving while it runs
+    wait for its result instead of starting the query again. Only the first
+    caller takes a slot of the query class.
+    """
+
+    def __init__(self, limits=None):
+        self.limits = QUERY_LIMITS if limits is None else limits
+        self._slots = {query_class: threading.BoundedSemaphore(limit['limit'])
+                       for query_class, limit in self.limits.items()}
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def run(self, query_class, key, func):
+        if key is None:
+            return self._run_limited(query_class, func)
+        with self._lock:
+            future = self._in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = self._in_flight[key] = Future()
+        if not owner:
+            instrumentation.record_coalesced(key[0])
+            return future.result()
+
+        try:
+            future.set_result(self._run_limited(query_class, func))
+        except BaseException as e:
+            # Including KeyboardInterrupt and SystemExit: the callers waiting
+            # on the future must not be left blocked
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+        return future.result()
+
+    def _run_limited(self, query_class, func):
+        slots = self._slots.get(query_class)
+        if slots is None:
+            return func()
+        if not slots.acquire(timeout=self.limits[query_class]['queue_timeout']):
+            instrumentation.record_shed(query_class)
+            raise QueryOverloaded(query_class)
+        try:
+            return func()
+        finally:
+            slots.release()
+
+
+class AsyncQueryCoalescer:
+    """
+    The asyncio counterpart of QueryCoalescer, for AsyncFlightData. The query
+    runs in its own task, so a caller that is cancelled (e.g. a disconnected
+    client) doesn't cancel it for the others waiting on it.
+    """
+
+    def __init__(self, limits=None):
+        self.limits = QUERY_LIMITS if limits is None else limits
+        self._slots = {query_class: asyncio.Semaphore(limit['limit'])
+                       for query_class, limit in self.limits.items()}
+        self._in_flight = {}
+
+    async def run(self, query_class, key, func):
+        if key is None:
+            return await self._run_limited(query_class, func)
+        task = self._in_flight.get(key)
+        if task is None:
+            task = self._in_flight[key] = asyncio.ensure_future(self._run_limited(query_class, func))
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        else:
+            instrumentation.record_coalesced(key[0])
+        return await asyncio.shield(task)
+
+    async def _run_limited(self, query_class, func):
+        slots = self._slots.get(query_class)
+        if slots is None:
+            return await func()
+        queue_timeout = self.limits[query_class]['queue_timeout']
+        if slots.locked():
+            try:
+                if queue_timeout == 0:
+                    raise asyncio.TimeoutError
+                await asyncio.wait_for(slots.acquire(), queue_timeout)
+            except asyncio.TimeoutError:
+                instrumentation.record_shed(query_class)
+                raise QueryOverloaded(query_class) from None
+        else:
+            await slots.acquire()
+        try:
+            return await func()
+        finally:
+            slots.release()
@@ -1,228 +1,824 @@
-from sqlalchemy import create_engine, text
+import logging
+import os
+import time
+from sqlalchemy import text
 from sqlalchemy.exc import SQLAlchemyError
-import pandas as pd  # Ensure you import pandas
+import coalescing
+import instrumentation
+import parallel
+import sketches
+import sqlite_engine
+import summaries
+
+logger = logging.getLogger(__name__)
+
+# Rows fetched per round trip when streaming results from a server-side cursor
+STREAM_BATCH_SIZE = 1000
+
+# Rows fetched per fetchmany() call when materializing a result
+FETCH_BATCH_SIZE = 10000
+
+# Result formats accepted by FlightData._execute_query
+RESULT_FORMATS = ('records', 'dataframe', 'arrow', 'tuples')
+
+# Flight IDs looked up per IN (...) query; well below SQLite's limit on bound parameters
+ID_CHUNK_SIZE = 500
+
+# Queries taking longer than this many seconds go to the slow-query log
+SLOW_QUERY_THRESHOLD = 0.5
+
+# SQL used by FlightData and AsyncFlightData (see async_data.py)
+FLIGHT_BY_ID_QUERY = """
+SELECT flights.*, 
+       airlines.airline AS AIRLINE,  
+       flights.ID as FLIGHT_ID, 
+       flights.DEPARTURE_DELAY as DELAY,
+       flights.year AS YEAR,        -- Add year to the result
+       flights.month AS MONTH,      -- Add month to the result
+       flights.day AS DAY           -- Add day to the result
+FROM flights
+JOIN airlines ON flights.airline = airlines.id
+WHERE flights.ID = :id
+"""
+
+# {ids} is replaced with one named parameter per flight ID
+FLIGHTS_BY_IDS_QUERY = """
+SELECT flights.*, 
+       airlines.airline AS AIRLINE,  
+       flights.ID as FLIGHT_ID, 
+       flights.DEPARTURE_DELAY as DELAY,
+       flights.year AS YEAR,
+       flights.month AS MONTH,
+       flights.day AS DAY
+FROM flights
+JOIN airlines ON flights.airline = airlines.id
+WHERE flights.ID IN ({ids})
+"""
+
+DELAYED_FLIGHTS_BY_AIRLINE_QUERY = """
+SELECT flights.*, airlines.airline, flights.ID as FLIGHT_ID, flights.DEPARTURE_DELAY as DELAY
+FROM flights
+JOIN airlines ON flights.airline = airlines.id
+WHERE airlines.airline = :airline
+AND flights.DEPARTURE_DELAY IS NOT NULL
+AND flights.DEPARTURE_DELAY > 0
+"""
+
+DELAYED_FLIGHTS_BY_AIRPORT_QUERY = """
+SELECT flights.*, airlines.airline, flights.ID as FLIGHT_ID, flights.DEPARTURE_DELAY as DELAY
+FROM flights
+JOIN airlines ON flights.airline = airlines.id
+WHERE flights.ORIGIN_AIRPORT = :airport
+AND flights.DEPARTURE_DELAY IS NOT NULL
+AND flights.DEPARTURE_DELAY > 0
+"""
+
+TOP_DELAYS_BY_DATE_RANGE_QUERY = """
+SELECT flights.*, 
+        airlines.airline, 
+        flights.ID as FLIGHT_ID, 
+        flights.DEPARTURE_DELAY as DELAY 
+FROM flights 
+JOIN airlines ON flights.airline = airlines.id 
+WHERE (flights.year, flights.month, flights.day) >= (:start_year, :start_month, :start_day)
+AND (flights.year, flights.month, flights.day) <= (:end_year, :end_month, :end_day)
+AND flights.DEPARTURE_DELAY IS NOT NULL
+ORDER BY flights.DEPARTURE_DELAY DESC, flights.ID
+LIMIT :k
+"""
+
+TOP_10_BUSIEST_AIRLINES_QUERY = """
+SELECT airlines.airline AS airline, COUNT(*) AS flight_count
+FROM flights
+JOIN airlines ON flights.airline = airlines.id
+GROUP BY airlines.airline
+ORDER BY flight_count DESC
+LIMIT 10
+"""
+
+AVERAGE_DELAY_PER_AIRLINE_QUERY = """
+SELECT 
+    airlines.airline AS AIRLINE,
+    AVG(CASE 
+            WHEN flights.DEPARTURE_DELAY >= 0 THEN flights.DEPARTURE_DELAY 
+            ELSE NULL 
+        END) AS average_delay 
+FROM 
+    flights 
+JOIN airlines ON flights.airline = airlines.id
+WHERE
+    flights.DEPARTURE_DELAY IS NOT NULL  -- Ignore NULL delays
+GROUP BY 
+    airlines.airline 
+ORDER BY 
+    average_delay DESC;
+"""
+
+PERCENTAGE_DELAYED_PER_AIRLINE_QUERY = """
+SELECT 
+    airlines.airline AS AIRLINE,
+    COUNT(*) AS total_flights,
+    SUM(CASE WHEN flights.DEPARTURE_DELAY > 0 THEN 1 ELSE 0 END) AS delayed_flights
+FROM 
+    flights 
+JOIN airlines ON flights.airline = airlines.id
+GROUP BY 
+    airlines.airline;
+"""
+
+AVERAGE_DELAY_PER_ORIGIN_QUERY = """
+SELECT 
+    flights.ORIGIN_AIRPORT AS origin_airport,
+    AVG(CASE 
+            WHEN flights.DEPARTURE_DELAY >= 0 THEN flights.DEPARTURE_DELAY 
+            ELSE NULL 
+        END) AS average_delay 
+FROM 
+    flights 
+WHERE
+    flights.DEPARTURE_DELAY IS NOT NULL  -- Ensure there are no NULL values
+GROUP BY 
+    flights.ORIGIN_AIRPORT 
+ORDER BY 
+    average_delay DESC;
+"""
+
+PERCENTAGE_DELAYED_PER_HOUR_QUERY = """
+SELECT 
+    strftime('%H', flights.SCHEDULED_DEPARTURE) AS hour,  -- Extract hour from SCHEDULED_DEPARTURE
+    COUNT(*) AS total_flights,
+    SUM(CASE WHEN flights.DEPARTURE_DELAY > 0 THEN 1 ELSE 0 END) AS delayed_flights
+FROM 
+    flights 
+GROUP BY 
+    hour;
+"""
+
+PERCENTAGE_DELAYED_PER_ROUTE_QUERY = """
+SELECT 
+    ORIGIN_AIRPORT,
+    DESTINATION_AIRPORT,
+    AVG(CASE WHEN DEPARTURE_DELAY > 0 THEN 1 ELSE 0 END) * 100 AS delay_percentage
+FROM 
+    flights
+GROUP BY 
+    ORIGIN_AIRPORT, DESTINATION_AIRPORT
+"""
+
+# Route aggregates with the coordinates of both airports; routes whose
+# airports aren't in the airports table are left out
+ROUTES_FOR_MAP_QUERY = """
+SELECT routes.ORIGIN_AIRPORT,
+       routes.DESTINATION_AIRPORT,
+       routes.flight_count,
+       routes.avg_delay,
+       routes.delay_percentage,
+       origin.LONGITUDE AS ORIGIN_LONGITUDE,
+       origin.LATITUDE AS ORIGIN_LATITUDE,
+       destination.LONGITUDE AS DESTINATION_LONGITUDE,
+       destination.LATITUDE AS DESTINATION_LATITUDE
+FROM (
+    SELECT ORIGIN_AIRPORT,
+           DESTINATION_AIRPORT,
+           COUNT(*) AS flight_count,
+           AVG(CASE WHEN DEPARTURE_DELAY >= 0 THEN DEPARTURE_DELAY END) AS avg_delay,
+           AVG(CASE WHEN DEPARTURE_DELAY > 0 THEN 1 ELSE 0 END) * 100 AS delay_percentage
+    FROM flights
+    GROUP BY ORIGIN_AIRPORT, DESTINATION_AIRPORT
+) AS routes
+JOIN airports AS origin ON origin.IATA_CODE = routes.ORIGIN_AIRPORT
+JOIN airports AS destination ON destination.IATA_CODE = routes.DESTINATION_AIRPORT
+"""
+
+# Routes between the top_airports busiest airports (by departures plus arrivals;
+# -1 means all of them) with at least min_flights flights, aggregated in SQL so
+# only the reduced set of routes leaves the database
+ROUTE_MATRIX_QUERY = """
+WITH routes AS (
+    SELECT ORIGIN_AIRPORT AS origin,
+           DESTINATION_AIRPORT AS destination,
+           COUNT(*) AS flight_count,
+           SUM(CASE WHEN DEPARTURE_DELAY > 0 THEN 1 ELSE 0 END) AS delayed_count
+    FROM flights
+    GROUP BY ORIGIN_AIRPORT, DESTINATION_AIRPORT
+),
+top_airports AS (
+    SELECT airport
+    FROM (SELECT origin AS airport, flight_count FROM routes
+          UNION ALL
+          SELECT destination, flight_count FROM routes)
+    WHERE airport IS NOT NULL
+    GROUP BY airport
+    ORDER BY SUM(flight_count) DESC
+    LIMIT :top_airports
+)
+SELECT origin AS ORIGIN_AIRPORT,
+       destination AS DESTINATION_AIRPORT,
+       flight_count,
+       delayed_count * 100.0 / flight_count AS delay_percentage
+FROM routes
+WHERE flight_count >= :min_flights
+  AND origin IN top_airports
+  AND destination IN top_airports
+ORDER BY origin, destination
+"""
+
+# Groups the delay rollups can be split by: selected column, grouping expression and join
+ROLLUP_GROUPS = {
+    None: (None, None, ""),
+    'airline': ("airlines.airline AS AIRLINE", "airlines.airline",
+                "JOIN airlines ON flights.airline = airlines.id"),
+    'origin': ("flights.ORIGIN_AIRPORT AS origin_airport", "flights.ORIGIN_AIRPORT", ""),
+}
+
+
+def keyset_page(query, params, limit=None, after=None):
+    """
+    Add keyset pagination on flights.ID to a delayed-flights query.
+    Only rows with an ID greater than `after` are returned, ordered by ID,
+    at most `limit` of them.
+    """
+    params = dict(params)
+    if after is not None:
+        query += "AND flights.ID > :after\n"
+        params['after'] = after
+    query += "ORDER BY flights.ID\n"
+    if limit is not None:
+        query += "LIMIT :limit\n"
+        params['limit'] = limit
+    return query, params
+
+
+def date_range_params(start, end):
+    """
+    Parameters of the date range queries for the (year, month, day) tuples start and end.
+    """
+    params = {}
+    for prefix, date in (('start', start), ('end', end)):
+        params.update(zip((f'{prefix}_year', f'{prefix}_month', f'{prefix}_day'), date))
+    return params
+
+
+def rollup_query(bucket, group_by=None):
+    """
+    The query computing the flight count, percentage of delayed flights and
+    average delay per bucket (and group) between two dates from the flights
+    table, in one pass over the date range of the (year, month, day) index.
+    See summaries.rollup_query() for the same from the daily rollups.
+    """
+    group_column, group_expression, join = ROLLUP_GROUPS[group_by]
+    columns = [f"{summaries.ROLLUP_BUCKETS[bucket].format(table='flights')} AS bucket"]
+    grouping = ["bucket"]
+    if group_column:
+        columns.append(group_column)
+        grouping.append(group_expression)
+    columns += ["COUNT(*) AS flight_count",
+                "SUM(CASE WHEN flights.DEPARTURE_DELAY > 0 THEN 1 ELSE 0 END) * 100.0 / COUNT(*) AS delay_percentage",
+                "AVG(CASE WHEN flights.DEPARTURE_DELAY >= 0 THEN flights.DEPARTURE_DELAY END) AS average_delay"]
+    return f"""
+SELECT {', '.join(columns)}
+FROM flights
+{join}
+WHERE (flights.year, flights.month, flights.day) >= (:start_year, :start_month, :start_day)
+  AND (flights.year, flights.month, flights.day) <= (:end_year, :end_month, :end_day)
+GROUP BY {', '.join(grouping)}
+ORDER BY {', '.join(grouping)}
+"""
+
+
+def delay_histogram_query(group_by=None):
+    """
+    The query counting the flights of each distinct delay (per group) between
+    two dates, for delay percentiles estimated without the sketch tables
+    (see sketches.bucket_delays()). The groups are those of the rollups.
+    """
+    group_column, group_expression, join = ROLLUP_GROUPS[group_by]
+    columns = [group_column] if group_column else []
+    grouping = [group_expression] if group_column else []
+    return f"""
+SELECT {', '.join(columns + ["flights.DEPARTURE_DELAY AS delay", "COUNT(*) AS flight_count"])}
+FROM flights
+{join}
+WHERE (flights.year, flights.month, flights.day) >= (:start_year, :start_month, :start_day)
+  AND (flights.year, flights.month, flights.day) <= (:end_year, :end_month, :end_day)
+  AND flights.DEPARTURE_DELAY IS NOT NULL
+GROUP BY {', '.join(grouping + ["flights.DEPARTURE_DELAY"])}
+ORDER BY {', '.join(grouping + ["flights.DEPARTURE_DELAY"])}
+"""
+
+
+def routes_flown_query(group_by=None):
+    """
+    The query listing the distinct routes (per group) between two dates, for
+    distinct route counts estimated without the sketch tables
+    (see sketches.register_routes()).
+    """
+    group_column, group_expression, join = ROLLUP_GROUPS[group_by]
+    columns = [group_column] if group_column else []
+    grouping = [group_expression] if group_column else []
+    order = f"ORDER BY {group_expression}" if group_column else ""
+    return f"""
+SELECT {', '.join(columns + ["flights.ORIGIN_AIRPORT AS origin", "flights.DESTINATION_AIRPORT AS destination"])}
+FROM flights
+{join}
+WHERE (flights.year, flights.month, flights.day) >= (:start_year, :start_month, :start_day)
+  AND (flights.year, flights.month, flights.day) <= (:end_year, :end_month, :end_day)
+  AND flights.ORIGIN_AIRPORT IS NOT NULL AND flights.DESTINATION_AIRPORT IS NOT NULL
+GROUP BY {', '.join(grouping + ["flights.ORIGIN_AIRPORT", "flights.DESTINATION_AIRPORT"])}
+{order}
+"""
+
+
+def check_rollup_args(bucket, group_by):
+    """
+    Raise ValueError for a bucket or group that delay rollups don't support.
+    """
+    if bucket not in summaries.ROLLUP_BUCKETS:
+        raise ValueError(f"Unknown bucket {bucket!r}, expected one of {tuple(summaries.ROLLUP_BUCKETS)}")
+    if group_by not in ROLLUP_GROUPS:
+        raise ValueError(f"Unknown group {group_by!r}, expected one of {tuple(ROLLUP_GROUPS)}")
+
+
+def flights_by_ids_queries(flight_ids, chunk_size=ID_CHUNK_SIZE):
+    """
+    Split flight_ids (duplicates dropped) into chunks of chunk_size and
+    yield the FLIGHTS_BY_IDS_QUERY and its parameters for each chunk.
+    """
+    flight_ids = list(dict.fromkeys(flight_ids))
+    for start in range(0, len(flight_ids), chunk_size):
+        chunk = flight_ids[start:start + chunk_size]
+        params = {f'id{i}': flight_id for i, flight_id in enumerate(chunk)}
+        yield FLIGHTS_BY_IDS_QUERY.format(ids=", ".join(f":{name}" for name in params)), params
+
+
+def materialize(result, result_format='records', batch_size=FETCH_BATCH_SIZE):
+    """
+    Fetch a query result in batches of batch_size rows and return it as:
+    'records' - a list of dictionaries, one per row
+    'tuples' - a list of row tuples
+    'dataframe' - a pandas DataFrame
+    'arrow' - a pyarrow Table
+    The columnar formats are filled column by column from each batch,
+    without building a dictionary per row.
+    """
+    if result_format not in RESULT_FORMATS:
+        raise ValueError(f"Unknown result format {result_format!r}, expected one of {RESULT_FORMATS}")
+
+    keys = list(result.keys())
+    if result_format in ('records', 'tuples'):
+        rows = []
+        while batch := result.fetchmany(batch_size):
+            rows.extend(batch)
+        if result_format == 'records':
+            return [dict(zip(keys, row)) for row in rows]
+        return rows
+
+    columns = [[] for _ in keys]
+    while batch := result.fetchmany(batch_size):
+        for column, values in zip(columns, zip(*batch)):
+            column.extend(values)
+
+    if result_format == 'arrow':
+        import pyarrow as pa  # Only needed for this format
+        return pa.table(columns, names=keys)
+    import pandas as pd  # Imported on first use, so plain lookups don't pay for it
+    df = pd.DataFrame(dict(enumerate(columns)))
+    df.columns = keys
+    return df
+
+
+def empty_result(result_format='records'):
+    """
+    The value _execute_query returns in the given format when a query fails.
+    """
+    if result_format == 'dataframe':
+        import pandas as pd  # Imported on first use, so plain lookups don't pay for it
+        return pd.DataFrame()
+    if result_format == 'arrow':
+        import pyarrow as pa  # Only needed for this format
+        return pa.table({})
+    return []
+
+
+def percentage_delays_per_airline(results):
+    """
+    Turn per-airline total and delayed flight counts into a DataFrame of delay percentages.
+    """
+    import pandas as pd  # Imported on first use, so plain lookups don't pay for it
+
+    # Convert the results to a DataFrame for easier manipulation
+    df = pd.DataFrame(results)
+
+    # Calculate percentage delays
+    df['percentage_delays'] = (df['delayed_flights'] / df['total_flights'] * 100).fillna(0)
+
+    return df[['AIRLINE', 'percentage_delays']]  # Return only the relevant columns
+
+
+def sparse_route_matrix(routes):
+    """
+    Turn the records of FlightData.get_route_matrix() into a sparse (coordinate
+    format) matrix: the sorted airport codes, and for each route the indexes of its
+    origin and destination in that list, its delay percentage and flight count.
+    """
+    airports = sorted({route['ORIGIN_AIRPORT'] for route in routes}
+                      | {route['DESTINATION_AIRPORT'] for route in routes})
+    index = {airport: i for i, airport in enumerate(airports)}
+    return {
+        'airports': airports,
+        'origin': [index[route['ORIGIN_AIRPORT']] for route in routes],
+        'destination': [index[route['DESTINATION_AIRPORT']] for route in routes],
+        'delay_percentage': [route['delay_percentage'] for route in routes],
+        'flight_count': [route['flight_count'] for route in routes],
+    }
+
+
+def percentage_delays_per_hour(results):
+    """
+    Turn per-hour total and delayed flight counts into a DataFrame of delay percentages.
+    """
+    import pandas as pd  # Imported on first use, so plain lookups don't pay for it
+
+    # Convert the results to a DataFrame for easier manipulation
+    df = pd.DataFrame(results)
+
+    # Calculate percentage delays
+    df['delay_percentage'] = (df['delayed_flights'] / df['total_flights'] * 100).fillna(0)
+
+    # Rename columns to match expected format if necessary
+    df.rename(columns={'hour': 'HOUR'}, inplace=True)  # Rename 'hour' to 'HOUR'
+
+    return df[['HOUR', 'delay_percentage']]  # Return only the relevant columns
 
 
 class FlightData:
-    def __init__(self, db_uri):
+    def __init__(self, db_uri, use_summaries=False, engine_profile=None,
+                 slow_query_threshold=SLOW_QUERY_THRESHOLD, parallel_workers=None,
+                 query_limits=None):
         """
         Initialize a new engine using the given database URI.
+        SQLite engines are tuned with engine_profile, the name of a profile
+        in sqlite_engine.PROFILES or a dictionary of overrides; the engine and
+        its connection pool can be shared by all request threads.
+        With use_summaries, the aggregate methods are answered from the
+        incrementally refreshed summary tables (see summaries.py).
+        Queries slower than slow_query_threshold seconds are logged with
+        their query plan to the 'flights.slow_queries' logger.
+        The aggregate methods called with parallel=True run partitioned by
+        year and month on a pool of parallel_workers processes (one per CPU
+        by default; see parallel.py).
+        Concurrent calls of a query method with the same arguments share one
+        execution, and each query class runs at most as many queries at once
+        as query_limits allows (coalescing.QUERY_LIMITS by default); callers
+        waiting too long for a slot get coalescing.QueryOverloaded.
+        """
+        self.engine = sqlite_engine.create_sqlite_engine(db_uri, engine_profile)
+        self.summaries = summaries.DelaySummaries(self.engine) if use_summaries else None
+        self.slow_query_threshold = slow_query_threshold
+        self.aggregator = parallel.PartitionedAggregator(db_uri, parallel_workers)
+        self.coalescer = coalescing.QueryCoalescer(query_limits)
+
+    def _summaries_ready(self):
+        """
+        Check that the summary tables include every flight, without waiting
+        for a refresh. When they are behind, a refresh is started in the
+        background and False is returned, in which case the caller should
+        query the flights table directly until it has finished.
         """
-        self.engine = create_engine(db_uri)
+        if self.summaries is None:
+            return False
+        try:
+            with self.engine.connect() as connection:
+                if self.summaries.is_current(connection):
+                    return True
+        except SQLAlchemyError as e:
+            logger.warning("Could not check summaries: %s: %s", e.__class__.__name__, e)
+            return False
+        self.summaries.refresh_in_background()
+        return False
 
-    def _execute_query(self, query, params=None):
+    def _execute_query(self, query, params=None, result_format='records'):
         """
         Execute an SQL query with the params provided in a dictionary,
-        and return a list of records (dictionary-like objects).
-        If an exception is raised, print the error, and return an empty list.
-        """
+        and return the result in result_format (see materialize()), by default
+        a list of records (dictionaries).
+        The wall time, row count and connection checkout wait are recorded
+        in the metrics (see instrumentation.py) under the calling method's name.
+        If an exception is raised, log the error, and return an empty result.
+        """
+        name = instrumentation.caller_name()
+        started = time.perf_counter()
         try:
             with self.engine.connect() as connection:
+                connected = time.perf_counter()
                 result = connection.execute(text(query), params)
+                results = materialize(result, result_format)
+                duration = time.perf_counter() - started
+                if duration > self.slow_query_threshold:
+                    self._log_slow_query(connection, name, query, params, duration)
+        except SQLAlchemyError as e:
+            logger.error("An error occurred in %s: %s: %s", name, e.__class__.__name__, e)
+            instrumentation.record_error(name)
+            return empty_result(result_format)
+
+        instrumentation.record_query(name, duration, len(results), connected - started)
+        return results
+
+    def _log_slow_query(self, connection, name, query, params, duration):
+        """
+        Log a slow query together with its EXPLAIN QUERY PLAN.
+        """
+        try:
+            plan = [row.detail for row in connection.execute(text("EXPLAIN QUERY PLAN " + query), params)]
+        except SQLAlchemyError:
+            plan = ["(no plan available)"]
+        instrumentation.slow_query_logger.warning(
+            "%s took %.3f s (params %s): %s\nPlan: %s",
+            name, duration, params, " ".join(query.split()), "; ".join(plan),
+        )
+
+    def _stream_query(self, query, params=None, batch_size=STREAM_BATCH_SIZE):
+        """
+        Execute an SQL query on a server-side cursor and return an iterator
+        over the records (dictionaries), fetched in batches of batch_size,
+        so the full result is never held in memory.
+        If an exception is raised, log the error, and stop the iteration.
+        """
+        return self._stream_rows(instrumentation.caller_name(), query, params, batch_size)
 
-                # Convert the result to a list of dictionaries
-                return [dict(row._mapping) for row in result]  # Convert each row to dictionary
+    def _stream_rows(self, name, query, params, batch_size):
+        started = time.perf_counter()
+        rows = 0
+        try:
+            with self.engine.connect() as connection:
+                connected = time.perf_counter()
+                result = connection.execution_options(
+                    stream_results=True, yield_per=batch_size
+                ).execute(text(query), params)
+                for row in result:
+                    rows += 1
+                    yield dict(row._mapping)
         except SQLAlchemyError as e:
-            print(f"An error occurred: {e.__class__.__name__}: {e}")
-            return []
+            logger.error("An error occurred in %s: %s: %s", name, e.__class__.__name__, e)
+            instrumentation.record_error(name)
+            return
+        instrumentation.record_query(name, time.perf_counter() - started, rows, connected - started)
+
+    def get_data_version(self):
+        """
+        Return a stamp that changes whenever the flights table changes:
+        the highest flight ID plus the modification times of the database
+        file and its write-ahead log (if any).
+        """
+        stamp = self._execute_query("SELECT MAX(ID) FROM flights", result_format='tuples')
+        version = [stamp[0][0] if stamp else None]
+        database = sqlite_engine.database_path(self.engine.url)
+        if database:
+            for path in (database, database + '-wal'):
+                try:
+                    version.append(os.stat(path).st_mtime_ns)
+                except OSError:
+                    version.append(None)
+        return tuple(version)
 
+    @coalescing.coalesced('lookup')
     def get_flight_by_id(self, flight_id):
         """
         Retrieves a flight using only the flight ID.
         """
-        query = """
-        SELECT flights.*, 
-               airlines.airline AS AIRLINE,  
-               flights.ID as FLIGHT_ID, 
-               flights.DEPARTURE_DELAY as DELAY,
-               flights.year AS YEAR,        -- Add year to the result
-               flights.month AS MONTH,      -- Add month to the result
-               flights.day AS DAY           -- Add day to the result
-        FROM flights
-        JOIN airlines ON flights.airline = airlines.id
-        WHERE flights.ID = :id
-        """
         params = {'id': flight_id}
-        return self._execute_query(query, params)
+        return self._execute_query(FLIGHT_BY_ID_QUERY, params)
+
+    def get_flights_by_ids(self, flight_ids, chunk_size=ID_CHUNK_SIZE):
+        """
+        Retrieves many flights at once, chunk_size IDs per query.
+        Returns a dictionary mapping each flight ID that was found to its record;
+        IDs that don't exist are left out.
+        """
+        flights = {}
+        for query, params in flights_by_ids_queries(flight_ids, chunk_size):
+            for record in self._execute_query(query, params):
+                flights[record['FLIGHT_ID']] = record
+        return flights
 
-    def get_delayed_flights_by_airline(self, airline_name):
+    @coalescing.coalesced('lookup')
+    def get_delayed_flights_by_airline(self, airline_name, limit=None, after=None):
         """
         Retrieves delayed flights for a given airline name.
+        Pass `limit` to get one page of results and `after` (the last flight ID
+        of the previous page) to continue from where that page stopped.
         """
         params = {'airline': airline_name}
-        query = """
-        SELECT flights.*, airlines.airline, flights.ID as FLIGHT_ID, flights.DEPARTURE_DELAY as DELAY
-        FROM flights
-        JOIN airlines ON flights.airline = airlines.id
-        WHERE airlines.airline = :airline
-        AND flights.DEPARTURE_DELAY IS NOT NULL
-        AND flights.DEPARTURE_DELAY > 0
-        """
+        query, params = keyset_page(DELAYED_FLIGHTS_BY_AIRLINE_QUERY, params, limit, after)
         return self._execute_query(query, params)
 
-    def get_delayed_flights_by_airport(self, airport_code):
+    def iter_delayed_flights_by_airline(self, airline_name, limit=None, after=None):
+        """
+        Like get_delayed_flights_by_airline, but yields the flights one at a time
+        from a server-side cursor instead of building the whole list.
+        """
+        params = {'airline': airline_name}
+        query, params = keyset_page(DELAYED_FLIGHTS_BY_AIRLINE_QUERY, params, limit, after)
+        return self._stream_query(query, params)
+
+    @coalescing.coalesced('lookup')
+    def get_delayed_flights_by_airport(self, airport_code, limit=None, after=None):
         """
         Retrieves delayed flights for a given origin airport IATA code.
+        Pass `limit` to get one page of results and `after` (the last flight ID
+        of the previous page) to continue from where that page stopped.
         """
         params = {'airport': airport_code}
-        query = """
-        SELECT flights.*, airlines.airline, flights.ID as FLIGHT_ID, flights.DEPARTURE_DELAY as DELAY
-        FROM flights
-        JOIN airlines ON flights.airline = airlines.id
-        WHERE flights.ORIGIN_AIRPORT = :airport
-        AND flights.DEPARTURE_DELAY IS NOT NULL
-        AND flights.DEPARTURE_DELAY > 0
-        """
+        query, params = keyset_page(DELAYED_FLIGHTS_BY_AIRPORT_QUERY, params, limit, after)
         return self._execute_query(query, params)
 
+    def iter_delayed_flights_by_airport(self, airport_code, limit=None, after=None):
+        """
+        Like get_delayed_flights_by_airport, but yields the flights one at a time
+        from a server-side cursor instead of building the whole list.
+        """
+        params = {'airport': airport_code}
+        query, params = keyset_page(DELAYED_FLIGHTS_BY_AIRPORT_QUERY, params, limit, after)
+        return self._stream_query(query, params)
+
+    @coalescing.coalesced('range')
     def get_top_5_delays_by_date(self, day, month, year):
         """
         Retrieve the top 5 delayed flights for a specific date.
         """
-        params = {'day': day, 'month': month, 'year': year}
-        query = """
-        SELECT flights.*, 
-                airlines.airline, 
-                flights.ID as FLIGHT_ID, 
-                flights.DEPARTURE_DELAY as DELAY 
-        FROM flights 
-        JOIN airlines ON flights.airline = airlines.id 
-        WHERE flights.year = :year 
-        AND flights.month = :month 
-        AND flights.day = :day
-        AND flights.DEPARTURE_DELAY IS NOT NULL
-        ORDER BY flights.DEPARTURE_DELAY DESC 
-        LIMIT 5
-        """
-        return self._execute_query(query, params)
+        params = {**date_range_params((year, month, day), (year, month, day)), 'k': 5}
+        if self._summaries_ready():
+            results = self._execute_query(summaries.TOP_DELAYS_BY_DATE_RANGE_QUERY, params)
+            if len(results) < params['k']:
+                results = self._execute_query(summaries.JOINED_TOP_DELAYS_BY_DATE_RANGE_QUERY, params)
+            return results
+        return self._execute_query(TOP_DELAYS_BY_DATE_RANGE_QUERY, params)
+
+    @coalescing.coalesced('range')
+    def get_top_delays_by_date_range(self, start, end, k=5):
+        """
+        Retrieve the k most delayed flights between the dates start and end, inclusive.
+        With summaries and k up to summaries.TOP_DELAYS_MAX_K, they are merged
+        from the daily top delays instead of sorting the flights of the range.
+        """
+        params = {**date_range_params((start.year, start.month, start.day), (end.year, end.month, end.day)), 'k': k}
+        if k <= summaries.TOP_DELAYS_MAX_K and self._summaries_ready():
+            results = self._execute_query(summaries.TOP_DELAYS_BY_DATE_RANGE_QUERY, params)
+            if len(results) < k:
+                # Some candidates lost their flight or airline (or there are
+                # fewer than k): join them all before the limit instead
+                results = self._execute_query(summaries.JOINED_TOP_DELAYS_BY_DATE_RANGE_QUERY, params)
+            return results
+        return self._execute_query(TOP_DELAYS_BY_DATE_RANGE_QUERY, params)
+
+    @coalescing.coalesced('range')
+    def get_delay_rollup(self, start, end, bucket='day', group_by=None):
+        """
+        Fetch the number of flights, percentage of delayed flights and average delay
+        (ignoring negative delays) per day, week or month (bucket) between the dates
+        start and end, inclusive, optionally per 'airline' or 'origin' (group_by).
+        With summaries, they are read from the daily rollups instead of the flights.
+        """
+        check_rollup_args(bucket, group_by)
+        params = date_range_params((start.year, start.month, start.day), (end.year, end.month, end.day))
+        if self._summaries_ready():
+            return self._execute_query(summaries.rollup_query(bucket, group_by), params)
+        return self._execute_query(rollup_query(bucket, group_by), params)
 
-    def get_top_10_busiest_airlines(self):
+    @coalescing.coalesced('range')
+    def get_delay_percentiles(self, start, end, group_by=None, percentiles=sketches.DEFAULT_PERCENTILES):
+        """
+        Estimate the delay percentiles (within sketches.RELATIVE_ACCURACY of the
+        exact ones) between the dates start and end, inclusive, overall or per
+        'airline' or 'origin' (group_by). percentiles must be a tuple.
+        With summaries, they are merged from the daily delay sketches instead
+        of reading the delays of every flight in the range.
+        """
+        sketches.check_sketch_args(group_by, percentiles)
+        params = date_range_params((start.year, start.month, start.day), (end.year, end.month, end.day))
+        if self._summaries_ready():
+            rows = self._execute_query(sketches.percentile_query(group_by), params)
+        else:
+            rows = sketches.bucket_delays(self._execute_query(delay_histogram_query(group_by), params))
+        return sketches.delay_percentiles(rows, sketches.GROUP_COLUMNS[group_by], percentiles)
+
+    @coalescing.coalesced('range')
+    def get_distinct_routes(self, start, end, group_by=None):
+        """
+        Estimate the number of distinct routes flown between the dates start and
+        end, inclusive, overall or per 'airline' or 'origin' (group_by), with a
+        HyperLogLog (see sketches.py). With summaries, it is merged from the
+        daily route sketches.
+        """
+        sketches.check_sketch_args(group_by)
+        params = date_range_params((start.year, start.month, start.day), (end.year, end.month, end.day))
+        if self._summaries_ready():
+            rows = self._execute_query(sketches.distinct_routes_query(group_by), params)
+        else:
+            rows = sketches.register_routes(self._execute_query(routes_flown_query(group_by), params))
+        return sketches.distinct_routes(rows, sketches.GROUP_COLUMNS[group_by])
+
+    @coalescing.coalesced('aggregate')
+    def get_top_10_busiest_airlines(self, parallel=False):
         """
         Returns the top 10 busiest airlines based on flight counts.
         """
-        query = """
-        SELECT airlines.airline AS airline, COUNT(*) AS flight_count
-        FROM flights
-        JOIN airlines ON flights.airline = airlines.id
-        GROUP BY airlines.airline
-        ORDER BY flight_count DESC
-        LIMIT 10
-        """
-        return self._execute_query(query)
+        if parallel:
+            return self.aggregator.top_10_busiest_airlines(self.engine)
+        if self._summaries_ready():
+            return self._execute_query(summaries.TOP_10_BUSIEST_AIRLINES_QUERY)
+        return self._execute_query(TOP_10_BUSIEST_AIRLINES_QUERY)
 
-    def get_average_delay_per_airline(self):
+    @coalescing.coalesced('aggregate')
+    def get_average_delay_per_airline(self, parallel=False):
         """
         Fetch the average delay per airline, ignoring negative delays.
         """
-        query = """
-        SELECT 
-            airlines.airline AS AIRLINE,
-            AVG(CASE 
-                    WHEN flights.DEPARTURE_DELAY >= 0 THEN flights.DEPARTURE_DELAY 
-                    ELSE NULL 
-                END) AS average_delay 
-        FROM 
-            flights 
-        JOIN airlines ON flights.airline = airlines.id
-        WHERE
-            flights.DEPARTURE_DELAY IS NOT NULL  -- Ignore NULL delays
-        GROUP BY 
-            airlines.airline 
-        ORDER BY 
-            average_delay DESC;
-        """
-        return self._execute_query(query)
-
-    def get_percentage_delayed_flights_per_airline(self):
+        if parallel:
+            return self.aggregator.average_delay_per_airline(self.engine)
+        if self._summaries_ready():
+            return self._execute_query(summaries.AVERAGE_DELAY_PER_AIRLINE_QUERY)
+        return self._execute_query(AVERAGE_DELAY_PER_AIRLINE_QUERY)
+
+    @coalescing.coalesced('aggregate')
+    def get_percentage_delayed_flights_per_airline(self, parallel=False):
         """
         Fetch the percentage of delayed flights per airline.
         """
-        query = """
-        SELECT 
-            airlines.airline AS AIRLINE,
-            COUNT(*) AS total_flights,
-            SUM(CASE WHEN flights.DEPARTURE_DELAY > 0 THEN 1 ELSE 0 END) AS delayed_flights
-        FROM 
-            flights 
-        JOIN airlines ON flights.airline = airlines.id
-        GROUP BY 
-            airlines.airline;
-        """
-        results = self._execute_query(query)
-
-        # Convert the results to a DataFrame for easier manipulation
-        df = pd.DataFrame(results)
-
-        # Calculate percentage delays
-        df['percentage_delays'] = (df['delayed_flights'] / df['total_flights'] * 100).fillna(0)
+        if parallel:
+            results = self.aggregator.percentage_delayed_per_airline(self.engine)
+        elif self._summaries_ready():
+            results = self._execute_query(summaries.PERCENTAGE_DELAYED_PER_AIRLINE_QUERY, result_format='dataframe')
+        else:
+            results = self._execute_query(PERCENTAGE_DELAYED_PER_AIRLINE_QUERY, result_format='dataframe')
+        return percentage_delays_per_airline(results)
 
-        return df[['AIRLINE', 'percentage_delays']]  # Return only the relevant columns
-
-    def get_average_delay_per_origin(self):
+    @coalescing.coalesced('aggregate')
+    def get_average_delay_per_origin(self, parallel=False):
         """
         Fetch the average delay per origin airport, ignoring negative delays.
         """
-        query = """
-        SELECT 
-            flights.ORIGIN_AIRPORT AS origin_airport,
-            AVG(CASE 
-                    WHEN flights.DEPARTURE_DELAY >= 0 THEN flights.DEPARTURE_DELAY 
-                    ELSE NULL 
-                END) AS average_delay 
-        FROM 
-            flights 
-        WHERE
-            flights.DEPARTURE_DELAY IS NOT NULL  -- Ensure there are no NULL values
-        GROUP BY 
-            flights.ORIGIN_AIRPORT 
-        ORDER BY 
-            average_delay DESC;
-        """
-        return self._execute_query(query)
-
-    def get_percentage_delayed_flights_per_hour(self):
+        if parallel:
+            return self.aggregator.average_delay_per_origin(self.engine)
+        if self._summaries_ready():
+            return self._execute_query(summaries.AVERAGE_DELAY_PER_ORIGIN_QUERY)
+        return self._execute_query(AVERAGE_DELAY_PER_ORIGIN_QUERY)
+
+    @coalescing.coalesced('aggregate')
+    def get_percentage_delayed_flights_per_hour(self, parallel=False):
         """
         Fetch the percentage of delayed flights per hour of the day.
         """
-        query = """
-        SELECT 
-            strftime('%H', flights.SCHEDULED_DEPARTURE) AS hour,  -- Extract hour from SCHEDULED_DEPARTURE
-            COUNT(*) AS total_flights,
-            SUM(CASE WHEN flights.DEPARTURE_DELAY > 0 THEN 1 ELSE 0 END) AS delayed_flights
-        FROM 
-            flights 
-        GROUP BY 
-            hour;
-        """
-        results = self._execute_query(query)
+        if parallel:
+            results = self.aggregator.percentage_delayed_per_hour(self.engine)
+        elif self._summaries_ready():
+            results = self._execute_query(summaries.PERCENTAGE_DELAYED_PER_HOUR_QUERY, result_format='dataframe')
+        else:
+            results = self._execute_query(PERCENTAGE_DELAYED_PER_HOUR_QUERY, result_format='dataframe')
+        return percentage_delays_per_hour(results)
 
-        # Convert the results to a DataFrame for easier manipulation
-        df = pd.DataFrame(results)
+    @coalescing.coalesced('aggregate')
+    def get_percentage_delayed_flights_per_route(self, parallel=False):
+        """
+        Fetch the percentage of delayed flights per origin -> destination route.
+        """
+        if parallel:
+            import pandas as pd
+            results = pd.DataFrame(self.aggregator.percentage_delayed_per_route(self.engine),
+                                   columns=['ORIGIN_AIRPORT', 'DESTINATION_AIRPORT', 'delay_percentage'])
+        elif self._summaries_ready():
+            results = self._execute_query(summaries.PERCENTAGE_DELAYED_PER_ROUTE_QUERY, result_format='dataframe')
+        else:
+            results = self._execute_query(PERCENTAGE_DELAYED_PER_ROUTE_QUERY, result_format='dataframe')
+        return results
 
-        # Calculate percentage delays
-        df['delay_percentage'] = (df['delayed_flights'] / df['total_flights'] * 100).fillna(0)
+    @coalescing.coalesced('aggregate')
+    def get_route_matrix(self, top_airports=None, min_flights=1, result_format='records'):
+        """
+        Fetch the flight count and percentage of delayed flights of the routes
+        between the top_airports busiest airports (all airports if None) that have
+        at least min_flights flights. See sparse_route_matrix() for a compact form.
+        """
+        params = {'top_airports': -1 if top_airports is None else top_airports,
+                  'min_flights': min_flights}
+        if self._summaries_ready():
+            return self._execute_query(summaries.ROUTE_MATRIX_QUERY, params, result_format)
+        return self._execute_query(ROUTE_MATRIX_QUERY, params, result_format)
 
-        # Rename columns to match expected format if necessary
-        df.rename(columns={'hour': 'HOUR'}, inplace=True)  # Rename 'hour' to 'HOUR'
-
-        return df[['HOUR', 'delay_percentage']]  # Return only the relevant columns
-
-    def get_percentage_delayed_flights_per_route(self):
-        query = """
-        SELECT 
-            ORIGIN_AIRPORT,
-            DESTINATION_AIRPORT,
-            AVG(CASE WHEN DELAY > 0 THEN 1 ELSE 0 END) * 100 AS delay_percentage
-        FROM 
-            flights
-        GROUP BY 
-            ORIGIN_AIRPORT, DESTINATION_AIRPORT
+    @coalescing.coalesced('aggregate')
+    def get_percentage_delayed_flights_for_map(self):
+        """
+        Fetch the number of flights, average delay and percentage of delayed flights
+        per route, with the longitude and latitude of both airports, as a DataFrame.
+        Needs the airports table (see airports.py).
         """
-        result = pd.read_sql(query, self.engine)
-        return result
+        if self._summaries_ready():
+            return self._execute_query(summaries.ROUTES_FOR_MAP_QUERY, result_format='dataframe')
+        return self._execute_query(ROUTES_FOR_MAP_QUERY, result_format='dataframe')
 
     def __del__(self):
         """
         Closes the connection to the database when the object is about to be destroyed.
         """
         self.engine.dispose()
+        self.aggregator.close()
@@ -0,0 +1,111 @@
+import gzip
+import json
+from flask.json.provider import DefaultJSONProvider
+
+# Optional dependencies: orjson serializes several times faster than json, and
+# zstandard adds zstd to the encodings offered to clients (gzip is always there)
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Record fields that repeat another field of the same record under an alias
+# (flights.ID AS FLIGHT_ID, flights.DEPARTURE_DELAY AS DELAY in data.py):
+# encoded records keep only the alias
+ALIASED_COLUMNS = {'ID': 'FLIGHT_ID', 'DEPARTURE_DELAY': 'DELAY'}
+
+# Bodies smaller than this are sent uncompressed, since compressing them saves
+# less than it costs
+COMPRESS_MIN_BYTES = 1024
+COMPRESSIBLE_MIMETYPES = ('application/json', 'application/x-ndjson', 'text/plain')
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+
+def dumps(obj):
+    """
+    Serialize obj to compact JSON bytes, with orjson if it is installed.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, separators=(',', ':')).encode()
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """
+    JSON provider for the Flask and Quart apps (app.json = FastJSONProvider(app)):
+    jsonify() serializes with orjson when it is installed.
+    """
+
+    def dumps(self, obj, **kwargs):
+        if orjson is None or kwargs:
+            return super().dumps(obj, **kwargs)
+        return dumps(obj).decode()
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(dumps(obj), mimetype=self.mimetype)
+
+
+def record_columns(record):
+    """
+    The fields of a record that encoded records keep: all but the ones repeated under an alias.
+    """
+    return [column for column in record if ALIASED_COLUMNS.get(column) not in record]
+
+
+def encode_records(records, columns=False):
+    """
+    Prepare a list of records (all with the same fields, as a query returns
+    them) for a JSON response: without the aliased fields, and with columns,
+    as one list of values per field instead of one object per record.
+    The records themselves are not modified, since they may be shared.
+    """
+    if not records:
+        return {} if columns else []
+    keys = record_columns(records[0])
+    if columns:
+        return {key: [record[key] for record in records] for key in keys}
+    if len(keys) == len(records[0]):
+        return records
+    return [{key: record[key] for key in keys} for record in records]
+
+
+def negotiate(accept_encodings):
+    """
+    The content encoding to compress a response with: the best of zstd (if
+    zstandard is installed) and gzip the client accepts, or None.
+    """
+    offered = ['zstd', 'gzip'] if zstandard is not None else ['gzip']
+    return accept_encodings.best_match(offered)
+
+
+def should_compress(response):
+    """
+    True if a response has a body that is worth compressing and isn't already encoded.
+    """
+    return (response.status_code == 200
+            and response.mimetype in COMPRESSIBLE_MIMETYPES
+            and 'Content-Encoding' not in response.headers)
+
+
+def compress(body, content_encoding):
+    if content_encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(body)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL)
+
+
+def set_compressed_body(response, body, content_encoding):
+    """
+    Replace a response's body with its compressed version. The ETag becomes
+    weak, as the bytes differ from the uncompressed body's.
+    """
+    response.set_data(compress(body, content_encoding))
+    response.headers['Content-Encoding'] = content_encoding
+    etag, _ = response.get_etag()
+    if etag:
+        response.set_etag(etag, weak=True)
@@ -1,15 +1,130 @@
-from flask import Flask, jsonify, request
-from datetime import datetime
+from flask import Flask, Response, g, jsonify, request, send_file, stream_with_context
+import os
+import time
+import api_args
+import cache
+import charts
+import coalescing
 import data
+import encoding
+import indexes
+import instrumentation
+import shards
+import sketches
+import summaries
 
 # Initialize Flask app
 app = Flask(__name__)
+app.json = encoding.FastJSONProvider(app)
 
-# Database URI
-SQLITE_URI = 'sqlite:////Users/masterschool/Documents/Masterschool_projects_2024/Database_SE106/sky_SQL_codio_project/flights.sqlite3'
+# Database URI, overridable with the FLIGHTS_DB_URI environment variable
+SQLITE_URI = os.environ.get(
+    'FLIGHTS_DB_URI',
+    'sqlite:////Users/masterschool/Documents/Masterschool_projects_2024/Database_SE106/sky_SQL_codio_project/flights.sqlite3'
+)
+
+# Directory of a sharded database (see shards.py), served instead of SQLITE_URI when set
+SHARD_DIR = os.environ.get('FLIGHTS_SHARD_DIR')
 
 # Initialize data manager (assuming 'data.FlightData' is your data manager class)
-data_manager = data.FlightData(SQLITE_URI)
+if SHARD_DIR:
+    data_manager = shards.ShardedFlightData(SHARD_DIR, use_summaries=True)
+else:
+    data_manager = data.FlightData(SQLITE_URI, use_summaries=True)
+    indexes.setup_schema(data_manager)
+
+# Cache of the aggregate responses, invalidated when the flights table changes
+response_cache = cache.ResponseCache(data_manager.get_data_version, max_entries=256)
+
+# Charts rendered on worker processes and cached as image files (see charts.py)
+chart_renderer = charts.ChartRenderer()
+
+# Seconds each cached endpoint's response stays fresh
+CACHE_TTLS = {
+    'average_delay_by_airline': 300,
+    'average_delay_by_origin': 300,
+    'top_busiest_airlines': 600,
+    'route_matrix': 600,
+    'delay_rollup': 300,
+    'delay_percentiles': 300,
+    'distinct_routes': 300,
+}
+
+
+@app.before_request
+def start_request_timing():
+    g.request_started = time.perf_counter()
+    # Clients can ask for a timing breakdown in the Server-Timing response header
+    if request.headers.get('X-Profile'):
+        instrumentation.start_profile()
+
+
+@app.after_request
+def record_request_metrics(response):
+    endpoint = request.endpoint or 'unknown'
+    instrumentation.REQUEST_DURATION.observe(endpoint, time.perf_counter() - g.request_started)
+    if not response.is_streamed:
+        instrumentation.RESPONSE_BYTES.observe(endpoint, response.calculate_content_length() or 0)
+    server_timing = instrumentation.finish_profile()
+    if server_timing:
+        response.headers['Server-Timing'] = server_timing
+    return response
+
+
+@app.after_request
+def compress_response(response):
+    # Registered after record_request_metrics, so it runs first and the
+    # metrics see the compressed size (see encoding.py for the encodings)
+    if response.is_streamed or response.direct_passthrough or not encoding.should_compress(response):
+        return response
+    response.vary.add('Accept-Encoding')
+    body = response.get_data()
+    content_encoding = encoding.negotiate(request.accept_encodings)
+    if content_encoding and len(body) >= encoding.COMPRESS_MIN_BYTES:
+        encoding.set_compressed_body(response, body, content_encoding)
+    return response
+
+
+def records_response(results):
+    """
+    JSON response for a list of records (see api_args.encode_results).
+    """
+    return jsonify(api_args.encode_results(results, request.args))
+
+
+def delayed_flights_response(get_flights, iter_flights, key):
+    """
+    Build the response for a delayed-flights endpoint.
+    With ?format=ndjson the flights are streamed one JSON object per line
+    straight from a server-side cursor; otherwise a JSON list is returned.
+    When a page is full, the X-Next-After header holds the cursor for the next page.
+    """
+    limit, after, error = api_args.pagination_args(request.args)
+    if error:
+        return jsonify({"error": error}), 400
+
+    if request.args.get('format') == 'ndjson':
+        def generate():
+            columns = None
+            for flight in iter_flights(key, limit=limit, after=after):
+                if columns is None:
+                    columns = encoding.record_columns(flight)
+                yield encoding.dumps({column: flight[column] for column in columns}) + b"\n"
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+    results = get_flights(key, limit=limit, after=after)
+    response = records_response(results)
+    if limit is not None and len(results) == limit:
+        response.headers['X-Next-After'] = str(results[-1]['FLIGHT_ID'])
+    return response
+
+@app.errorhandler(coalescing.QueryOverloaded)
+def query_overloaded(e):
+    # The query's class is at its concurrency limit (see coalescing.py)
+    response = jsonify({"error": str(e)})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(api_args.OVERLOADED_RETRY_AFTER)
+    return response
 
 @app.route('/')
 def home():
@@ -22,8 +137,8 @@ def delayed_flights_by_airline():
     if not airline:
         return jsonify({"error": "Airline parameter is required."}), 400
 
-    results = data_manager.get_delayed_flights_by_airline(airline)
-    return jsonify(results)
+    return delayed_flights_response(data_manager.get_delayed_flights_by_airline,
+                                    data_manager.iter_delayed_flights_by_airline, airline)
 
 # Endpoint: Get delayed flights by airport
 @app.route('/flights/delayed_by_airport', methods=['GET'])
@@ -32,8 +147,8 @@ def delayed_flights_by_airport():
     if not airport or len(airport) != 3:
         return jsonify({"error": "Valid IATA airport code is required."}), 400
 
-    results = data_manager.get_delayed_flights_by_airport(airport)
-    return jsonify(results)
+    return delayed_flights_response(data_manager.get_delayed_flights_by_airport,
+                                    data_manager.iter_delayed_flights_by_airport, airport)
 
 # Endpoint: Get flight by ID
 @app.route('/flights/<int:flight_id>', methods=['GET'])
@@ -41,39 +156,153 @@ def flight_by_id(flight_id):
     result = data_manager.get_flight_by_id(flight_id)
     if not result:
         return jsonify({"error": "Flight not found."}), 404
-    return jsonify(result)
+    return records_response(result)
+
+# Endpoint: Get many flights by ID in one request
+@app.route('/flights/batch', methods=['POST'])
+def flights_by_ids():
+    flight_ids, error = api_args.batch_ids(request.get_json(silent=True))
+    if error:
+        return jsonify({"error": error}), 400
+
+    flights = data_manager.get_flights_by_ids(flight_ids)
+    return jsonify(api_args.batch_body(flight_ids, flights))
 
 # Endpoint: Get top 5 delayed flights by date
 @app.route('/flights/delayed_by_date', methods=['GET'])
 def flights_by_date():
-    date_input = request.args.get('date')
+    start, end, error = api_args.date_range_args(request.args)
+    if error:
+        return jsonify({"error": error}), 400
     try:
-        date = datetime.strptime(date_input, '%d/%m/%Y')
-    except (ValueError, TypeError):
-        return jsonify({"error": "Invalid date format. Use DD/MM/YYYY."}), 400
+        k = int(request.args.get('k', 5))
+    except ValueError:
+        return jsonify({"error": "k must be an integer."}), 400
+    if not 0 < k <= summaries.TOP_DELAYS_MAX_K:
+        return jsonify({"error": f"k must be between 1 and {summaries.TOP_DELAYS_MAX_K}."}), 400
 
-    results = data_manager.get_top_5_delays_by_date(date.day, date.month, date.year)
+    results = data_manager.get_top_delays_by_date_range(start, end, k)
     if not results:
         return jsonify({"message": "No delayed flights found for this date."}), 404
-    return jsonify(results)
+    return records_response(results)
+
+# Endpoint: Get delay metrics per day, week or month of a date range
+@app.route('/flights/delay_rollup', methods=['GET'])
+@response_cache.cached(ttl=CACHE_TTLS['delay_rollup'])
+def delay_rollup():
+    start, end, error = api_args.date_range_args(request.args)
+    if error:
+        return jsonify({"error": error}), 400
+    bucket = request.args.get('bucket', 'day')
+    group_by = request.args.get('group_by')
+    try:
+        data.check_rollup_args(bucket, group_by)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    return records_response(data_manager.get_delay_rollup(start, end, bucket, group_by))
+
+# Endpoint: Get delay percentiles of a date range, overall or per airline or origin airport
+@app.route('/flights/delay_percentiles', methods=['GET'])
+@response_cache.cached(ttl=CACHE_TTLS['delay_percentiles'])
+def delay_percentiles():
+    start, end, error = api_args.date_range_args(request.args)
+    if error:
+        return jsonify({"error": error}), 400
+    group_by = request.args.get('group_by')
+    try:
+        percentiles = (tuple(float(p) for p in request.args['percentiles'].split(','))
+                       if 'percentiles' in request.args else sketches.DEFAULT_PERCENTILES)
+    except ValueError:
+        return jsonify({"error": "percentiles must be a comma-separated list of numbers."}), 400
+    try:
+        sketches.check_sketch_args(group_by, percentiles)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    return records_response(data_manager.get_delay_percentiles(start, end, group_by, percentiles))
+
+# Endpoint: Get the number of distinct routes flown in a date range, overall or per airline or origin airport
+@app.route('/flights/distinct_routes', methods=['GET'])
+@response_cache.cached(ttl=CACHE_TTLS['distinct_routes'])
+def distinct_routes():
+    start, end, error = api_args.date_range_args(request.args)
+    if error:
+        return jsonify({"error": error}), 400
+    group_by = request.args.get('group_by')
+    try:
+        sketches.check_sketch_args(group_by)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    return records_response(data_manager.get_distinct_routes(start, end, group_by))
 
 # Endpoint: Get average delay per airline
 @app.route('/flights/average_delay_by_airline', methods=['GET'])
+@response_cache.cached(ttl=CACHE_TTLS['average_delay_by_airline'])
 def average_delay_per_airline():
     results = data_manager.get_average_delay_per_airline()
-    return jsonify(results)
+    return records_response(results)
 
 # Endpoint: Get average delay per origin airport
 @app.route('/flights/average_delay_by_origin', methods=['GET'])
+@response_cache.cached(ttl=CACHE_TTLS['average_delay_by_origin'])
 def average_delay_per_origin():
     results = data_manager.get_average_delay_per_origin()
-    return jsonify(results)
+    return records_response(results)
 
 # Endpoint: Get top 10 busiest airlines
 @app.route('/flights/top_busiest_airlines', methods=['GET'])
+@response_cache.cached(ttl=CACHE_TTLS['top_busiest_airlines'])
 def top_10_busiest_airlines():
     results = data_manager.get_top_10_busiest_airlines()
-    return jsonify(results)
+    return records_response(results)
+
+# Endpoint: Get the delay percentage of the routes between the busiest airports,
+# as a sparse matrix (see data.sparse_route_matrix)
+@app.route('/flights/route_matrix', methods=['GET'])
+@response_cache.cached(ttl=CACHE_TTLS['route_matrix'])
+def route_matrix():
+    try:
+        top = int(request.args['top']) if 'top' in request.args else None
+        min_flights = int(request.args.get('min_flights', 1))
+    except ValueError:
+        return jsonify({"error": "top and min_flights must be integers."}), 400
+    if (top is not None and top < 1) or min_flights < 1:
+        return jsonify({"error": "top and min_flights must be positive."}), 400
+
+    routes = data_manager.get_route_matrix(top_airports=top, min_flights=min_flights)
+    return jsonify(data.sparse_route_matrix(routes))
+
+# Endpoint: Get a chart as a PNG or SVG image, e.g. /charts/percentage_delay_per_hour.png
+@app.route('/charts/<chart>.<image_format>', methods=['GET'])
+def chart_image(chart, image_format):
+    if chart not in charts.CHARTS:
+        return jsonify({"error": f"Unknown chart. Available charts: {', '.join(charts.CHARTS)}."}), 404
+    if image_format not in charts.CHART_FORMATS:
+        return jsonify({"error": f"Unknown image format. Use one of: {', '.join(charts.CHART_FORMATS)}."}), 400
+    try:
+        params = {name: int(request.args[name])
+                  for name in charts.CHARTS[chart]['params'] if name in request.args}
+    except ValueError:
+        return jsonify({"error": "Chart parameters must be integers."}), 400
+    if any(value < 1 for value in params.values()):
+        return jsonify({"error": "Chart parameters must be positive."}), 400
+
+    path = chart_renderer.render(data_manager, chart, image_format, **params)
+    if path is None:
+        return jsonify({"message": "No data available to generate the chart."}), 404
+    return send_file(path, mimetype=charts.CHART_FORMATS[image_format])
+
+# Endpoint: Get response cache statistics
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    return jsonify(response_cache.get_stats())
+
+# Endpoint: Get query and request metrics in the Prometheus text format
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(instrumentation.render_metrics(), content_type='text/plain; version=0.0.4')
 
 # Run the Flask app
 if __name__ == '__main__':
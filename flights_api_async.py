@@ -0,0 +1,235 @@
+from quart import Quart, jsonify, request
+from quart.wrappers.response import DataBody
+import asyncio
+import os
+import api_args
+import async_data
+import coalescing
+import data
+import encoding
+import indexes
+import sketches
+import summaries
+
+# The same endpoints as flights_api.py, served by an ASGI app whose views are
+# coroutines: while SQLite runs one query, the event loop serves other requests.
+# Run with an ASGI server, e.g. `hypercorn flights_api_async:app`.
+app = Quart(__name__)
+app.json = encoding.FastJSONProvider(app)
+
+# Database URI, overridable with the FLIGHTS_DB_URI environment variable
+SQLITE_URI = os.environ.get(
+    'FLIGHTS_DB_URI',
+    'sqlite:////Users/masterschool/Documents/Masterschool_projects_2024/Database_SE106/sky_SQL_codio_project/flights.sqlite3'
+)
+
+data_manager = None
+
+
+@app.before_serving
+async def open_data_manager():
+    global data_manager
+    # The indexes and summaries are set up with a synchronous FlightData, on a
+    # thread, before the first request (see indexes.setup_schema)
+    await asyncio.to_thread(indexes.setup_schema, data.FlightData(SQLITE_URI, use_summaries=True))
+    data_manager = async_data.AsyncFlightData(SQLITE_URI, use_summaries=True)
+
+
+@app.after_serving
+async def close_data_manager():
+    await data_manager.close()
+
+
+@app.after_request
+async def compress_response(response):
+    # Streamed responses (NDJSON) are sent as they are (see encoding.py for the encodings)
+    if not isinstance(response.response, DataBody) or not encoding.should_compress(response):
+        return response
+    response.vary.add('Accept-Encoding')
+    body = await response.get_data()
+    content_encoding = encoding.negotiate(request.accept_encodings)
+    if content_encoding and len(body) >= encoding.COMPRESS_MIN_BYTES:
+        encoding.set_compressed_body(response, body, content_encoding)
+    return response
+
+
+def records_response(results):
+    """
+    JSON response for a list of records (see api_args.encode_results).
+    """
+    return jsonify(api_args.encode_results(results, request.args))
+
+
+async def delayed_flights_response(get_flights, iter_flights, key):
+    """
+    Build the response for a delayed-flights endpoint (see flights_api.delayed_flights_response).
+    """
+    limit, after, error = api_args.pagination_args(request.args)
+    if error:
+        return jsonify({"error": error}), 400
+
+    if request.args.get('format') == 'ndjson':
+        async def generate():
+            columns = None
+            async for flight in iter_flights(key, limit=limit, after=after):
+                if columns is None:
+                    columns = encoding.record_columns(flight)
+                yield encoding.dumps({column: flight[column] for column in columns}) + b"\n"
+        return generate(), 200, {'Content-Type': 'application/x-ndjson'}
+
+    results = await get_flights(key, limit=limit, after=after)
+    response = records_response(results)
+    if limit is not None and len(results) == limit:
+        response.headers['X-Next-After'] = str(results[-1]['FLIGHT_ID'])
+    return response
+
+
+@app.errorhandler(coalescing.QueryOverloaded)
+async def query_overloaded(e):
+    # The query's class is at its concurrency limit (see coalescing.py)
+    response = jsonify({"error": str(e)})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(api_args.OVERLOADED_RETRY_AFTER)
+    return response
+
+@app.route('/')
+async def home():
+    return "Welcome to the Flight API!"
+
+# Endpoint: Get delayed flights by airline
+@app.route('/flights/delayed_by_airline', methods=['GET'])
+async def delayed_flights_by_airline():
+    airline = request.args.get('airline')
+    if not airline:
+        return jsonify({"error": "Airline parameter is required."}), 400
+
+    return await delayed_flights_response(data_manager.get_delayed_flights_by_airline,
+                                          data_manager.iter_delayed_flights_by_airline, airline)
+
+# Endpoint: Get delayed flights by airport
+@app.route('/flights/delayed_by_airport', methods=['GET'])
+async def delayed_flights_by_airport():
+    airport = request.args.get('airport')
+    if not airport or len(airport) != 3:
+        return jsonify({"error": "Valid IATA airport code is required."}), 400
+
+    return await delayed_flights_response(data_manager.get_delayed_flights_by_airport,
+                                          data_manager.iter_delayed_flights_by_airport, airport)
+
+# Endpoint: Get flight by ID
+@app.route('/flights/<int:flight_id>', methods=['GET'])
+async def flight_by_id(flight_id):
+    result = await data_manager.get_flight_by_id(flight_id)
+    if not result:
+        return jsonify({"error": "Flight not found."}), 404
+    return records_response(result)
+
+# Endpoint: Get many flights by ID in one request
+@app.route('/flights/batch', methods=['POST'])
+async def flights_by_ids():
+    flight_ids, error = api_args.batch_ids(await request.get_json(silent=True))
+    if error:
+        return jsonify({"error": error}), 400
+
+    flights = await data_manager.get_flights_by_ids(flight_ids)
+    return jsonify(api_args.batch_body(flight_ids, flights))
+
+# Endpoint: Get top 5 delayed flights by date
+@app.route('/flights/delayed_by_date', methods=['GET'])
+async def flights_by_date():
+    start, end, error = api_args.date_range_args(request.args)
+    if error:
+        return jsonify({"error": error}), 400
+    try:
+        k = int(request.args.get('k', 5))
+    except ValueError:
+        return jsonify({"error": "k must be an integer."}), 400
+    if not 0 < k <= summaries.TOP_DELAYS_MAX_K:
+        return jsonify({"error": f"k must be between 1 and {summaries.TOP_DELAYS_MAX_K}."}), 400
+
+    results = await data_manager.get_top_delays_by_date_range(start, end, k)
+    if not results:
+        return jsonify({"message": "No delayed flights found for this date."}), 404
+    return records_response(results)
+
+# Endpoint: Get delay metrics per day, week or month of a date range
+@app.route('/flights/delay_rollup', methods=['GET'])
+async def delay_rollup():
+    start, end, error = api_args.date_range_args(request.args)
+    if error:
+        return jsonify({"error": error}), 400
+    bucket = request.args.get('bucket', 'day')
+    group_by = request.args.get('group_by')
+    try:
+        data.check_rollup_args(bucket, group_by)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    return records_response(await data_manager.get_delay_rollup(start, end, bucket, group_by))
+
+# Endpoint: Get delay percentiles of a date range, overall or per airline or origin airport
+@app.route('/flights/delay_percentiles', methods=['GET'])
+async def delay_percentiles():
+    start, end, error = api_args.date_range_args(request.args)
+    if error:
+        return jsonify({"error": error}), 400
+    group_by = request.args.get('group_by')
+    try:
+        percentiles = (tuple(float(p) for p in request.args['percentiles'].split(','))
+                       if 'percentiles' in request.args else sketches.DEFAULT_PERCENTILES)
+    except ValueError:
+        return jsonify({"error": "percentiles must be a comma-separated list of numbers."}), 400
+    try:
+        sketches.check_sketch_args(group_by, percentiles)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    return records_response(await data_manager.get_delay_percentiles(start, end, group_by, percentiles))
+
+# Endpoint: Get the number of distinct routes flown in a date range, overall or per airline or origin airport
+@app.route('/flights/distinct_routes', methods=['GET'])
+async def distinct_routes():
+    start, end, error = api_args.date_range_args(request.args)
+    if error:
+        return jsonify({"error": error}), 400
+    group_by = request.args.get('group_by')
+    try:
+        sketches.check_sketch_args(group_by)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    return records_response(await data_manager.get_distinct_routes(start, end, group_by))
+
+# Endpoint: Get average delay per airline
+@app.route('/flights/average_delay_by_airline', methods=['GET'])
+async def average_delay_per_airline():
+    return records_response(await data_manager.get_average_delay_per_airline())
+
+# Endpoint: Get average delay per origin airport
+@app.route('/flights/average_delay_by_origin', methods=['GET'])
+async def average_delay_per_origin():
+    return records_response(await data_manager.get_average_delay_per_origin())
+
+# Endpoint: Get top 10 busiest airlines
+@app.route('/flights/top_busiest_airlines', methods=['GET'])
+async def top_10_busiest_airlines():
+    return records_response(await data_manager.get_top_10_busiest_airlines())
+
+# Endpoint: Get the delay percentage of the routes between the busiest airports,
+# as a sparse matrix (see data.sparse_route_matrix)
+@app.route('/flights/route_matrix', methods=['GET'])
+async def route_matrix():
+    try:
+        top = int(request.args['top']) if 'top' in request.args else None
+        min_flights = int(request.args.get('min_flights', 1))
+    except ValueError:
+        return jsonify({"error": "top and min_flights must be integers."}), 400
+    if (top is not None and top < 1) or min_flights < 1:
+        return jsonify({"error": "top and min_flights must be positive."}), 400
+
+    routes = await data_manager.get_route_matrix(top_airports=top, min_flights=min_flights)
+    return jsonify(data.sparse_route_matrix(routes))
+
+# Run the Quart app
+if __name__ == '__main__':
+    app.run(debug=True)
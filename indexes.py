@@ -0,0 +1,139 @@
+from datetime import date
+import logging
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+import coalescing
+import data
+
+logger = logging.getLogger(__name__)
+
+# Indexes for the access paths used by the FlightData queries.
+# All statements are idempotent, so they can run on every startup.
+INDEXES = {
+    # Delayed flights by airline / origin, paginated by flights.ID
+    'idx_flights_airline_delayed':
+        "CREATE INDEX IF NOT EXISTS idx_flights_airline_delayed "
+        "ON flights (airline, ID) WHERE DEPARTURE_DELAY > 0",
+    'idx_flights_origin_delayed':
+        "CREATE INDEX IF NOT EXISTS idx_flights_origin_delayed "
+        "ON flights (ORIGIN_AIRPORT, ID) WHERE DEPARTURE_DELAY > 0",
+    # Top delays of a given date
+    'idx_flights_date_delay':
+        "CREATE INDEX IF NOT EXISTS idx_flights_date_delay "
+        "ON flights (year, month, day, DEPARTURE_DELAY DESC)",
+    # Covering indexes for the aggregates per airline, origin, route and hour
+    'idx_flights_airline_delay':
+        "CREATE INDEX IF NOT EXISTS idx_flights_airline_delay "
+        "ON flights (airline, DEPARTURE_DELAY)",
+    'idx_flights_origin_delay':
+        "CREATE INDEX IF NOT EXISTS idx_flights_origin_delay "
+        "ON flights (ORIGIN_AIRPORT, DEPARTURE_DELAY)",
+    'idx_flights_route_delay':
+        "CREATE INDEX IF NOT EXISTS idx_flights_route_delay "
+        "ON flights (ORIGIN_AIRPORT, DESTINATION_AIRPORT, DEPARTURE_DELAY)",
+    'idx_flights_hour_delay':
+        "CREATE INDEX IF NOT EXISTS idx_flights_hour_delay "
+        "ON flights (strftime('%H', SCHEDULED_DEPARTURE), DEPARTURE_DELAY)",
+    # Airline lookup by name
+    'idx_airlines_airline':
+        "CREATE INDEX IF NOT EXISTS idx_airlines_airline ON airlines (airline)",
+}
+
+# FlightData methods to check, with sample arguments for their parameters
+PLAN_CHECKS = [
+    ('get_flight_by_id', (1,)),
+    ('get_delayed_flights_by_airline', ('',)),
+    ('get_delayed_flights_by_airport', ('AAA',)),
+    ('get_top_5_delays_by_date', (1, 1, 2015)),
+    ('get_top_delays_by_date_range', (date(2015, 1, 1), date(2015, 1, 31), 5)),
+    # The bucket doesn't change the plan, the group joins airlines or not
+    ('get_delay_rollup', (date(2015, 1, 1), date(2015, 1, 31), 'week', None)),
+    ('get_delay_rollup', (date(2015, 1, 1), date(2015, 1, 31), 'week', 'airline')),
+    ('get_delay_rollup', (date(2015, 1, 1), date(2015, 1, 31), 'week', 'origin')),
+    ('get_top_10_busiest_airlines', ()),
+    ('get_average_delay_per_airline', ()),
+    ('get_percentage_delayed_flights_per_airline', ()),
+    ('get_average_delay_per_origin', ()),
+    ('get_percentage_delayed_flights_per_hour', ()),
+    ('get_percentage_delayed_flights_per_route', ()),
+]
+
+
+class _PlanRecorder(data.FlightData):
+    """
+    A FlightData that runs EXPLAIN QUERY PLAN instead of its queries and
+    records the plans, so every method can be checked with its real SQL.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.summaries = None
+        self.coalescer = coalescing.QueryCoalescer(limits={})
+        self.plans = []
+
+    def _execute_query(self, query, params=None, result_format='records'):
+        with self.engine.connect() as connection:
+            rows = connection.execute(text("EXPLAIN QUERY PLAN " + query), params)
+            self.plans.append([row.detail for row in rows])
+        return data.empty_result(result_format)
+
+    def __del__(self):
+        # The engine belongs to the FlightData being checked
+        pass
+
+
+def ensure_indexes(engine):
+    """
+    Create the indexes that don't exist yet and refresh the planner statistics.
+    """
+    with engine.begin() as connection:
+        for statement in INDEXES.values():
+            connection.execute(text(statement))
+        connection.execute(text("PRAGMA optimize"))
+
+
+def is_table_scan(detail):
+    """
+    Return True if an EXPLAIN QUERY PLAN line is a full scan of the flights table.
+    """
+    return detail.startswith('SCAN flights') and 'INDEX' not in detail
+
+
+def check_query_plans(engine):
+    """
+    Run EXPLAIN QUERY PLAN for every FlightData query and return a dictionary
+    mapping the name of each method that still scans the flights table to its plan.
+    """
+    scans = {}
+    for method, args in PLAN_CHECKS:
+        recorder = _PlanRecorder(engine)
+        try:
+            getattr(recorder, method)(*args)
+        except (KeyError, ValueError):
+            # The DataFrame methods can't post-process an empty result
+            pass
+        for plan in recorder.plans:
+            if any(is_table_scan(detail) for detail in plan):
+                scans[method] = plan
+    return scans
+
+
+def setup_schema(data_manager, check_plans=True):
+    """
+    Make sure the indexes exist, bring the summary tables up to date if the
+    data manager uses them and, with check_plans, report any query that
+    still scans the flights table (this runs every FlightData method, so it
+    loads pandas). Errors (e.g. a read-only database) and the scans found are
+    logged, not raised.
+    """
+    try:
+        ensure_indexes(data_manager.engine)
+        if data_manager.summaries is not None:
+            data_manager.summaries.refresh()
+        scans = check_query_plans(data_manager.engine) if check_plans else {}
+    except SQLAlchemyError as e:
+        logger.warning("Could not set up indexes: %s: %s", e.__class__.__name__, e)
+        return
+
+    for method, plan in scans.items():
+        logger.warning("%s scans the flights table: %s", method, '; '.join(plan))
@@ -0,0 +1,311 @@
+import csv
+import itertools
+import logging
+import os
+import re
+import sys
+import time
+from sqlalchemy import text
+import data
+import indexes
+
+logger = logging.getLogger(__name__)
+
+# Rows inserted per executemany; each batch is committed in one transaction
+# together with the load's checkpoint
+INGEST_BATCH_SIZE = 50000
+
+# Loads of at least this many rows drop the flights indexes first and rebuild
+# them at the end, which is much faster than updating them row by row
+DROP_INDEXES_MIN_ROWS = 200000
+
+# Columns every flight must have
+REQUIRED_COLUMNS = ['YEAR', 'MONTH', 'DAY', 'AIRLINE', 'ORIGIN_AIRPORT', 'DESTINATION_AIRPORT']
+
+AIRPORT_COLUMNS = ['ORIGIN_AIRPORT', 'DESTINATION_AIRPORT']
+IATA_CODE = re.compile(r'^[A-Z]{3}$')
+
+# How far each load got, committed with every batch so a crashed load can resume.
+# source identifies the input file by path, size and modification time.
+CREATE_PROGRESS_TABLE = """
+CREATE TABLE IF NOT EXISTS ingest_progress (
+    source TEXT PRIMARY KEY,
+    rows_read INTEGER NOT NULL,
+    rows_loaded INTEGER NOT NULL,
+    rows_rejected INTEGER NOT NULL,
+    finished INTEGER NOT NULL
+)
+"""
+
+SAVE_PROGRESS = """
+INSERT INTO ingest_progress (source, rows_read, rows_loaded, rows_rejected, finished)
+VALUES (:source, :rows_read, :rows_loaded, :rows_rejected, :finished)
+ON CONFLICT (source) DO UPDATE SET
+    rows_read = excluded.rows_read,
+    rows_loaded = excluded.rows_loaded,
+    rows_rejected = excluded.rows_rejected,
+    finished = excluded.finished
+"""
+
+
+def source_key(path):
+    """
+    Identify an input file by its absolute path, size and modification time,
+    so a different file at the same path starts a new load.
+    """
+    stat = os.stat(path)
+    return f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def is_parquet(path):
+    return path.lower().endswith(('.parquet', '.pq'))
+
+
+def count_rows(path):
+    """
+    Number of rows in the input: from the metadata of a Parquet file,
+    or by counting the lines of a CSV file (minus its header).
+    """
+    if is_parquet(path):
+        import pyarrow.parquet as pq
+        return pq.ParquetFile(path).metadata.num_rows
+    lines = 0
+    last = b'\n'
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            lines += chunk.count(b'\n')
+            last = chunk[-1:]
+    if last != b'\n':
+        lines += 1  # No newline after the last row
+    return max(lines - 1, 0)
+
+
+def read_batches(path, batch_size=INGEST_BATCH_SIZE, skip=0):
+    """
+    Stream the rows of a CSV or Parquet file as lists of dictionaries,
+    batch_size rows at a time, after skipping the first skip rows.
+    """
+    if is_parquet(path):
+        import pyarrow.parquet as pq
+        rows = (row for batch in pq.ParquetFile(path).iter_batches(batch_size=batch_size)
+                for row in batch.to_pylist())
+        rows = itertools.islice(rows, skip, None)
+        while batch := list(itertools.islice(rows, batch_size)):
+            yield batch
+        return
+
+    with open(path, newline='') as f:
+        rows = itertools.islice(csv.DictReader(f), skip, None)
+        while batch := list(itertools.islice(rows, batch_size)):
+            yield batch
+
+
+def _converter(declared_type):
+    """
+    Function converting an input value for a column of the given SQLite
+    declared type, following SQLite's affinity rules.
+    """
+    declared_type = (declared_type or '').upper()
+    if 'INT' in declared_type:
+        return _to_int
+    if any(name in declared_type for name in ('REAL', 'FLOA', 'DOUB')):
+        return float
+    return str
+
+
+def _to_int(value):
+    if isinstance(value, str):
+        try:
+            return int(value)
+        except ValueError:
+            value = float(value)
+    if isinstance(value, float) and not value.is_integer():
+        raise ValueError(f"{value} is not an integer")
+    return int(value)
+
+
+class RowValidator:
+    """
+    Validates and normalizes input rows for the flights table: column names are
+    matched case-insensitively, values converted to the declared column types,
+    the airline (ID, name or IATA code) resolved to its ID in airlines, and the
+    airport codes upper-cased and checked to be IATA codes.
+    """
+
+    def __init__(self, connection):
+        self.converters = {
+            column.name.upper(): (column.name, _converter(column.type))
+            for column in connection.execute(text("PRAGMA table_info(flights)"))
+        }
+        missing = [column for column in REQUIRED_COLUMNS if column not in self.converters]
+        if missing:
+            raise ValueError(f"The flights table has no {', '.join(missing)} column")
+
+        # Every way an airline can be referred to, mapped to its ID
+        airline_columns = [column.name for column in connection.execute(text("PRAGMA table_info(airlines)"))]
+        self.airlines = {}
+        for row in connection.execute(text(f"SELECT {', '.join(airline_columns)} FROM airlines")):
+            row = dict(zip((name.upper() for name in airline_columns), row))
+            for name in ('ID', 'AIRLINE', 'IATA_CODE'):
+                if row.get(name) is not None:
+                    self.airlines[str(row[name]).strip().upper()] = row['ID']
+
+    def columns(self, input_columns):
+        """
+        The flights columns an input with the given columns fills in.
+        Raises ValueError if a required column is missing.
+        """
+        input_columns = {name.strip().upper() for name in input_columns}
+        missing = [column for column in REQUIRED_COLUMNS if column not in input_columns]
+        if missing:
+            raise ValueError(f"The input has no {', '.join(missing)} column")
+        return [column for column in self.converters if column in input_columns]
+
+    def normalize(self, row, columns):
+        """
+        Returns (values, None) with the row's values as a tuple in the order
+        of columns, or (None, reason) if the row is rejected.
+        """
+        row = {name.strip().upper(): value for name, value in row.items() if name is not None}
+        values = []
+        for column in columns:
+            value = row.get(column)
+            if isinstance(value, str):
+                value = value.strip()
+            if value is None or value == '':
+                if column in REQUIRED_COLUMNS:
+                    return None, f"missing {column}"
+                values.append(None)
+                continue
+
+            if column == 'AIRLINE':
+                value = self.airlines.get(str(value).upper())
+                if value is None:
+                    return None, "unknown AIRLINE"
+            elif column in AIRPORT_COLUMNS:
+                value = str(value).upper()
+                if not IATA_CODE.match(value):
+                    return None, f"invalid {column}"
+            else:
+                try:
+                    value = self.converters[column][1](value)
+                except (TypeError, ValueError):
+                    return None, f"invalid {column}"
+            values.append(value)
+        return tuple(values), None
+
+
+def print_progress(progress):
+    """
+    Default progress reporter: one line per committed batch.
+    """
+    total = f"/{progress['total']}" if progress['total'] is not None else ""
+    rate = progress['rows_read'] / progress['elapsed'] if progress['elapsed'] else 0
+    print(f"Read {progress['rows_read']}{total} rows: {progress['rows_loaded']} loaded, "
+          f"{progress['rows_rejected']} rejected ({rate:,.0f} rows/s)")
+
+
+def drop_flight_indexes(connection):
+    """
+    Drop the indexes on flights created by indexes.ensure_indexes().
+    """
+    for name, statement in indexes.INDEXES.items():
+        if " ON flights " in statement:
+            connection.execute(text(f"DROP INDEX IF EXISTS {name}"))
+
+
+def load_flights(data_manager, path, batch_size=INGEST_BATCH_SIZE, drop_indexes=None,
+                 progress=print_progress):
+    """
+    Load the flights of a CSV or Parquet file into the flights table.
+
+    Rows are validated and normalized (see RowValidator) and inserted batch_size
+    at a time with executemany, one transaction per batch; rejected rows are
+    counted and logged. Each transaction also records how far the load got, so
+    running it again after a crash resumes after the last committed batch, and
+    running it again after it finished does nothing.
+
+    With drop_indexes (by default, when the load has at least DROP_INDEXES_MIN_ROWS
+    rows) the flights indexes are dropped first. They are rebuilt at the end,
+    and the summary tables are brought up to date if data_manager uses them.
+    progress is called with a dictionary of counters after each batch.
+    Returns that dictionary for the whole load.
+    """
+    source = source_key(path)
+    engine = data_manager.engine
+
+    with engine.begin() as connection:
+        connection.execute(text(CREATE_PROGRESS_TABLE))
+        state = connection.execute(
+            text("SELECT rows_read, rows_loaded, rows_rejected, finished FROM ingest_progress "
+                 "WHERE source = :source"),
+            {'source': source},
+        ).mappings().first()
+        validator = RowValidator(connection)
+
+    state = dict(state) if state else {'rows_read': 0, 'rows_loaded': 0, 'rows_rejected': 0, 'finished': 0}
+    total = count_rows(path)
+    counters = {'source': source, 'total': total, 'elapsed': 0.0, **state}
+    if state['finished']:
+        logger.info("%s was already loaded", path)
+        return counters
+    if state['rows_read']:
+        logger.info("Resuming the load of %s after %d rows", path, state['rows_read'])
+
+    if drop_indexes is None:
+        drop_indexes = total - state['rows_read'] >= DROP_INDEXES_MIN_ROWS
+    if drop_indexes:
+        with engine.begin() as connection:
+            drop_flight_indexes(connection)
+
+    rejected = {}
+    started = time.perf_counter()
+    columns = insert = None
+    for batch in read_batches(path, batch_size, skip=state['rows_read']):
+        if columns is None:
+            columns = validator.columns(batch[0].keys())
+            insert = (f"INSERT INTO flights ({', '.join(validator.converters[c][0] for c in columns)}) "
+                      f"VALUES ({', '.join('?' for _ in columns)})")
+
+        rows = []
+        for row in batch:
+            values, reason = validator.normalize(row, columns)
+            if values is None:
+                rejected[reason] = rejected.get(reason, 0) + 1
+            else:
+                rows.append(values)
+
+        counters['rows_read'] += len(batch)
+        counters['rows_loaded'] += len(rows)
+        counters['rows_rejected'] += len(batch) - len(rows)
+        with engine.begin() as connection:
+            if rows:
+                # Plain DB-API executemany: binding SQLAlchemy parameters row by row costs more than the inserts
+                connection.exec_driver_sql(insert, rows)
+            connection.execute(text(SAVE_PROGRESS), {**counters, 'finished': 0})
+        counters['elapsed'] = time.perf_counter() - started
+        if progress:
+            progress(counters)
+
+    # Rebuild whatever indexes this or an interrupted earlier run dropped
+    indexes.ensure_indexes(engine)
+    if data_manager.summaries is not None:
+        data_manager.summaries.refresh()
+    with engine.begin() as connection:
+        connection.execute(text(SAVE_PROGRESS), {**counters, 'finished': 1})
+    counters['finished'] = 1
+    counters['elapsed'] = time.perf_counter() - started
+
+    for reason, count in sorted(rejected.items()):
+        logger.warning("Rejected %d rows of %s: %s", count, path, reason)
+    return counters
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print("Usage: python ingest.py <database URI> <CSV or Parquet file>")
+        sys.exit(1)
+    logging.basicConfig(level=logging.INFO)
+    result = load_flights(data.FlightData(sys.argv[1], use_summaries=True), sys.argv[2])
+    print(f"Loaded {result['rows_loaded']} flights from {sys.argv[2]} "
+          f"({result['rows_rejected']} rejected) in {result['elapsed']:.1f}s")
@@ -0,0 +1,176 @@
+from bisect import bisect_left
+from contextvars import ContextVar
+import logging
+import sys
+import threading
+import time
+
+# Logger the queries slower than FlightData's slow_query_threshold go to,
+# together with their EXPLAIN QUERY PLAN
+slow_query_logger = logging.getLogger('flights.slow_queries')
+
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+ROW_BUCKETS = (1, 10, 100, 1000, 10000, 100000, 1000000)
+BYTE_BUCKETS = (1000, 10000, 100000, 1000000, 10000000, 100000000)
+
+
+class Histogram:
+    """
+    A Prometheus-style cumulative histogram with one series per label value.
+    """
+
+    def __init__(self, name, help_text, label, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_value, value):
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = {
+                    'counts': [0] * (len(self.buckets) + 1), 'sum': 0.0, 'count': 0,
+                }
+            series['counts'][bisect_left(self.buckets, value)] += 1
+            series['sum'] += value
+            series['count'] += 1
+
+    def render(self):
+        """
+        Return the histogram in the Prometheus text exposition format.
+        """
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for label_value, series in sorted(self._series.items()):
+                label = f'{self.label}="{label_value}"'
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), series['counts']):
+                    cumulative += count
+                    lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {cumulative}')
+                lines.append(f"{self.name}_sum{{{label}}} {series['sum']}")
+                lines.append(f"{self.name}_count{{{label}}} {series['count']}")
+        return "\n".join(lines)
+
+
+class Counter:
+    """
+    A Prometheus-style counter with one series per label value.
+    """
+
+    def __init__(self, name, help_text, label):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def increment(self, label_value, amount=1):
+        with self._lock:
+            self._values[label_value] = self._values.get(label_value, 0) + amount
+
+    def render(self):
+        """
+        Return the counter in the Prometheus text exposition format.
+        """
+        lines = [f"# HELP {self.name}_total {self.help_text}", f"# TYPE {self.name}_total counter"]
+        with self._lock:
+            for label_value, value in sorted(self._values.items()):
+                lines.append(f'{self.name}_total{{{self.label}="{label_value}"}} {value}')
+        return "\n".join(lines)
+
+
+QUERY_DURATION = Histogram('flights_query_duration_seconds',
+                           "Wall time of FlightData queries.", 'query', DURATION_BUCKETS)
+QUERY_ROWS = Histogram('flights_query_rows',
+                       "Rows returned by FlightData queries.", 'query', ROW_BUCKETS)
+CONNECTION_WAIT = Histogram('flights_connection_wait_seconds',
+                            "Time spent checking a connection out of the pool.", 'query',
+                            DURATION_BUCKETS)
+QUERY_ERRORS = Counter('flights_query_errors',
+                       "FlightData queries that raised a database error.", 'query')
+QUERIES_COALESCED = Counter('flights_queries_coalesced',
+                            "FlightData calls that shared the result of an identical call in flight.",
+                            'query')
+QUERIES_SHED = Counter('flights_queries_shed',
+                       "FlightData calls rejected at the concurrency limit of their query class.",
+                       'query_class')
+REQUEST_DURATION = Histogram('flights_request_duration_seconds',
+                             "Wall time of API requests.", 'endpoint', DURATION_BUCKETS)
+RESPONSE_BYTES = Histogram('flights_response_bytes',
+                           "Size of serialized API responses.", 'endpoint', BYTE_BUCKETS)
+
+METRICS = [QUERY_DURATION, QUERY_ROWS, CONNECTION_WAIT, QUERY_ERRORS, QUERIES_COALESCED, QUERIES_SHED,
+           REQUEST_DURATION, RESPONSE_BYTES]
+
+# Timing breakdown of the current request, when profiling was requested
+_profile = ContextVar('flights_profile', default=None)
+
+
+def caller_name(depth=2):
+    """
+    Name of the function depth frames up the stack: for _execute_query,
+    the FlightData method that ran the query, used as its metric label.
+    """
+    return sys._getframe(depth).f_code.co_name
+
+
+def record_query(name, duration, rows, connection_wait):
+    """
+    Record one query in the metrics and in the current request's profile.
+    """
+    QUERY_DURATION.observe(name, duration)
+    QUERY_ROWS.observe(name, rows)
+    CONNECTION_WAIT.observe(name, connection_wait)
+    profile = _profile.get()
+    if profile is not None:
+        profile['queries'].append((name, duration, connection_wait, rows))
+
+
+def record_error(name):
+    QUERY_ERRORS.increment(name)
+
+
+def record_coalesced(name):
+    QUERIES_COALESCED.increment(name)
+
+
+def record_shed(query_class):
+    QUERIES_SHED.increment(query_class)
+
+
+def start_profile():
+    """
+    Start collecting a timing breakdown for the current request.
+    """
+    _profile.set({'started': time.perf_counter(), 'queries': []})
+
+
+def finish_profile():
+    """
+    Stop collecting and return the breakdown as a Server-Timing header value,
+    or None if profiling wasn't started for this request.
+    """
+    profile = _profile.get()
+    if profile is None:
+        return None
+    _profile.set(None)
+    total = time.perf_counter() - profile['started']
+    queries = profile['queries']
+    db = sum(duration for _, duration, _, _ in queries)
+    wait = sum(wait for _, _, wait, _ in queries)
+    entries = [f'db;dur={db * 1000:.2f};desc="{len(queries)} queries"',
+               f'conn;dur={wait * 1000:.2f}']
+    entries += [f'{name};dur={duration * 1000:.2f};desc="{rows} rows"'
+                for name, duration, _, rows in queries]
+    entries += [f'app;dur={(total - db) * 1000:.2f}', f'total;dur={total * 1000:.2f}']
+    return ", ".join(entries)
+
+
+def render_metrics():
+    """
+    Return all metrics in the Prometheus text exposition format.
+    """
+    return "\n".join(metric.render() for metric in METRICS) + "\n"
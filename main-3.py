@@ -1,14 +1,22 @@
+import airports
+import argparse
+import charts
 import data
+import indexes
 from datetime import datetime
+import json
+import os
 import sqlalchemy
 import sys
-import matplotlib.pyplot as plt
-import seaborn as sns
-import pandas as pd
-import geopandas as gpd
-from shapely.geometry import LineString
 
-SQLITE_URI = 'sqlite:////Users/masterschool/Documents/Masterschool_projects_2024/Database_SE106/sky_SQL_codio_project/flights.sqlite3'
+# matplotlib, seaborn, pandas and geopandas are imported inside the
+# plotting functions, so lookups don't pay seconds of import time for them
+
+# Database URI, overridable with the FLIGHTS_DB_URI environment variable
+SQLITE_URI = os.environ.get(
+    'FLIGHTS_DB_URI',
+    'sqlite:////Users/masterschool/Documents/Masterschool_projects_2024/Database_SE106/sky_SQL_codio_project/flights.sqlite3'
+)
 IATA_LENGTH = 3
 
 def delayed_flights_by_airline(data_manager):
@@ -113,115 +121,72 @@ def print_average_delay_per_origin(results):
         print(f"{origin_airport}: {average_delay:.2f} minutes")
 
 def plot_percentage_delay_per_airline(data_manager):
+    import matplotlib.pyplot as plt
+
     results = data_manager.get_percentage_delayed_flights_per_airline()
 
     if results.empty:
         print("No data available to generate the graph.")
         return
 
-    airlines = results['AIRLINE']
-    delay_percentages = results['percentage_delays']
-
-    # Plotting the data
-    plt.figure(figsize=(10, 6))
-    plt.bar(airlines, delay_percentages, color='skyblue')
-
-    # Customizing the graph
-    plt.title('Percentage of Delayed Flights Per Airline')
-    plt.xlabel('Airlines')
-    plt.ylabel('Delay Percentage (%)')
-    plt.xticks(rotation=45, ha="right")
+    fig, ax = plt.subplots(figsize=(10, 6))
+    charts.draw_percentage_delay_per_airline(ax, results)
 
     # Display the graph
     plt.tight_layout()
     plt.show()
 
 def plot_percentage_delay_per_hour(data_manager):
+    import matplotlib.pyplot as plt
+
     results = data_manager.get_percentage_delayed_flights_per_hour()
 
     if results.empty:
         print("No data available to generate the graph.")
         return
 
-    hours = results['HOUR']
-    delay_percentages = results['delay_percentage']
-
-    # Plotting the data
-    plt.figure(figsize=(10, 6))
-    plt.bar(hours, delay_percentages, color='lightcoral')
-
-    # Customizing the graph
-    plt.title('Percentage of Delayed Flights Per Hour of the Day')
-    plt.xlabel('Hour of the Day (24-hour format)')
-    plt.ylabel('Delay Percentage (%)')
-    plt.xticks(hours)
+    fig, ax = plt.subplots(figsize=(10, 6))
+    charts.draw_percentage_delay_per_hour(ax, results)
 
     # Display the graph
     plt.tight_layout()
     plt.show()
 
 def plot_heatmap_delay_per_route(data_manager):
-    results = data_manager.get_percentage_delayed_flights_per_route()
+    import matplotlib.pyplot as plt
+
+    results = charts.route_matrix_data(data_manager)
 
     if results.empty:
         print("No data available to generate the heatmap.")
         return
 
-    # Create a DataFrame from the results
-    df = pd.DataFrame(results)
-
-    # Pivot the data to create a matrix of origin -> destination with delay percentage
-    heatmap_data = df.pivot("ORIGIN_AIRPORT", "DESTINATION_AIRPORT", "delay_percentage")
-
-    # Plotting the heatmap
-    plt.figure(figsize=(12, 8))
-    sns.heatmap(heatmap_data, annot=True, fmt=".2f", cmap="YlGnBu", cbar_kws={'label': 'Delay Percentage (%)'})
-
-    plt.title('Heatmap of Delayed Flights (Origin -> Destination)')
-    plt.xlabel('Destination Airport')
-    plt.ylabel('Origin Airport')
+    fig, ax = plt.subplots(figsize=(12, 8))
+    charts.draw_heatmap_delay_per_route(ax, results)
 
     # Display the heatmap
     plt.tight_layout()
     plt.show()
 
 def plot_delay_map_per_route(data_manager):
-    results = data_manager.get_percentage_delayed_flights_for_map()
+    import geopandas as gpd
+    import matplotlib.pyplot as plt
 
-    if results.empty:
-        print("No data available to generate the map.")
-        return
+    # Route geometries built from the airports table, cached as GeoParquet
+    routes_gdf = airports.route_map(data_manager)
 
-    # Load world map data
-    world = gpd.read_file(gpd.datasets.get_path('naturalearth_lowres'))
-
-    # Create a GeoDataFrame for flight routes
-    routes = []
-    for result in results:
-        origin = result['ORIGIN_AIRPORT']
-        destination = result['DESTINATION_AIRPORT']
-        avg_delay = result['avg_delay']
-
-        # Create LineString geometry for route (assuming you have lat/long data)
-        origin_coords = get_airport_coordinates(origin)
-        destination_coords = get_airport_coordinates(destination)
-
-        if origin_coords and destination_coords:
-            route = {
-                'geometry': LineString([origin_coords, destination_coords]),
-                'delay': avg_delay
-            }
-            routes.append(route)
-
-    # Convert the list of routes into a GeoDataFrame
-    routes_gdf = gpd.GeoDataFrame(routes)
+    if routes_gdf.empty:
+        print("No data available to generate the map (load the airports table with airports.py).")
+        return
 
-    # Plot the map with routes
+    # Plot the map with routes, over the world map where geopandas still ships it (before 1.0)
     fig, ax = plt.subplots(figsize=(12, 8))
-    world.plot(ax=ax, color='lightgray')
+    if hasattr(gpd, 'datasets'):
+        world = gpd.read_file(gpd.datasets.get_path('naturalearth_lowres'))
+        world.plot(ax=ax, color='lightgray')
 
     # Plot routes with color based on average delay
-    routes_gdf.plot(ax=ax, column='delay', cmap='Reds', legend=True, linewidth=2)
+    routes_gdf.plot(ax=ax, column='avg_delay', cmap='Reds', legend=True, linewidth=2)
 
     plt.title('Average Delayed Flights Per Route (Origin <-> Destination)')
     plt.xlabel('Longitude')
@@ -230,17 +195,78 @@ def plot_delay_map_per_route(data_manager):
     plt.tight_layout()
     plt.show()
 
-def get_airport_coordinates(airport_code):
-    # Placeholder function - you need a way to map IATA codes to lat/long coordinates
-    airport_coords = {
-        'JFK': (-73.7781, 40.6413),
-        'LAX': (-118.4085, 33.9416),
-        # Add more airport coordinates here...
-    }
-    return airport_coords.get(airport_code)
+def parse_date(value):
+    try:
+        return datetime.strptime(value, '%d/%m/%Y')
+    except ValueError:
+        raise argparse.ArgumentTypeError("Invalid date format. Please use DD/MM/YYYY format.")
+
+def parse_iata(value):
+    if not (value.isalpha() and len(value) == IATA_LENGTH):
+        raise argparse.ArgumentTypeError("Invalid IATA code.")
+    return value.upper()
+
+# One-shot commands: name, description, (argument name, argument type) or None,
+# query to run and function printing its results
+COMMANDS = [
+    ('flight', "Show flight by ID", ('flight_id', int),
+     lambda data_manager, flight_id: data_manager.get_flight_by_id(flight_id), print_results),
+    ('delayed-airline', "Delayed flights by airline", ('airline', str),
+     lambda data_manager, airline: data_manager.get_delayed_flights_by_airline(airline), print_results),
+    ('delayed-airport', "Delayed flights by origin airport", ('airport', parse_iata),
+     lambda data_manager, airport: data_manager.get_delayed_flights_by_airport(airport), print_results),
+    ('top-delays-date', "Top 5 flight delays by date (DD/MM/YYYY)", ('date', parse_date),
+     lambda data_manager, date: data_manager.get_top_5_delays_by_date(date.day, date.month, date.year),
+     print_results),
+    ('avg-delay-airline', "Average delay per airline", None,
+     lambda data_manager: data_manager.get_average_delay_per_airline(), print_average_delay_per_airline),
+    ('avg-delay-origin', "Average delay per origin airport", None,
+     lambda data_manager: data_manager.get_average_delay_per_origin(), print_average_delay_per_origin),
+    ('busiest-airlines', "Top 10 busiest airlines", None,
+     lambda data_manager: data_manager.get_top_10_busiest_airlines(), print_top_10_busiest_airlines),
+]
+
+def run_command(argv):
+    """
+    Run one query given on the command line, print its results and return the
+    exit status: 0 if there were results, 1 if not.
+    """
+    parser = argparse.ArgumentParser(
+        prog='main-3.py',
+        description="Query the flights database. Without a command, the interactive menu starts.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    for name, description, argument, query, printer in COMMANDS:
+        command = commands.add_parser(name, help=description)
+        if argument:
+            command.add_argument(argument[0], type=argument[1])
+        command.add_argument('--json', action='store_true', help="Print the results as JSON.")
+        command.set_defaults(query=query, printer=printer, argument=argument)
+    commands.add_parser('setup', help="Create the indexes and check the query plans")
+    options = parser.parse_args(argv)
+
+    data_manager = data.FlightData(SQLITE_URI)
+    if options.command == 'setup':
+        # The queries only read, so they leave the schema to this command, the
+        # menu and the API, and never wait for a writer's lock
+        indexes.setup_schema(data_manager)
+        return 0
+    if options.argument:
+        results = options.query(data_manager, getattr(options, options.argument[0]))
+    else:
+        results = options.query(data_manager)
+
+    if options.json:
+        print(json.dumps(results, indent=2, default=str))
+    else:
+        options.printer(results)
+    return 0 if results else 1
 
 def main():
+    if len(sys.argv) > 1:
+        sys.exit(run_command(sys.argv[1:]))
+
     data_manager = data.FlightData(SQLITE_URI)
+    indexes.setup_schema(data_manager)
 
     FUNCTIONS = {
         1: (flight_by_id, "Show flight by ID"),
@@ -0,0 +1,180 @@
+import os
+from abc import ABC, abstractmethod
+from concurrent.futures import ProcessPoolExecutor
+from sqlalchemy import text
+import sqlite_engine
+import summaries
+
+# Each partition is one (year, month) of flights. Its partial aggregates are the
+# counters of the summary tables (see summaries.py), which add up exactly across
+# partitions, grouped by the same keys.
+PARTITIONS_QUERY = "SELECT DISTINCT flights.year, flights.month FROM flights"
+
+# The engine of a worker process, opened read-only by _init_worker()
+_engine = None
+
+
+def partial_query(table, partitioned=True):
+    """
+    The query computing the counters of summary table `table` for one partition
+    (or, if not partitioned, for all flights).
+    IS matches NULL years and months too and, like =, can use the date index.
+    """
+    keys = summaries.SUMMARIES[table]['keys']
+    columns = [f"{expression} AS {name}" for name, expression in keys.items()]
+    columns += [f"{expression} AS {name}" for name, expression in summaries.COUNTERS.items()]
+    where = "WHERE flights.year IS :year AND flights.month IS :month " if partitioned else ""
+    return (f"SELECT {', '.join(columns)} FROM flights "
+            f"{where}"
+            f"GROUP BY {', '.join(keys.values())}")
+
+
+def merge_counters(table, partials):
+    """
+    Add up the partial counters of summary table `table`: partials is an
+    iterable of row lists, each row its key columns followed by its counters.
+    Returns a dictionary mapping each key tuple to its counters.
+    """
+    key_count = len(summaries.SUMMARIES[table]['keys'])
+    merged = {}
+    for rows in partials:
+        for row in rows:
+            key, values = tuple(row[:key_count]), row[key_count:]
+            totals = merged.get(key)
+            if totals is None:
+                merged[key] = list(values)
+            else:
+                for i, value in enumerate(values):
+                    totals[i] += value
+    return {key: dict(zip(summaries.COUNTERS, values)) for key, values in merged.items()}
+
+
+def _init_worker(db_uri):
+    global _engine
+    _engine = sqlite_engine.create_sqlite_engine(db_uri, 'readonly')
+
+
+def _partial_counters(table, year, month):
+    """
+    Run in a worker process: the counters of one partition, as tuples.
+    """
+    with _engine.connect() as connection:
+        result = connection.execute(text(partial_query(table)), {'year': year, 'month': month})
+        return [tuple(row) for row in result]
+
+
+def _descending(column):
+    """
+    Sort key ordering rows by column, largest first and None last, like ORDER BY column DESC in SQLite.
+    """
+    return lambda row: (row[column] is None, -row[column] if row[column] is not None else 0)
+
+
+def _null_first(item):
+    """
+    Sort key for (group, ...) items ordering groups like GROUP BY does in SQLite, NULL first.
+    """
+    return (item[0] is not None, item[0] if item[0] is not None else '')
+
+
+def _average(delay_sum, delay_count):
+    return delay_sum / delay_count if delay_count else None
+
+
+class CounterAggregator(ABC):
+    """
+    Computes the aggregate queries of FlightData from summary table counters
+    merged by counters(), into the same rows the single SQL query returns.
+    Subclasses implement counters() over their own parts of the flights.
+    """
+
+    @abstractmethod
+    def counters(self, engine, table):
+        """
+        Aggregate summary table `table`'s counters over all flights.
+        Returns a dictionary mapping each key tuple to its counters.
+        """
+
+    def _per_airline(self, engine):
+        """
+        The airline counters merged per airline name, like GROUP BY airlines.airline
+        after joining airlines (flights of unknown airlines are left out).
+        """
+        with engine.connect() as connection:
+            names = dict(connection.execute(text("SELECT id, airline FROM airlines")).all())
+        per_airline = {}
+        for (airline_id,), counters in self.counters(engine, 'delay_summary_airline').items():
+            if airline_id not in names:
+                continue
+            totals = per_airline.setdefault(names[airline_id], dict.fromkeys(counters, 0))
+            for name, value in counters.items():
+                totals[name] += value
+        return per_airline
+
+    def top_10_busiest_airlines(self, engine):
+        rows = [{'airline': airline, 'flight_count': counters['flight_count']}
+                for airline, counters in self._per_airline(engine).items()]
+        return sorted(rows, key=_descending('flight_count'))[:10]
+
+    def average_delay_per_airline(self, engine):
+        rows = [{'AIRLINE': airline, 'average_delay': _average(c['delay_sum'], c['delay_count'])}
+                for airline, c in self._per_airline(engine).items() if c['reported_count']]
+        return sorted(rows, key=_descending('average_delay'))
+
+    def percentage_delayed_per_airline(self, engine):
+        return [{'AIRLINE': airline, 'total_flights': c['flight_count'], 'delayed_flights': c['delayed_count']}
+                for airline, c in sorted(self._per_airline(engine).items(), key=_null_first)]
+
+    def average_delay_per_origin(self, engine):
+        rows = [{'origin_airport': origin, 'average_delay': _average(c['delay_sum'], c['delay_count'])}
+                for (origin,), c in self.counters(engine, 'delay_summary_origin').items()
+                if c['reported_count']]
+        return sorted(rows, key=_descending('average_delay'))
+
+    def percentage_delayed_per_hour(self, engine):
+        counters = self.counters(engine, 'delay_summary_hour')
+        return [{'hour': hour, 'total_flights': c['flight_count'], 'delayed_flights': c['delayed_count']}
+                for (hour,), c in sorted(counters.items(), key=lambda item: _null_first(item[0]))]
+
+    def percentage_delayed_per_route(self, engine):
+        # delayed / total * 100, computed in the same order as AVG(...) * 100
+        return [{'ORIGIN_AIRPORT': origin, 'DESTINATION_AIRPORT': destination,
+                 'delay_percentage': c['delayed_count'] / c['flight_count'] * 100}
+                for (origin, destination), c in self.counters(engine, 'delay_summary_route').items()]
+
+
+class PartitionedAggregator(CounterAggregator):
+    """
+    Runs the aggregate queries of FlightData as scatter-gather over year/month
+    partitions: each partition is aggregated by a process pool worker with its
+    own read-only connection, and the partial counters are merged here. The
+    pool is started on first use.
+    """
+
+    def __init__(self, db_uri, workers=None):
+        self.db_uri = db_uri
+        self.workers = workers or os.cpu_count()
+        self._pool = None
+
+    def _executor(self):
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(self.workers, initializer=_init_worker,
+                                             initargs=(self.db_uri,))
+        return self._pool
+
+    def counters(self, engine, table):
+        """
+        Aggregate summary table `table`'s counters over all partitions.
+        Returns a dictionary mapping each key tuple to its counters.
+        """
+        with engine.connect() as connection:
+            partitions = connection.execute(text(PARTITIONS_QUERY)).all()
+
+        pool = self._executor()
+        futures = [pool.submit(_partial_counters, table, year, month) for year, month in partitions]
+        return merge_counters(table, (future.result() for future in futures))
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
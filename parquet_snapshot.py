@@ -0,0 +1,210 @@
+import os
+import shutil
+import sys
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from pyarrow import fs
+from sqlalchemy import text
+import data
+
+# Rows written per Parquet file while exporting
+EXPORT_BATCH_SIZE = 100000
+
+# Flights joined with the airline name, plus the departure hour computed the
+# same way as in the SQL queries, so the snapshot needs no string parsing.
+# {columns} are the flights columns converted by _select_column(). The snapshot
+# keeps the flights without an airlines row, as the queries by origin, hour and
+# route count them; the per-airline methods leave them out like the SQL joins.
+SNAPSHOT_QUERY = """
+SELECT {columns},
+       airlines.airline AS AIRLINE_NAME,
+       strftime('%H', flights.SCHEDULED_DEPARTURE) AS DEPARTURE_HOUR
+FROM flights
+LEFT JOIN airlines ON flights.airline = airlines.id
+"""
+
+PARTITION_COLUMNS = ['YEAR', 'MONTH']
+
+# The flights whose airline is in the airlines table
+KNOWN_AIRLINE = ds.field('AIRLINE_NAME').is_valid()
+
+
+def _arrow_type(declared_type):
+    """
+    Map an SQLite declared column type to an Arrow type, following SQLite's affinity rules.
+    """
+    declared_type = (declared_type or '').upper()
+    if 'INT' in declared_type:
+        return pa.int64()
+    if any(name in declared_type for name in ('REAL', 'FLOA', 'DOUB')):
+        return pa.float64()
+    return pa.string()
+
+
+def _select_column(name, arrow_type):
+    """
+    Select flights column name converted to arrow_type by SQLite; values that
+    don't fit become NULL. SQLite columns can hold values of any type, but a
+    Parquet column can't, and converting them here lets Arrow build each column
+    of a batch in one call.
+    """
+    column = f"flights.{name}"
+    if arrow_type == pa.string():
+        return f"CAST({column} AS TEXT) AS {name}"
+    sql_type = 'INTEGER' if arrow_type == pa.int64() else 'REAL'
+    return (f"CASE WHEN typeof({column}) IN ('integer', 'real') "
+            f"THEN CAST({column} AS {sql_type}) END AS {name}")
+
+
+def snapshot_query(schema):
+    """
+    The query reading the snapshot's columns, with the types of schema.
+    """
+    flight_fields = [field for field in schema if field.name not in ('AIRLINE_NAME', 'DEPARTURE_HOUR')]
+    return SNAPSHOT_QUERY.format(
+        columns=",\n       ".join(_select_column(field.name, field.type) for field in flight_fields)
+    )
+
+
+def snapshot_schema(connection):
+    """
+    Build the Arrow schema of the snapshot from the declared types of the flights table.
+    """
+    columns = connection.execute(text("PRAGMA table_info(flights)"))
+    fields = [pa.field(column.name.upper(), _arrow_type(column.type)) for column in columns]
+    fields += [pa.field('AIRLINE_NAME', pa.string()), pa.field('DEPARTURE_HOUR', pa.string())]
+    return pa.schema(fields)
+
+
+def export_snapshot(data_manager, path, batch_size=EXPORT_BATCH_SIZE):
+    """
+    Write flights joined with airlines to a Parquet dataset at path,
+    partitioned by year and month (hive style: YEAR=2015/MONTH=1/...).
+    The snapshot is built next to path and swapped in when complete,
+    so readers never see a half-written snapshot.
+    Returns the number of flights exported.
+    """
+    staging = path + '.tmp'
+    shutil.rmtree(staging, ignore_errors=True)
+    exported = 0
+
+    with data_manager.engine.connect() as connection:
+        schema = snapshot_schema(connection)
+        result = connection.execution_options(stream_results=True).execute(text(snapshot_query(schema)))
+        for number, rows in enumerate(result.partitions(batch_size)):
+            table = pa.Table.from_arrays(
+                [pa.array(values, type=field.type) for values, field in zip(zip(*rows), schema)],
+                schema=schema,
+            )
+            pq.write_to_dataset(
+                table, staging,
+                partition_cols=PARTITION_COLUMNS,
+                basename_template=f"part-{number}-{{i}}.parquet",
+            )
+            exported += len(rows)
+
+    shutil.rmtree(path, ignore_errors=True)
+    if exported:
+        os.rename(staging, path)
+    return exported
+
+
+def _records(df):
+    """
+    Convert a DataFrame to a list of dictionaries like FlightData returns, with None for missing values.
+    """
+    return df.astype(object).where(df.notna(), None).to_dict('records')
+
+
+class ParquetFlightData:
+    """
+    Answers the analytics methods of FlightData from a Parquet snapshot
+    written by export_snapshot(). The files are memory-mapped and only the
+    columns a method needs are read; the aggregation is vectorized in pandas.
+    """
+
+    def __init__(self, path):
+        self.dataset = ds.dataset(
+            path, format='parquet', partitioning='hive',
+            filesystem=fs.LocalFileSystem(use_mmap=True),
+        )
+
+    def _read(self, columns):
+        """
+        Read the given columns of the whole snapshot into a DataFrame, only
+        the flights of known airlines if they include AIRLINE_NAME.
+        """
+        row_filter = KNOWN_AIRLINE if 'AIRLINE_NAME' in columns else None
+        return self.dataset.to_table(columns=columns, filter=row_filter).to_pandas()
+
+    def _average_delay(self, key, name):
+        """
+        Average non-negative delay per value of key, like the SQL AVG(CASE ...) queries.
+        """
+        df = self._read([key, 'DEPARTURE_DELAY'])
+        df = df[df['DEPARTURE_DELAY'].notna()]
+        delays = df['DEPARTURE_DELAY'].where(df['DEPARTURE_DELAY'] >= 0)
+        averages = delays.groupby(df[key], dropna=False).mean()
+        result = pd.DataFrame({name: averages.index, 'average_delay': averages.values})
+        return _records(result.sort_values('average_delay', ascending=False, na_position='last'))
+
+    def _delay_counts(self, keys):
+        """
+        Total and delayed flight counts per group of keys.
+        """
+        df = self._read(keys + ['DEPARTURE_DELAY'])
+        delayed = (df['DEPARTURE_DELAY'] > 0).astype('int64')
+        counts = delayed.groupby([df[key] for key in keys], dropna=False).agg(['size', 'sum'])
+        counts.columns = ['total_flights', 'delayed_flights']
+        return counts.reset_index()
+
+    def get_top_10_busiest_airlines(self):
+        """
+        Returns the top 10 busiest airlines based on flight counts.
+        """
+        counts = self._read(['AIRLINE_NAME'])['AIRLINE_NAME'].value_counts().head(10)
+        return _records(pd.DataFrame({'airline': counts.index, 'flight_count': counts.values}))
+
+    def get_average_delay_per_airline(self):
+        """
+        Fetch the average delay per airline, ignoring negative delays.
+        """
+        return self._average_delay('AIRLINE_NAME', 'AIRLINE')
+
+    def get_average_delay_per_origin(self):
+        """
+        Fetch the average delay per origin airport, ignoring negative delays.
+        """
+        return self._average_delay('ORIGIN_AIRPORT', 'origin_airport')
+
+    def get_percentage_delayed_flights_per_airline(self):
+        """
+        Fetch the percentage of delayed flights per airline.
+        """
+        counts = self._delay_counts(['AIRLINE_NAME']).rename(columns={'AIRLINE_NAME': 'AIRLINE'})
+        return data.percentage_delays_per_airline(counts)
+
+    def get_percentage_delayed_flights_per_hour(self):
+        """
+        Fetch the percentage of delayed flights per hour of the day.
+        """
+        counts = self._delay_counts(['DEPARTURE_HOUR']).rename(columns={'DEPARTURE_HOUR': 'hour'})
+        return data.percentage_delays_per_hour(counts.sort_values('hour'))
+
+    def get_percentage_delayed_flights_per_route(self):
+        """
+        Fetch the percentage of delayed flights per origin -> destination route.
+        """
+        counts = self._delay_counts(['ORIGIN_AIRPORT', 'DESTINATION_AIRPORT'])
+        counts['delay_percentage'] = counts['delayed_flights'] / counts['total_flights'] * 100
+        return counts[['ORIGIN_AIRPORT', 'DESTINATION_AIRPORT', 'delay_percentage']]
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print("Usage: python parquet_snapshot.py <database URI> <snapshot directory>")
+        sys.exit(1)
+    count = export_snapshot(data.FlightData(sys.argv[1]), sys.argv[2])
+    print(f"Exported {count} flights to {sys.argv[2]}")
@@ -0,0 +1,590 @@
+import heapq
+import logging
+import os
+import re
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from sqlalchemy import text
+import coalescing
+import data
+import indexes
+import parallel
+import sketches
+import sqlite_engine
+import summaries
+
+logger = logging.getLogger(__name__)
+
+# A sharded database is a directory of SQLite files holding the flights of one
+# year (flights_2015.sqlite3) or one month (flights_2015_01.sqlite3) each, with
+# the flights schema, indexes and summaries, and a copy of the airlines table
+SHARD_LAYOUTS = ('year', 'month')
+SHARD_FILE_PATTERN = re.compile(r'^flights_(\d{4})(?:_(\d{2}))?\.sqlite3$')
+
+# The rollup counters merged across shards (see summaries.COUNTERS)
+ROLLUP_COUNTERS = ('flight_count', 'delayed_count', 'delay_sum', 'delay_count')
+
+# The source files copied into a shard by split_database(): the offset added
+# to their flight IDs and the highest source ID copied so far
+SHARD_SOURCES_SCHEMA = """
+CREATE TABLE IF NOT EXISTS shard_sources (
+    source TEXT PRIMARY KEY,
+    id_offset INTEGER NOT NULL,
+    high_water INTEGER
+)
+"""
+
+# How many of the newest shards ShardedFlightData opens read-write; the older
+# ones no longer change and are opened with the read-only 'archive' profile
+WRITABLE_SHARDS = 1
+
+
+def shard_file_name(year, month=None):
+    if month is None:
+        return f"flights_{year:04d}.sqlite3"
+    return f"flights_{year:04d}_{month:02d}.sqlite3"
+
+
+def discover_shards(shard_dir):
+    """
+    The shards in shard_dir as (year, month, path) tuples, oldest first;
+    month is None for per-year shards.
+    """
+    shards = []
+    for name in os.listdir(shard_dir):
+        match = SHARD_FILE_PATTERN.match(name)
+        if match:
+            year, month = match.groups()
+            shards.append((int(year), int(month) if month else None, os.path.join(shard_dir, name)))
+    return sorted(shards, key=lambda shard: (shard[0], shard[1] or 0))
+
+
+def shard_span(year, month=None):
+    """
+    The first and last (year, month, day) a shard can hold.
+    """
+    return (year, month or 1, 1), (year, month or 12, 31)
+
+
+def split_database(source_uri, shard_dir, by='year', build_summaries=True):
+    """
+    Copy the flights of an SQLite database into the shards of shard_dir, one
+    per year or month (by), creating the shards that don't exist yet with the
+    source's flights and airlines tables and the indexes. Every shard written
+    to gets the source's airlines. Flights without a date are skipped.
+    Flight IDs are kept, unless they would collide with the IDs already in the
+    shards: then the copied flights are renumbered to follow the highest one.
+    Each shard records, per source file, the ID offset used and the highest
+    source ID copied (its high-water mark), so splitting the same source again
+    only copies its new flights, with the same offset.
+    With build_summaries, the summary tables of the shards written to are
+    brought up to date, since old shards are opened read-only later.
+    Returns a dictionary mapping each shard file written to its number of new flights.
+    """
+    if by not in SHARD_LAYOUTS:
+        raise ValueError(f"Unknown shard layout {by!r}, expected one of {SHARD_LAYOUTS}")
+    os.makedirs(shard_dir, exist_ok=True)
+    existing = discover_shards(shard_dir)
+    if any((month is None) != (by == 'year') for _, month, _ in existing):
+        raise ValueError(f"{shard_dir} holds shards of another layout than {by!r}")
+
+    source = sqlite_engine.create_sqlite_engine(source_uri, 'readonly')
+    source_path = sqlite_engine.database_path(source.url)
+    source_key = os.path.realpath(source_path)
+    date_columns = "flights.year, flights.month" if by == 'month' else "flights.year, NULL"
+    with source.connect() as connection:
+        schema = connection.exec_driver_sql(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' AND name IN ('flights', 'airlines')"
+        ).scalars().all()
+        columns = [row[1] for row in connection.exec_driver_sql("PRAGMA table_info(flights)")]
+        partitions = connection.exec_driver_sql(
+            f"SELECT DISTINCT {date_columns} FROM flights "
+            f"WHERE flights.year IS NOT NULL AND flights.month IS NOT NULL"
+        ).all()
+        undated = connection.exec_driver_sql(
+            "SELECT COUNT(*) FROM flights WHERE flights.year IS NULL OR flights.month IS NULL"
+        ).scalar()
+        first_id = connection.exec_driver_sql("SELECT MIN(ID) FROM flights").scalar()
+    source.dispose()
+    if undated:
+        logger.warning("Skipping %d flights without a year or month", undated)
+
+    states = {os.path.basename(path): _shard_state(path, source_key) for _, _, path in existing}
+    offsets = {offset for _, offset, _ in states.values() if offset is not None}
+    if offsets:
+        # Copied before: keep its numbering
+        offset = offsets.pop()
+    else:
+        # Renumber the new flights if their IDs overlap the ones already sharded
+        offset = 0
+        highest_id = max((max_id or 0 for max_id, _, _ in states.values()), default=0)
+        if first_id is not None and first_id <= highest_id:
+            offset = highest_id - first_id + 1
+
+    copied_columns = ", ".join(columns)
+    selected_columns = ", ".join(f"flights.ID + {offset}" if column.upper() == 'ID' else f"flights.{column}"
+                                 for column in columns)
+    where = "flights.year = :year AND flights.month = :month" if by == 'month' else "flights.year = :year"
+    # IS NULL: nothing of this source was copied into the shard yet
+    where += " AND (:high_water IS NULL OR flights.ID > :high_water)"
+    copied = {}
+    for year, month in sorted(partitions):
+        name = shard_file_name(year, month)
+        high_water = states.get(name, (None, None, None))[2]
+        params = {'year': year, 'month': month, 'high_water': high_water}
+        engine = sqlite_engine.create_sqlite_engine(f"sqlite:///{os.path.join(shard_dir, name)}")
+        with engine.connect() as connection:
+            connection.exec_driver_sql("ATTACH DATABASE ? AS source", (source_path,))
+            for statement in schema:
+                connection.exec_driver_sql(statement.replace("CREATE TABLE", "CREATE TABLE IF NOT EXISTS", 1))
+            connection.exec_driver_sql(SHARD_SOURCES_SCHEMA)
+            connection.exec_driver_sql("INSERT OR REPLACE INTO main.airlines SELECT * FROM source.airlines")
+            result = connection.execute(text(
+                f"INSERT INTO main.flights ({copied_columns}) "
+                f"SELECT {selected_columns} FROM source.flights AS flights WHERE {where}"
+            ), params)
+            copied[name] = result.rowcount
+            connection.execute(text(
+                f"INSERT OR REPLACE INTO main.shard_sources (source, id_offset, high_water) "
+                f"SELECT :source, :offset, COALESCE(MAX(flights.ID), :high_water) "
+                f"FROM source.flights AS flights WHERE {where}"
+            ), dict(params, source=source_key, offset=offset))
+            connection.commit()
+            connection.exec_driver_sql("DETACH DATABASE source")
+        indexes.ensure_indexes(engine)
+        if build_summaries:
+            summaries.DelaySummaries(engine).refresh()
+        engine.dispose()
+        logger.info("Copied %d flights into %s", copied[name], name)
+    return copied
+
+
+def _shard_state(path, source_key):
+    """
+    The highest flight ID of a shard, and the ID offset and high-water mark
+    recorded for source_key (None if that source wasn't copied into it).
+    """
+    engine = sqlite_engine.create_sqlite_engine(f"sqlite:///{path}", 'readonly')
+    try:
+        with engine.connect() as connection:
+            max_id = connection.exec_driver_sql("SELECT MAX(ID) FROM flights").scalar()
+            recorded = connection.exec_driver_sql(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'shard_sources'"
+            ).scalar()
+            source = None
+            if recorded:
+                source = connection.exec_driver_sql(
+                    "SELECT id_offset, high_water FROM shard_sources WHERE source = ?", (source_key,)
+                ).first()
+            return (max_id,) + (tuple(source) if source else (None, None))
+    finally:
+        engine.dispose()
+
+
+def rollup_counters_query(bucket, group_by=None, summarized=False):
+    """
+    The query computing the counters the delay rollups are made of per bucket
+    (and group) between two dates, from the daily rollups if summarized or
+    from the flights table. Unlike the rollups themselves, they add up across shards.
+    """
+    if summarized:
+        table, group_column, group_expression, join = summaries.ROLLUP_GROUPS[group_by]
+        source, alias = f"{table} r", 'r'
+        counters = [f"SUM(r.{name}) AS {name}" for name in ROLLUP_COUNTERS]
+    else:
+        group_column, group_expression, join = data.ROLLUP_GROUPS[group_by]
+        source, alias = "flights", 'flights'
+        counters = [f"{summaries.COUNTERS[name]} AS {name}" for name in ROLLUP_COUNTERS]
+    columns = [f"{summaries.ROLLUP_BUCKETS[bucket].format(table=alias)} AS bucket"]
+    grouping = ["bucket"]
+    if group_column:
+        columns.append(group_column)
+        grouping.append(group_expression)
+    return f"""
+SELECT {', '.join(columns + counters)}
+FROM {source}
+{join}
+WHERE ({alias}.year, {alias}.month, {alias}.day) >= (:start_year, :start_month, :start_day)
+  AND ({alias}.year, {alias}.month, {alias}.day) <= (:end_year, :end_month, :end_day)
+GROUP BY {', '.join(grouping)}
+"""
+
+
+def summary_counters_query(table):
+    """
+    The query reading the counters of summary table `table`, with NULL keys
+    as in parallel.partial_query() (the summaries store them as '').
+    """
+    keys = [f"NULLIF({name}, '') AS {name}" for name in summaries.SUMMARIES[table]['keys']]
+    return f"SELECT {', '.join(keys + list(summaries.COUNTERS))} FROM {table}"
+
+
+def merge_rollups(partials, group_column=None):
+    """
+    Add up the rollup counters of several shards (see rollup_counters_query())
+    into the records of FlightData.get_delay_rollup(), ordered by bucket and group.
+    """
+    merged = {}
+    for rows in partials:
+        for row in rows:
+            key = (row['bucket'], row[group_column] if group_column else None)
+            totals = merged.setdefault(key, dict.fromkeys(ROLLUP_COUNTERS, 0))
+            for name in totals:
+                totals[name] += row[name]
+
+    records = []
+    for (bucket, group), c in sorted(merged.items(), key=lambda item: (item[0][0], _group_key(item[0][1]))):
+        record = {'bucket': bucket}
+        if group_column:
+            record[group_column] = group
+        record['flight_count'] = c['flight_count']
+        record['delay_percentage'] = c['delayed_count'] * 100.0 / c['flight_count']
+        record['average_delay'] = parallel._average(c['delay_sum'], c['delay_count'])
+        records.append(record)
+    return records
+
+
+def _group_key(group):
+    # Orders groups like GROUP BY does in SQLite, NULL first
+    return (group is not None, group if group is not None else '')
+
+
+def _shard_counters(shard, table):
+    """
+    The counters of summary table `table` over all flights of one shard, as tuples.
+    """
+    if shard.data._summaries_ready():
+        return shard.data._execute_query(summary_counters_query(table), result_format='tuples')
+    return shard.data._execute_query(parallel.partial_query(table, partitioned=False), result_format='tuples')
+
+
+def _top_delays_key(flight):
+    # ORDER BY DEPARTURE_DELAY DESC, ID as in the top delays queries, NULL delays last
+    return (flight['DELAY'] is None, -(flight['DELAY'] or 0), flight['FLIGHT_ID'])
+
+
+class Shard:
+    """
+    One shard file: the year (and month) of its flights and the FlightData reading it.
+    """
+
+    def __init__(self, year, month, path, data_manager):
+        self.year = year
+        self.month = month
+        self.path = path
+        self.data = data_manager
+        self.first_day, self.last_day = shard_span(year, month)
+
+    def overlaps(self, start, end):
+        return self.first_day <= end and start <= self.last_day
+
+
+class ShardAggregator(parallel.CounterAggregator):
+    """
+    The aggregates of parallel.CounterAggregator over the shards of a
+    ShardedFlightData: each shard computes its counters (from its summaries
+    if it has them) on a thread of the ShardedFlightData, and they are merged
+    into the same rows.
+    """
+
+    def __init__(self, sharded):
+        self.sharded = sharded
+
+    def counters(self, engine, table):
+        return parallel.merge_counters(
+            table, self.sharded._fan_out(lambda shard: _shard_counters(shard, table), self.sharded.shards)
+        )
+
+
+class ShardedFlightData:
+    """
+    The FlightData queries over a sharded database (see split_database()).
+    Queries with a date range only open the shards overlapping it, so adding
+    a year doesn't slow down queries on recent data; lookups by ID try the
+    newest shards first. The other queries run on all shards at once, on a
+    pool of threads, and their results are merged: the delayed flights by
+    flight ID, the top delays by delay, and the aggregates, rollups and
+    sketches from their counters, histograms and registers, which add up
+    exactly across shards. The map query is not supported.
+    """
+
+    def __init__(self, shard_dir, use_summaries=False, writable_shards=WRITABLE_SHARDS,
+                 slow_query_threshold=data.SLOW_QUERY_THRESHOLD, query_limits=None):
+        """
+        Open every shard of shard_dir with its own FlightData (see
+        FlightData.__init__ for the other arguments); all but the
+        writable_shards newest are opened read-only with the 'archive' profile.
+        Raises ValueError if shard_dir holds no shards.
+        """
+        found = discover_shards(shard_dir)
+        if not found:
+            raise ValueError(f"No shards found in {shard_dir}")
+        self.use_summaries = use_summaries
+        self.shards = []
+        for i, (year, month, path) in enumerate(reversed(found)):
+            profile = None if i < writable_shards else 'archive'
+            data_manager = data.FlightData(f"sqlite:///{os.path.abspath(path)}", use_summaries,
+                                           profile, slow_query_threshold, query_limits=query_limits)
+            self.shards.append(Shard(year, month, path, data_manager))
+        self.aggregator = ShardAggregator(self)
+        self.coalescer = coalescing.QueryCoalescer(query_limits)
+        self._pool = None
+
+    def _executor(self):
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(len(self.shards), thread_name_prefix='shard')
+        return self._pool
+
+    def _fan_out(self, func, shards):
+        """
+        Call func on each shard, on the thread pool if there are several.
+        Returns the results in the order of shards.
+        """
+        if len(shards) == 1:
+            return [func(shards[0])]
+        return list(self._executor().map(func, shards))
+
+    def _shards_between(self, start, end):
+        start, end = (start.year, start.month, start.day), (end.year, end.month, end.day)
+        return [shard for shard in self.shards if shard.overlaps(start, end)]
+
+    def get_data_version(self):
+        """
+        Return a stamp that changes whenever the flights of any shard change.
+        """
+        return tuple(shard.data.get_data_version() for shard in self.shards)
+
+    def get_flight_by_id(self, flight_id):
+        """
+        Retrieves a flight using only the flight ID, from the newest shard that has it.
+        """
+        for shard in self.shards:
+            result = shard.data.get_flight_by_id(flight_id)
+            if result:
+                return result
+        return []
+
+    def get_flights_by_ids(self, flight_ids, chunk_size=data.ID_CHUNK_SIZE):
+        """
+        Retrieves many flights at once, looking for the ones not found yet in
+        the next older shard. Returns a dictionary like FlightData.get_flights_by_ids().
+        """
+        flights = {}
+        remaining = list(dict.fromkeys(flight_ids))
+        for shard in self.shards:
+            if not remaining:
+                break
+            flights.update(shard.data.get_flights_by_ids(remaining, chunk_size))
+            remaining = [flight_id for flight_id in remaining if flight_id not in flights]
+        return flights
+
+    def _merge_pages(self, get_page, key, limit, after):
+        pages = self._fan_out(lambda shard: get_page(shard.data)(key, limit=limit, after=after), self.shards)
+        return list(islice(heapq.merge(*pages, key=lambda flight: flight['FLIGHT_ID']), limit))
+
+    @coalescing.coalesced('lookup')
+    def get_delayed_flights_by_airline(self, airline_name, limit=None, after=None):
+        """
+        Retrieves delayed flights for a given airline name, ordered by flight ID
+        across the shards, with the pagination of FlightData.
+        """
+        return self._merge_pages(lambda shard: shard.get_delayed_flights_by_airline, airline_name, limit, after)
+
+    def iter_delayed_flights_by_airline(self, airline_name, limit=None, after=None):
+        """
+        Like get_delayed_flights_by_airline, but merges the shards' streams one flight at a time.
+        """
+        streams = [shard.data.iter_delayed_flights_by_airline(airline_name, limit, after) for shard in self.shards]
+        return islice(heapq.merge(*streams, key=lambda flight: flight['FLIGHT_ID']), limit)
+
+    @coalescing.coalesced('lookup')
+    def get_delayed_flights_by_airport(self, airport_code, limit=None, after=None):
+        """
+        Retrieves delayed flights for a given origin airport IATA code, ordered
+        by flight ID across the shards, with the pagination of FlightData.
+        """
+        return self._merge_pages(lambda shard: shard.get_delayed_flights_by_airport, airport_code, limit, after)
+
+    def iter_delayed_flights_by_airport(self, airport_code, limit=None, after=None):
+        """
+        Like get_delayed_flights_by_airport, but merges the shards' streams one flight at a time.
+        """
+        streams = [shard.data.iter_delayed_flights_by_airport(airport_code, limit, after) for shard in self.shards]
+        return islice(heapq.merge(*streams, key=lambda flight: flight['FLIGHT_ID']), limit)
+
+    def get_top_5_delays_by_date(self, day, month, year):
+        """
+        Retrieve the top 5 delayed flights for a specific date, from the one shard holding it.
+        """
+        for shard in self.shards:
+            if shard.overlaps((year, month, day), (year, month, day)):
+                return shard.data.get_top_5_delays_by_date(day, month, year)
+        return []
+
+    @coalescing.coalesced('range')
+    def get_top_delays_by_date_range(self, start, end, k=5):
+        """
+        Retrieve the k most delayed flights between the dates start and end,
+        inclusive, merged from the k most delayed of each shard in the range.
+        """
+        shards = self._shards_between(start, end)
+        if len(shards) == 1:
+            return shards[0].data.get_top_delays_by_date_range(start, end, k)
+        tops = self._fan_out(lambda shard: shard.data.get_top_delays_by_date_range(start, end, k), shards)
+        return list(islice(heapq.merge(*tops, key=_top_delays_key), k))
+
+    @coalescing.coalesced('range')
+    def get_delay_rollup(self, start, end, bucket='day', group_by=None):
+        """
+        Fetch the delay rollups between the dates start and end, inclusive (see
+        FlightData.get_delay_rollup()). A week or month spanning two shards is
+        added up from the counters of both.
+        """
+        data.check_rollup_args(bucket, group_by)
+        shards = self._shards_between(start, end)
+        if len(shards) == 1:
+            return shards[0].data.get_delay_rollup(start, end, bucket, group_by)
+        params = data.date_range_params((start.year, start.month, start.day), (end.year, end.month, end.day))
+
+        def shard_rollup(shard):
+            query = rollup_counters_query(bucket, group_by, shard.data._summaries_ready())
+            return shard.data._execute_query(query, params)
+
+        return merge_rollups(self._fan_out(shard_rollup, shards), sketches.GROUP_COLUMNS[group_by])
+
+    @coalescing.coalesced('range')
+    def get_delay_percentiles(self, start, end, group_by=None, percentiles=sketches.DEFAULT_PERCENTILES):
+        """
+        Estimate the delay percentiles between the dates start and end, inclusive
+        (see FlightData.get_delay_percentiles()), from the merged histograms of
+        the shards in the range.
+        """
+        sketches.check_sketch_args(group_by, percentiles)
+        shards = self._shards_between(start, end)
+        if len(shards) == 1:
+            return shards[0].data.get_delay_percentiles(start, end, group_by, percentiles)
+        params = data.date_range_params((start.year, start.month, start.day), (end.year, end.month, end.day))
+        group_column = sketches.GROUP_COLUMNS[group_by]
+
+        def shard_histogram(shard):
+            if shard.data._summaries_ready():
+                return shard.data._execute_query(sketches.percentile_query(group_by), params)
+            return list(sketches.bucket_delays(shard.data._execute_query(data.delay_histogram_query(group_by), params)))
+
+        rows = [row for rows in self._fan_out(shard_histogram, shards) for row in rows]
+        rows.sort(key=lambda row: (_group_key(row[group_column] if group_column else None), row['bucket']))
+        return sketches.delay_percentiles(rows, group_column, percentiles)
+
+    @coalescing.coalesced('range')
+    def get_distinct_routes(self, start, end, group_by=None):
+        """
+        Estimate the number of distinct routes flown between the dates start and
+        end, inclusive (see FlightData.get_distinct_routes()), from the merged
+        HyperLogLog registers of the shards in the range.
+        """
+        sketches.check_sketch_args(group_by)
+        shards = self._shards_between(start, end)
+        if len(shards) == 1:
+            return shards[0].data.get_distinct_routes(start, end, group_by)
+        params = data.date_range_params((start.year, start.month, start.day), (end.year, end.month, end.day))
+        group_column = sketches.GROUP_COLUMNS[group_by]
+
+        def shard_registers(shard):
+            if shard.data._summaries_ready():
+                return shard.data._execute_query(sketches.distinct_routes_query(group_by), params)
+            return list(sketches.register_routes(shard.data._execute_query(data.routes_flown_query(group_by), params)))
+
+        rows = [row for rows in self._fan_out(shard_registers, shards) for row in rows]
+        if group_column:
+            rows.sort(key=lambda row: _group_key(row[group_column]))
+        return sketches.distinct_routes(rows, group_column)
+
+    def _airlines_engine(self):
+        # Every shard has the airlines; the newest has the latest of them
+        return self.shards[0].data.engine
+
+    @coalescing.coalesced('aggregate')
+    def get_top_10_busiest_airlines(self):
+        """
+        Returns the top 10 busiest airlines based on flight counts.
+        """
+        return self.aggregator.top_10_busiest_airlines(self._airlines_engine())
+
+    @coalescing.coalesced('aggregate')
+    def get_average_delay_per_airline(self):
+        """
+        Fetch the average delay per airline, ignoring negative delays.
+        """
+        return self.aggregator.average_delay_per_airline(self._airlines_engine())
+
+    @coalescing.coalesced('aggregate')
+    def get_percentage_delayed_flights_per_airline(self):
+        """
+        Fetch the percentage of delayed flights per airline.
+        """
+        return data.percentage_delays_per_airline(self.aggregator.percentage_delayed_per_airline(self._airlines_engine()))
+
+    @coalescing.coalesced('aggregate')
+    def get_average_delay_per_origin(self):
+        """
+        Fetch the average delay per origin airport, ignoring negative delays.
+        """
+        return self.aggregator.average_delay_per_origin(self._airlines_engine())
+
+    @coalescing.coalesced('aggregate')
+    def get_percentage_delayed_flights_per_hour(self):
+        """
+        Fetch the percentage of delayed flights per hour of the day.
+        """
+        return data.percentage_delays_per_hour(self.aggregator.percentage_delayed_per_hour(self._airlines_engine()))
+
+    @coalescing.coalesced('aggregate')
+    def get_percentage_delayed_flights_per_route(self):
+        """
+        Fetch the percentage of delayed flights per origin -> destination route.
+        """
+        import pandas as pd
+        return pd.DataFrame(self.aggregator.percentage_delayed_per_route(self._airlines_engine()),
+                            columns=['ORIGIN_AIRPORT', 'DESTINATION_AIRPORT', 'delay_percentage'])
+
+    @coalescing.coalesced('aggregate')
+    def get_route_matrix(self, top_airports=None, min_flights=1, result_format='records'):
+        """
+        Fetch the routes between the busiest airports like FlightData.get_route_matrix(),
+        from the route counters of all shards. result_format is 'records' or 'dataframe'.
+        """
+        routes = self.aggregator.counters(self._airlines_engine(), 'delay_summary_route')
+        traffic = {}
+        for (origin, destination), counters in routes.items():
+            for airport in (origin, destination):
+                if airport is not None:
+                    traffic[airport] = traffic.get(airport, 0) + counters['flight_count']
+        busiest = sorted(traffic, key=lambda airport: (-traffic[airport], airport))
+        top = set(busiest if top_airports is None else busiest[:top_airports])
+
+        records = [{'ORIGIN_AIRPORT': origin, 'DESTINATION_AIRPORT': destination,
+                    'flight_count': c['flight_count'],
+                    'delay_percentage': c['delayed_count'] * 100.0 / c['flight_count']}
+                   for (origin, destination), c in routes.items()
+                   if c['flight_count'] >= min_flights and origin in top and destination in top]
+        records.sort(key=lambda route: (route['ORIGIN_AIRPORT'], route['DESTINATION_AIRPORT']))
+        if result_format == 'dataframe':
+            import pandas as pd
+            return pd.DataFrame(records, columns=['ORIGIN_AIRPORT', 'DESTINATION_AIRPORT',
+                                                  'flight_count', 'delay_percentage'])
+        return records
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (3, 4) or (len(sys.argv) == 4 and sys.argv[3] not in SHARD_LAYOUTS):
+        print("Usage: python shards.py <database URI> <shard directory> [year|month]")
+        sys.exit(1)
+    logging.basicConfig(level=logging.INFO)
+    copied = split_database(sys.argv[1], sys.argv[2], *sys.argv[3:])
+    print(f"Copied {sum(copied.values())} flights into {len(copied)} shards in {sys.argv[2]}")
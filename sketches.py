@@ -0,0 +1,304 @@
+from functools import lru_cache
+import hashlib
+import math
+from sqlalchemy import text
+
+# Mergeable sketches of the flights of every day, per airline and per origin
+# airport, kept next to the summary tables (see summaries.DelaySummaries):
+#
+# - The delays go into a histogram with logarithmic buckets (as in DDSketch):
+#   every delay is within RELATIVE_ACCURACY of the value of its bucket, so any
+#   percentile estimated from the histogram is too. Histograms of several days
+#   merge by adding up the counts of each bucket, which SUM() does in SQL.
+# - The routes flown go into a HyperLogLog of 2 ** HLL_PRECISION registers,
+#   which estimates the number of distinct routes within about
+#   1.04 / sqrt(2 ** HLL_PRECISION) (3%). Registers merge with MAX().
+#
+# Changing RELATIVE_ACCURACY or HLL_PRECISION takes a DelaySummaries.rebuild().
+RELATIVE_ACCURACY = 0.01
+HLL_PRECISION = 10
+
+DEFAULT_PERCENTILES = (50, 95, 99)
+
+_GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+_LOG_GAMMA = math.log(_GAMMA)
+_HLL_REGISTERS = 1 << HLL_PRECISION
+_HLL_HASH_BITS = 64 - HLL_PRECISION
+
+# Sketch tables per group: key column and the flights column it comes from.
+# Keys are stored as '' instead of NULL, as in the summary tables.
+SKETCH_GROUPS = {
+    'airline': ('airline_id', 'flights.airline'),
+    'origin': ('origin_airport', 'flights.ORIGIN_AIRPORT'),
+}
+
+# Groups the sketches can be read by: sketch tables, selected column, grouping
+# expression and join. Without a group, the airline sketches of all airlines
+# are merged.
+SKETCH_READ_GROUPS = {
+    None: ('airline', None, None, ""),
+    'airline': ('airline', "airlines.airline AS AIRLINE", "airlines.airline",
+                "JOIN airlines ON s.airline_id = airlines.id"),
+    'origin': ('origin', "NULLIF(s.origin_airport, '') AS origin_airport", "s.origin_airport", ""),
+}
+
+# Column holding the group in the results, by group
+GROUP_COLUMNS = {None: None, 'airline': 'AIRLINE', 'origin': 'origin_airport'}
+
+# The buckets of the distinct delays and the registers of the distinct routes
+# are computed here once and kept in lookup tables, so the sketches of new
+# flights are built in SQL by joining them, like the summary tables
+CREATE_LOOKUP_TABLES = [
+    "CREATE TABLE IF NOT EXISTS sketch_delay_buckets "
+    "(delay REAL PRIMARY KEY, bucket INTEGER NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS sketch_route_registers "
+    "(origin_airport TEXT NOT NULL, destination_airport TEXT NOT NULL, "
+    "register INTEGER NOT NULL, rank INTEGER NOT NULL, "
+    "PRIMARY KEY (origin_airport, destination_airport)) WITHOUT ROWID",
+]
+
+NEW_DELAYS_QUERY = """
+SELECT DISTINCT flights.DEPARTURE_DELAY
+FROM flights
+WHERE flights.ID > :low AND flights.ID <= :high AND flights.DEPARTURE_DELAY IS NOT NULL
+"""
+
+NEW_ROUTES_QUERY = """
+SELECT DISTINCT flights.ORIGIN_AIRPORT, flights.DESTINATION_AIRPORT
+FROM flights
+WHERE flights.ID > :low AND flights.ID <= :high
+  AND flights.ORIGIN_AIRPORT IS NOT NULL AND flights.DESTINATION_AIRPORT IS NOT NULL
+"""
+
+
+@lru_cache(maxsize=65536)
+def delay_bucket(delay):
+    """
+    The histogram bucket of a delay. Buckets are ordered like the delays:
+    0 holds the delays under a minute either way, k > 0 the delays of at least
+    a minute up to _GAMMA ** (k - 1) minutes and -k the early departures of as
+    many minutes.
+    """
+    if abs(delay) < 1:
+        return 0
+    index = math.ceil(math.log(abs(delay)) / _LOG_GAMMA) + 1
+    return index if delay > 0 else -index
+
+
+def bucket_value(bucket):
+    """
+    The delay a bucket stands for, within RELATIVE_ACCURACY of all delays in it.
+    """
+    if bucket == 0:
+        return 0.0
+    value = 2 * _GAMMA ** (abs(bucket) - 1) / (_GAMMA + 1)
+    return value if bucket > 0 else -value
+
+
+@lru_cache(maxsize=65536)
+def route_register(origin, destination):
+    """
+    The HyperLogLog register of a route and the rank the route sets it to.
+    """
+    digest = hashlib.blake2b(f"{origin}-{destination}".encode(), digest_size=8).digest()
+    value = int.from_bytes(digest, 'big')
+    register = value >> _HLL_HASH_BITS
+    rank = _HLL_HASH_BITS - (value & ((1 << _HLL_HASH_BITS) - 1)).bit_length() + 1
+    return register, rank
+
+
+def percentile_name(percentile):
+    return f"p{percentile:g}"
+
+
+def check_sketch_args(group_by, percentiles=DEFAULT_PERCENTILES):
+    """
+    Raise ValueError for a group the sketches aren't kept by or a percentile out of range.
+    """
+    if group_by not in SKETCH_READ_GROUPS:
+        raise ValueError(f"Unknown group {group_by!r}, expected one of {tuple(SKETCH_READ_GROUPS)}")
+    if not all(0 <= percentile <= 100 for percentile in percentiles):
+        raise ValueError("Percentiles must be between 0 and 100.")
+
+
+def _read_query(kind, group_by, columns, merge):
+    table, group_column, group_expression, join = SKETCH_READ_GROUPS[group_by]
+    grouping = [group_expression] if group_column else []
+    selected = [group_column] if group_column else []
+    return f"""
+SELECT {', '.join(selected + columns)}
+FROM {kind}_sketch_{table} s
+{join}
+WHERE (s.year, s.month, s.day) >= (:start_year, :start_month, :start_day)
+  AND (s.year, s.month, s.day) <= (:end_year, :end_month, :end_day)
+GROUP BY {', '.join(grouping + [merge])}
+ORDER BY {', '.join(grouping + [merge])}
+"""
+
+
+def percentile_query(group_by=None):
+    """
+    The query merging the daily delay histograms of each group between two dates.
+    """
+    return _read_query('delay', group_by, ["s.bucket AS bucket", "SUM(s.flight_count) AS flight_count"],
+                       "s.bucket")
+
+
+def distinct_routes_query(group_by=None):
+    """
+    The query merging the daily HyperLogLog registers of each group between two dates.
+    """
+    return _read_query('route', group_by, ["s.register AS register", "MAX(s.rank) AS rank"],
+                       "s.register")
+
+
+def bucket_delays(rows):
+    """
+    Histogram rows (bucket, flight_count) from rows of distinct delays and their
+    flight_count, for percentiles estimated straight from the flights table.
+    """
+    for row in rows:
+        row = dict(row)
+        row['bucket'] = delay_bucket(row.pop('delay'))
+        yield row
+
+
+def register_routes(rows):
+    """
+    HyperLogLog register rows (register, rank) from rows of distinct routes,
+    for distinct counts estimated straight from the flights table.
+    """
+    for row in rows:
+        row = dict(row)
+        row['register'], row['rank'] = route_register(row.pop('origin'), row.pop('destination'))
+        yield row
+
+
+def _quantile(histogram, total, fraction):
+    rank = fraction * (total - 1)
+    seen = 0
+    for bucket, count in histogram:
+        seen += count
+        if seen > rank:
+            return round(bucket_value(bucket), 1)
+    return round(bucket_value(histogram[-1][0]), 1)
+
+
+def delay_percentiles(rows, group_column=None, percentiles=DEFAULT_PERCENTILES):
+    """
+    Estimate the delay percentiles of each group from its merged histogram:
+    rows with group_column (if any), bucket and flight_count, ordered by
+    bucket within each group. Returns one record per group with the number
+    of flights with a reported delay and a 'p<percentile>' field per percentile.
+    """
+    histograms = {}
+    for row in rows:
+        group = row[group_column] if group_column else None
+        histograms.setdefault(group, []).append((row['bucket'], row['flight_count']))
+
+    results = []
+    for group, histogram in histograms.items():
+        total = sum(count for _, count in histogram)
+        record = {group_column: group} if group_column else {}
+        record['reported_count'] = total
+        for percentile in percentiles:
+            record[percentile_name(percentile)] = _quantile(histogram, total, percentile / 100)
+        results.append(record)
+    return results
+
+
+def hll_estimate(registers):
+    """
+    Estimate the number of distinct values from HyperLogLog registers, a
+    dictionary mapping the non-zero registers to their rank.
+    """
+    m = _HLL_REGISTERS
+    zeros = m - len(registers)
+    harmonic = zeros + sum(2.0 ** -rank for rank in registers.values())
+    estimate = 0.7213 / (1 + 1.079 / m) * m * m / harmonic
+    if estimate <= 2.5 * m and zeros:
+        # Small cardinalities: linear counting of the empty registers
+        estimate = m * math.log(m / zeros)
+    return round(estimate)
+
+
+def distinct_routes(rows, group_column=None):
+    """
+    Estimate the number of distinct routes of each group from its merged
+    registers: rows with group_column (if any), register and rank.
+    """
+    registers = {}
+    for row in rows:
+        group = registers.setdefault(row[group_column] if group_column else None, {})
+        group[row['register']] = max(group.get(row['register'], 0), row['rank'])
+
+    return [{**({group_column: group} if group_column else {}), 'distinct_routes': hll_estimate(group_registers)}
+            for group, group_registers in registers.items()]
+
+
+def create_tables(connection):
+    """
+    Create the sketch tables and their lookup tables if they don't exist yet.
+    """
+    for statement in CREATE_LOOKUP_TABLES:
+        connection.execute(text(statement))
+    for group_by, (key, _) in SKETCH_GROUPS.items():
+        for kind, merge, value in (('delay', 'bucket', 'flight_count'), ('route', 'register', 'rank')):
+            connection.execute(text(
+                f"CREATE TABLE IF NOT EXISTS {kind}_sketch_{group_by} "
+                f"(year INTEGER NOT NULL, month INTEGER NOT NULL, day INTEGER NOT NULL, "
+                f"{key} NOT NULL, {merge} INTEGER NOT NULL, {value} INTEGER NOT NULL, "
+                f"PRIMARY KEY (year, month, day, {key}, {merge})) WITHOUT ROWID"
+            ))
+
+
+def drop_tables(connection):
+    for group_by in SKETCH_GROUPS:
+        connection.execute(text(f"DROP TABLE IF EXISTS delay_sketch_{group_by}"))
+        connection.execute(text(f"DROP TABLE IF EXISTS route_sketch_{group_by}"))
+    connection.execute(text("DROP TABLE IF EXISTS sketch_delay_buckets"))
+    connection.execute(text("DROP TABLE IF EXISTS sketch_route_registers"))
+
+
+def update(connection, low, high):
+    """
+    Sketch the flights with low < ID <= high and merge them into the sketch tables.
+    """
+    params = {'low': low, 'high': high}
+    delays = [(delay, delay_bucket(delay))
+              for delay, in connection.execute(text(NEW_DELAYS_QUERY), params)]
+    routes = [(origin, destination, *route_register(origin, destination))
+              for origin, destination in connection.execute(text(NEW_ROUTES_QUERY), params)]
+    # Plain DB-API executemany: binding SQLAlchemy parameters row by row costs more than the inserts
+    if delays:
+        connection.exec_driver_sql(
+            "INSERT OR IGNORE INTO sketch_delay_buckets (delay, bucket) VALUES (?, ?)", delays)
+    if routes:
+        connection.exec_driver_sql(
+            "INSERT OR IGNORE INTO sketch_route_registers "
+            "(origin_airport, destination_airport, register, rank) VALUES (?, ?, ?, ?)", routes)
+
+    for group_by, (key, expression) in SKETCH_GROUPS.items():
+        columns = f"year, month, day, {key}"
+        grouping = f"flights.year, flights.month, flights.day, COALESCE({expression}, '')"
+        connection.execute(text(f"""
+            INSERT INTO delay_sketch_{group_by} ({columns}, bucket, flight_count)
+            SELECT {grouping}, b.bucket, COUNT(*)
+            FROM flights
+            JOIN sketch_delay_buckets b ON b.delay = flights.DEPARTURE_DELAY
+            WHERE flights.ID > :low AND flights.ID <= :high
+              AND flights.year IS NOT NULL AND flights.month IS NOT NULL AND flights.day IS NOT NULL
+            GROUP BY {grouping}, b.bucket
+            ON CONFLICT({columns}, bucket) DO UPDATE SET flight_count = flight_count + excluded.flight_count
+        """), params)
+        connection.execute(text(f"""
+            INSERT INTO route_sketch_{group_by} ({columns}, register, rank)
+            SELECT {grouping}, r.register, MAX(r.rank)
+            FROM flights
+            JOIN sketch_route_registers r
+              ON r.origin_airport = flights.ORIGIN_AIRPORT AND r.destination_airport = flights.DESTINATION_AIRPORT
+            WHERE flights.ID > :low AND flights.ID <= :high
+              AND flights.year IS NOT NULL AND flights.month IS NOT NULL AND flights.day IS NOT NULL
+            GROUP BY {grouping}, r.register
+            ON CONFLICT({columns}, register) DO UPDATE SET rank = MAX(rank, excluded.rank)
+        """), params)
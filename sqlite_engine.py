@@ -0,0 +1,133 @@
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+
+# Engine profiles for SQLite databases. The PRAGMAs are applied to every new
+# connection; the pool settings size the connection pool shared by all threads.
+PROFILES = {
+    'readwrite': {
+        'read_only': False,
+        'journal_mode': 'WAL',          # readers don't block the writer and vice versa
+        'synchronous': 'NORMAL',        # safe with WAL, far fewer fsyncs
+        'mmap_size': 256 * 1024 ** 2,   # bytes of the file read through mmap
+        'cache_size': -64 * 1024,       # negative means KiB: 64 MiB page cache per connection
+        'temp_store': 'MEMORY',         # sorts and GROUP BY temp tables in memory
+        'busy_timeout': 5000,           # milliseconds to wait for a lock instead of failing
+        'pool_size': 8,
+        'max_overflow': 8,
+        'pool_timeout': 30,
+        'pool_pre_ping': True,
+    },
+}
+PROFILES['readonly'] = dict(PROFILES['readwrite'], read_only=True, pool_size=16)
+# Shards of past years that no longer change (see shards.py): read-only, and
+# mapped whole (up to 1 GiB) so pages are read straight from the page cache
+PROFILES['archive'] = dict(PROFILES['readonly'], mmap_size=1024 ** 3, pool_size=4)
+
+DEFAULT_PROFILE = 'readwrite'
+
+
+def get_profile(profile=None):
+    """
+    Resolve a profile given by name, or as a dictionary overriding the default profile.
+    """
+    if profile is None:
+        return dict(PROFILES[DEFAULT_PROFILE])
+    if isinstance(profile, str):
+        return dict(PROFILES[profile])
+    return dict(PROFILES[DEFAULT_PROFILE], **profile)
+
+
+def read_only_url(url):
+    """
+    Turn a file-based SQLite URL into one that opens the file read-only.
+    """
+    return url.set(database=f"file:{url.database}", query=dict(url.query, mode='ro', uri='true'))
+
+
+def is_read_only(url):
+    """
+    True if an SQLite URL opens its database read-only (see read_only_url()).
+    """
+    return url.query.get('mode') == 'ro'
+
+
+def database_path(url):
+    """
+    Return the filesystem path of an SQLite URL's database, or None for in-memory databases.
+    """
+    database = url.database
+    if not database or database == ':memory:':
+        return None
+    if database.startswith('file:'):
+        database = database[len('file:'):]
+    return database
+
+
+def install_pragmas(engine, settings):
+    """
+    Apply the PRAGMAs of a profile to every new connection of engine.
+    """
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        if not settings['read_only']:
+            # The journal mode is stored in the file, so it needs write access
+            cursor.execute(f"PRAGMA journal_mode = {settings['journal_mode']}")
+            cursor.execute(f"PRAGMA synchronous = {settings['synchronous']}")
+        cursor.execute(f"PRAGMA mmap_size = {int(settings['mmap_size'])}")
+        cursor.execute(f"PRAGMA cache_size = {int(settings['cache_size'])}")
+        cursor.execute(f"PRAGMA temp_store = {settings['temp_store']}")
+        cursor.execute(f"PRAGMA busy_timeout = {int(settings['busy_timeout'])}")
+        cursor.close()
+
+
+def engine_options(db_uri, profile=None):
+    """
+    Return the URL, the create_engine keyword arguments and the profile
+    settings for db_uri, or None for the settings if db_uri doesn't point to
+    an SQLite file (such URIs are not tuned).
+    """
+    url = make_url(db_uri)
+    if url.get_backend_name() != 'sqlite' or url.database in (None, '', ':memory:'):
+        return url, {}, None
+
+    settings = get_profile(profile)
+    if settings['read_only'] and not url.database.startswith('file:'):
+        url = read_only_url(url)
+
+    options = {
+        'connect_args': {'check_same_thread': False},
+        'pool_size': settings['pool_size'],
+        'max_overflow': settings['max_overflow'],
+        'pool_timeout': settings['pool_timeout'],
+        'pool_pre_ping': settings['pool_pre_ping'],
+    }
+    return url, options, settings
+
+
+def create_sqlite_engine(db_uri, profile=None):
+    """
+    Create an engine for db_uri tuned with the given profile.
+    URIs that don't point to an SQLite file get a plain engine.
+    """
+    url, options, settings = engine_options(db_uri, profile)
+    engine = create_engine(url, **options)
+    if settings is not None:
+        install_pragmas(engine, settings)
+    return engine
+
+
+def create_async_sqlite_engine(db_uri, profile=None):
+    """
+    Create an asyncio engine (aiosqlite driver) for db_uri tuned with the given profile.
+    """
+    # Imported here so the synchronous code doesn't need aiosqlite installed
+    from sqlalchemy.ext.asyncio import create_async_engine
+
+    url, options, settings = engine_options(db_uri, profile)
+    if url.get_backend_name() == 'sqlite':
+        url = url.set(drivername='sqlite+aiosqlite')
+    engine = create_async_engine(url, **options)
+    if settings is not None:
+        install_pragmas(engine.sync_engine, settings)
+    return engine
@@ -0,0 +1,472 @@
+import logging
+import threading
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+import sketches
+import sqlite_engine
+
+logger = logging.getLogger(__name__)
+
+# Name of the row in delay_summary_state that tracks how far into flights the
+# summaries have been built
+STATE_NAME = 'flights'
+
+# The daily top delays, the daily rollups and the sketches (added later) are
+# tracked separately, so databases whose summaries were built before they
+# existed get them filled in on the next refresh
+TOP_DELAYS_STATE_NAME = 'daily_top_delays'
+ROLLUP_STATE_NAME = 'daily_rollups'
+SKETCH_STATE_NAME = 'delay_sketches'
+STATE_NAMES = (STATE_NAME, TOP_DELAYS_STATE_NAME, ROLLUP_STATE_NAME, SKETCH_STATE_NAME)
+
+# Each summary table keeps, per group, the number of flights, the number of
+# flights with a reported delay, the count and sum of the non-negative delays
+# (what the average delay methods use) and the number of delayed flights.
+# Group keys are stored as '' instead of NULL so they can be part of the
+# primary key; the read queries turn them back into NULL. 'state' names the
+# delay_summary_state row tracking a table (STATE_NAME if not given).
+SUMMARIES = {
+    'delay_summary_airline': {
+        'keys': {'airline_id': 'flights.airline'},
+    },
+    'delay_summary_origin': {
+        'keys': {'origin_airport': 'flights.ORIGIN_AIRPORT'},
+    },
+    'delay_summary_hour': {
+        'keys': {'hour': "strftime('%H', flights.SCHEDULED_DEPARTURE)"},
+    },
+    'delay_summary_route': {
+        'keys': {
+            'origin_airport': 'flights.ORIGIN_AIRPORT',
+            'destination_airport': 'flights.DESTINATION_AIRPORT',
+        },
+    },
+    # Daily rollups, overall and per airline and origin, for the bucketed delay metrics
+    'delay_rollup_day': {
+        'keys': {'year': 'flights.year', 'month': 'flights.month', 'day': 'flights.day'},
+        'state': ROLLUP_STATE_NAME,
+    },
+    'delay_rollup_day_airline': {
+        'keys': {'year': 'flights.year', 'month': 'flights.month', 'day': 'flights.day',
+                 'airline_id': 'flights.airline'},
+        'state': ROLLUP_STATE_NAME,
+    },
+    'delay_rollup_day_origin': {
+        'keys': {'year': 'flights.year', 'month': 'flights.month', 'day': 'flights.day',
+                 'origin_airport': 'flights.ORIGIN_AIRPORT'},
+        'state': ROLLUP_STATE_NAME,
+    },
+}
+
+COUNTERS = {
+    'flight_count': "COUNT(*)",
+    'reported_count': "COUNT(flights.DEPARTURE_DELAY)",
+    'delay_count': "SUM(CASE WHEN flights.DEPARTURE_DELAY >= 0 THEN 1 ELSE 0 END)",
+    'delay_sum': "TOTAL(CASE WHEN flights.DEPARTURE_DELAY >= 0 THEN flights.DEPARTURE_DELAY END)",
+    'delayed_count': "SUM(CASE WHEN flights.DEPARTURE_DELAY > 0 THEN 1 ELSE 0 END)",
+}
+
+TOP_10_BUSIEST_AIRLINES_QUERY = """
+SELECT airlines.airline AS airline, SUM(s.flight_count) AS flight_count
+FROM delay_summary_airline s
+JOIN airlines ON s.airline_id = airlines.id
+GROUP BY airlines.airline
+ORDER BY flight_count DESC
+LIMIT 10
+"""
+
+AVERAGE_DELAY_PER_AIRLINE_QUERY = """
+SELECT airlines.airline AS AIRLINE,
+       SUM(s.delay_sum) / NULLIF(SUM(s.delay_count), 0) AS average_delay
+FROM delay_summary_airline s
+JOIN airlines ON s.airline_id = airlines.id
+WHERE s.reported_count > 0
+GROUP BY airlines.airline
+ORDER BY average_delay DESC
+"""
+
+PERCENTAGE_DELAYED_PER_AIRLINE_QUERY = """
+SELECT airlines.airline AS AIRLINE,
+       SUM(s.flight_count) AS total_flights,
+       SUM(s.delayed_count) AS delayed_flights
+FROM delay_summary_airline s
+JOIN airlines ON s.airline_id = airlines.id
+GROUP BY airlines.airline
+"""
+
+AVERAGE_DELAY_PER_ORIGIN_QUERY = """
+SELECT NULLIF(origin_airport, '') AS origin_airport,
+       delay_sum / NULLIF(delay_count, 0) AS average_delay
+FROM delay_summary_origin
+WHERE reported_count > 0
+ORDER BY average_delay DESC
+"""
+
+PERCENTAGE_DELAYED_PER_HOUR_QUERY = """
+SELECT NULLIF(hour, '') AS hour,
+       flight_count AS total_flights,
+       delayed_count AS delayed_flights
+FROM delay_summary_hour
+ORDER BY hour
+"""
+
+PERCENTAGE_DELAYED_PER_ROUTE_QUERY = """
+SELECT NULLIF(origin_airport, '') AS ORIGIN_AIRPORT,
+       NULLIF(destination_airport, '') AS DESTINATION_AIRPORT,
+       delayed_count * 100.0 / flight_count AS delay_percentage
+FROM delay_summary_route
+"""
+
+ROUTES_FOR_MAP_QUERY = """
+SELECT s.origin_airport AS ORIGIN_AIRPORT,
+       s.destination_airport AS DESTINATION_AIRPORT,
+       s.flight_count AS flight_count,
+       s.delay_sum / NULLIF(s.delay_count, 0) AS avg_delay,
+       s.delayed_count * 100.0 / s.flight_count AS delay_percentage,
+       origin.LONGITUDE AS ORIGIN_LONGITUDE,
+       origin.LATITUDE AS ORIGIN_LATITUDE,
+       destination.LONGITUDE AS DESTINATION_LONGITUDE,
+       destination.LATITUDE AS DESTINATION_LATITUDE
+FROM delay_summary_route s
+JOIN airports AS origin ON origin.IATA_CODE = s.origin_airport
+JOIN airports AS destination ON destination.IATA_CODE = s.destination_airport
+"""
+
+ROUTE_MATRIX_QUERY = """
+WITH routes AS (
+    SELECT NULLIF(origin_airport, '') AS origin,
+           NULLIF(destination_airport, '') AS destination,
+           flight_count,
+           delayed_count
+    FROM delay_summary_route
+),
+top_airports AS (
+    SELECT airport
+    FROM (SELECT origin AS airport, flight_count FROM routes
+          UNION ALL
+          SELECT destination, flight_count FROM routes)
+    WHERE airport IS NOT NULL
+    GROUP BY airport
+    ORDER BY SUM(flight_count) DESC
+    LIMIT :top_airports
+)
+SELECT origin AS ORIGIN_AIRPORT,
+       destination AS DESTINATION_AIRPORT,
+       flight_count,
+       delayed_count * 100.0 / flight_count AS delay_percentage
+FROM routes
+WHERE flight_count >= :min_flights
+  AND origin IN top_airports
+  AND destination IN top_airports
+ORDER BY origin, destination
+"""
+
+# The daily top-K table keeps the TOP_DELAYS_MAX_K largest delays of every day
+# (ties broken by flight ID), so the worst delays of a day or a date range are
+# read from at most TOP_DELAYS_MAX_K rows per day instead of sorting the day's
+# flights. Changing it takes a rebuild().
+TOP_DELAYS_MAX_K = 100
+
+CREATE_DAILY_TOP_DELAYS = """
+CREATE TABLE IF NOT EXISTS daily_top_delays (
+    year INTEGER NOT NULL,
+    month INTEGER NOT NULL,
+    day INTEGER NOT NULL,
+    departure_delay REAL NOT NULL,
+    flight_id INTEGER NOT NULL,
+    PRIMARY KEY (year, month, day, departure_delay DESC, flight_id)
+) WITHOUT ROWID
+"""
+
+# Candidates from the new flights: each day's top K among them
+INSERT_DAILY_TOP_DELAYS = """
+INSERT INTO daily_top_delays (year, month, day, departure_delay, flight_id)
+SELECT year, month, day, departure_delay, flight_id
+FROM (
+    SELECT flights.year AS year, flights.month AS month, flights.day AS day,
+           flights.DEPARTURE_DELAY AS departure_delay, flights.ID AS flight_id,
+           ROW_NUMBER() OVER (PARTITION BY flights.year, flights.month, flights.day
+                              ORDER BY flights.DEPARTURE_DELAY DESC, flights.ID) AS rank
+    FROM flights
+    WHERE flights.ID > :low AND flights.ID <= :high
+      AND flights.DEPARTURE_DELAY IS NOT NULL
+      AND flights.year IS NOT NULL AND flights.month IS NOT NULL AND flights.day IS NOT NULL
+)
+WHERE rank <= :k
+"""
+
+# Trim the days that got new candidates back to their top K
+PRUNE_DAILY_TOP_DELAYS = """
+DELETE FROM daily_top_delays
+WHERE (year, month, day, departure_delay, flight_id) IN (
+    SELECT year, month, day, departure_delay, flight_id
+    FROM (
+        SELECT t.*,
+               ROW_NUMBER() OVER (PARTITION BY t.year, t.month, t.day
+                                  ORDER BY t.departure_delay DESC, t.flight_id) AS rank
+        FROM daily_top_delays t
+        WHERE (t.year, t.month, t.day) IN (
+            SELECT DISTINCT flights.year, flights.month, flights.day
+            FROM flights
+            WHERE flights.ID > :low AND flights.ID <= :high
+        )
+    )
+    WHERE rank > :k
+)
+"""
+
+# The k worst delays of a date range from the daily top delays. The k
+# candidates are picked before joining flights and airlines, which keeps the
+# sort to k rows, so fewer come back if some of them lost their flight or
+# airline; JOINED_TOP_DELAYS_BY_DATE_RANGE_QUERY joins every candidate first.
+TOP_DELAYS_BY_DATE_RANGE_QUERY = """
+SELECT flights.*,
+       airlines.airline,
+       flights.ID as FLIGHT_ID,
+       flights.DEPARTURE_DELAY as DELAY
+FROM (
+    SELECT departure_delay, flight_id
+    FROM daily_top_delays
+    WHERE (year, month, day) >= (:start_year, :start_month, :start_day)
+      AND (year, month, day) <= (:end_year, :end_month, :end_day)
+    ORDER BY departure_delay DESC, flight_id
+    LIMIT :k
+) AS t
+JOIN flights ON flights.ID = t.flight_id
+JOIN airlines ON flights.airline = airlines.id
+ORDER BY t.departure_delay DESC, t.flight_id
+"""
+
+JOINED_TOP_DELAYS_BY_DATE_RANGE_QUERY = """
+SELECT flights.*,
+       airlines.airline,
+       flights.ID as FLIGHT_ID,
+       flights.DEPARTURE_DELAY as DELAY
+FROM daily_top_delays t
+JOIN flights ON flights.ID = t.flight_id
+JOIN airlines ON flights.airline = airlines.id
+WHERE (t.year, t.month, t.day) >= (:start_year, :start_month, :start_day)
+  AND (t.year, t.month, t.day) <= (:end_year, :end_month, :end_day)
+ORDER BY t.departure_delay DESC, t.flight_id
+LIMIT :k
+"""
+
+
+# Bucket of a day for the delay rollups, from the year, month and day columns
+# of {table}: the date, the Monday starting its week, or its month
+ROLLUP_BUCKETS = {
+    'day': "printf('%04d-%02d-%02d', {table}.year, {table}.month, {table}.day)",
+    'week': "date(printf('%04d-%02d-%02d', {table}.year, {table}.month, {table}.day), 'weekday 0', '-6 days')",
+    'month': "printf('%04d-%02d', {table}.year, {table}.month)",
+}
+
+# Groups the rollups can be split by: rollup table, selected column, grouping
+# expression and join
+ROLLUP_GROUPS = {
+    None: ('delay_rollup_day', None, None, ""),
+    'airline': ('delay_rollup_day_airline', "airlines.airline AS AIRLINE", "airlines.airline",
+                "JOIN airlines ON r.airline_id = airlines.id"),
+    'origin': ('delay_rollup_day_origin', "NULLIF(r.origin_airport, '') AS origin_airport",
+               "r.origin_airport", ""),
+}
+
+
+def rollup_query(bucket, group_by=None):
+    """
+    The query reading the flight count, percentage of delayed flights and average
+    delay per bucket (and group) between two dates from the daily rollups.
+    """
+    table, group_column, group_expression, join = ROLLUP_GROUPS[group_by]
+    columns = [f"{ROLLUP_BUCKETS[bucket].format(table='r')} AS bucket"]
+    grouping = ["bucket"]
+    if group_column:
+        columns.append(group_column)
+        grouping.append(group_expression)
+    columns += ["SUM(r.flight_count) AS flight_count",
+                "SUM(r.delayed_count) * 100.0 / SUM(r.flight_count) AS delay_percentage",
+                "SUM(r.delay_sum) / NULLIF(SUM(r.delay_count), 0) AS average_delay"]
+    return f"""
+SELECT {', '.join(columns)}
+FROM {table} r
+{join}
+WHERE (r.year, r.month, r.day) >= (:start_year, :start_month, :start_day)
+  AND (r.year, r.month, r.day) <= (:end_year, :end_month, :end_day)
+GROUP BY {', '.join(grouping)}
+ORDER BY {', '.join(grouping)}
+"""
+
+
+class DelaySummaries:
+    """
+    Keeps per-airline, per-origin, per-hour and per-route delay aggregates,
+    the daily top delays and the daily delay and route sketches (see
+    sketches.py) in side tables, so the aggregate, top-delay and percentile
+    methods of FlightData don't have to scan the flights table on every call.
+
+    The summaries are refreshed incrementally: only flights with an ID above
+    the high-water mark recorded at the last refresh are scanned. This relies
+    on flights being append-only with increasing IDs; call rebuild() after
+    updating or deleting existing flights. Refreshes are serialized, so one
+    instance can be shared by several threads. They run at setup time
+    (indexes.setup_schema()), after a load (ingest.py) or in the background
+    when a query finds the summaries behind, never on the query path.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self._lock = threading.Lock()
+        self._warned_read_only = False
+
+    def create_tables(self, connection):
+        """
+        Create the summary tables and the state table if they don't exist yet.
+        """
+        counters = ", ".join(f"{name} {'REAL' if name == 'delay_sum' else 'INTEGER'} NOT NULL"
+                             for name in COUNTERS)
+        for table, summary in SUMMARIES.items():
+            keys = ", ".join(f"{key} NOT NULL" for key in summary['keys'])
+            connection.execute(text(
+                f"CREATE TABLE IF NOT EXISTS {table} "
+                f"({keys}, {counters}, PRIMARY KEY ({', '.join(summary['keys'])}))"
+            ))
+        connection.execute(text(CREATE_DAILY_TOP_DELAYS))
+        sketches.create_tables(connection)
+        connection.execute(text(
+            "CREATE TABLE IF NOT EXISTS delay_summary_state "
+            "(name TEXT PRIMARY KEY, high_water INTEGER NOT NULL)"
+        ))
+
+    def high_water(self, connection, name=STATE_NAME):
+        """
+        Return the highest flights.ID already included in the summaries
+        tracked by the state row `name`.
+        """
+        result = connection.execute(
+            text("SELECT high_water FROM delay_summary_state WHERE name = :name"),
+            {'name': name},
+        ).scalar()
+        return result if result is not None else 0
+
+    @staticmethod
+    def _set_high_water(connection, name, high):
+        connection.execute(
+            text("INSERT INTO delay_summary_state (name, high_water) VALUES (:name, :high) "
+                 "ON CONFLICT(name) DO UPDATE SET high_water = excluded.high_water"),
+            {'name': name, 'high': high},
+        )
+
+    def is_current(self, connection):
+        """
+        True if the summaries include every flight. This only reads (without
+        the refresh lock), so it is cheap enough to call before each query
+        and works on read-only connections.
+        """
+        try:
+            high, low, states = connection.execute(text(
+                "SELECT (SELECT MAX(ID) FROM flights), MIN(high_water), COUNT(*) FROM delay_summary_state"
+            )).one()
+        except SQLAlchemyError:
+            # No state table: the summaries were never built
+            return False
+        return high is None or (states == len(STATE_NAMES) and low >= high)
+
+    def refresh(self):
+        """
+        Add the flights inserted since the last refresh to the summaries.
+        Returns the number of flight IDs covered by this refresh.
+        """
+        with self._lock, self.engine.begin() as connection:
+            return self.update(connection)
+
+    def refresh_in_background(self):
+        """
+        Start a refresh on a daemon thread, so the caller doesn't wait for it.
+        Returns False without starting one if a refresh is already running or
+        the engine is read-only (its summaries must be built at setup time).
+        """
+        if sqlite_engine.is_read_only(self.engine.url):
+            if not self._warned_read_only:
+                logger.warning("Summaries of the read-only %s are out of date", self.engine.url.database)
+                self._warned_read_only = True
+            return False
+        if not self._lock.acquire(blocking=False):
+            return False
+
+        def run():
+            try:
+                with self.engine.begin() as connection:
+                    self.update(connection)
+            except SQLAlchemyError as e:
+                logger.warning("Could not refresh summaries: %s: %s", e.__class__.__name__, e)
+            finally:
+                self._lock.release()
+
+        threading.Thread(target=run, name='summaries-refresh', daemon=True).start()
+        return True
+
+    def update(self, connection):
+        """
+        Do the work of refresh() inside the caller's transaction.
+        """
+        self.create_tables(connection)
+        high = connection.execute(text("SELECT MAX(ID) FROM flights")).scalar()
+        if high is None:
+            return 0
+
+        top_low = self.high_water(connection, TOP_DELAYS_STATE_NAME)
+        if high > top_low:
+            params = {'low': top_low, 'high': high, 'k': TOP_DELAYS_MAX_K}
+            connection.execute(text(INSERT_DAILY_TOP_DELAYS), params)
+            connection.execute(text(PRUNE_DAILY_TOP_DELAYS), params)
+            self._set_high_water(connection, TOP_DELAYS_STATE_NAME, high)
+
+        sketch_low = self.high_water(connection, SKETCH_STATE_NAME)
+        if high > sketch_low:
+            sketches.update(connection, sketch_low, high)
+            self._set_high_water(connection, SKETCH_STATE_NAME, high)
+
+        tables_by_state = {}
+        for table, summary in SUMMARIES.items():
+            tables_by_state.setdefault(summary.get('state', STATE_NAME), []).append(table)
+
+        covered = 0
+        for state, tables in tables_by_state.items():
+            low = self.high_water(connection, state)
+            if high <= low:
+                continue
+            for table in tables:
+                self._merge(connection, table, SUMMARIES[table]['keys'], low, high)
+            self._set_high_water(connection, state, high)
+            covered = max(covered, high - low)
+        return covered
+
+    def rebuild(self):
+        """
+        Drop the summaries and build them again from the whole flights table.
+        """
+        with self._lock, self.engine.begin() as connection:
+            for table in SUMMARIES:
+                connection.execute(text(f"DROP TABLE IF EXISTS {table}"))
+            connection.execute(text("DROP TABLE IF EXISTS daily_top_delays"))
+            sketches.drop_tables(connection)
+            connection.execute(text("DROP TABLE IF EXISTS delay_summary_state"))
+        return self.refresh()
+
+    @staticmethod
+    def _merge(connection, table, keys, low, high):
+        """
+        Aggregate the flights with low < ID <= high and add them to a summary table.
+        """
+        key_columns = ", ".join(keys)
+        key_exprs = ", ".join(f"COALESCE({expr}, '')" for expr in keys.values())
+        counter_columns = ", ".join(COUNTERS)
+        counter_exprs = ", ".join(COUNTERS.values())
+        updates = ", ".join(f"{name} = {name} + excluded.{name}" for name in COUNTERS)
+        connection.execute(text(f"""
+            INSERT INTO {table} ({key_columns}, {counter_columns})
+            SELECT {key_exprs}, {counter_exprs}
+            FROM flights
+            WHERE flights.ID > :low AND flights.ID <= :high
+            GROUP BY {key_exprs}
+            ON CONFLICT({key_columns}) DO UPDATE SET {updates}
+        """), {'low': low, 'high': high})
@@ -0,0 +1,208 @@
+import asyncio
+import threading
+import time
+import pytest
+import coalescing
+import instrumentation
+
+CALLERS = 8
+QUEUE_TIMEOUT = 0.2
+# Timers may fire a clock tick early
+TIMER_SLACK = 0.01
+
+
+def wait_for_coalesced(name, count, timeout=5.0):
+    # Followers are counted just before they wait on the call in flight
+    deadline = time.monotonic() + timeout
+    while instrumentation.QUERIES_COALESCED._values.get(name, 0) < count:
+        assert time.monotonic() < deadline, "the concurrent calls were not coalesced"
+        time.sleep(0.005)
+
+
+class FakeData:
+    """
+    Stands in for FlightData: coalesced methods whose queries block until released.
+    """
+
+    def __init__(self, limits=None):
+        self.coalescer = coalescing.QueryCoalescer(limits)
+        self.executions = 0
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    @coalescing.coalesced('lookup')
+    def sync_identical_calls(self, key, k=5):
+        self.executions += 1
+        self.started.set()
+        self.release.wait(5)
+        return [key, k]
+
+    @coalescing.coalesced('range')
+    def sync_sequence_call(self, percentiles=(50, 95)):
+        self.executions += 1
+        self.started.set()
+        self.release.wait(5)
+        return list(percentiles)
+
+    @coalescing.coalesced('lookup')
+    def sync_interrupted_call(self, key):
+        self.started.set()
+        self.release.wait(5)
+        raise KeyboardInterrupt
+
+    @coalescing.coalesced('range')
+    def sync_limited_call(self, key):
+        self.started.set()
+        self.release.wait(5)
+        return key
+
+
+class AsyncFakeData:
+    """
+    Stands in for AsyncFlightData.
+    """
+
+    def __init__(self, limits=None):
+        self.coalescer = coalescing.AsyncQueryCoalescer(limits)
+        self.executions = 0
+        self.release = asyncio.Event()
+
+    @coalescing.coalesced('lookup')
+    async def async_identical_calls(self, key, k=5):
+        self.executions += 1
+        await self.release.wait()
+        return [key, k]
+
+    @coalescing.coalesced('range')
+    async def async_limited_call(self, key):
+        await self.release.wait()
+        return key
+
+
+def test_identical_concurrent_calls_run_once():
+    fake = FakeData()
+    results = []
+    first = threading.Thread(target=lambda: results.append(fake.sync_identical_calls('ATL')))
+    first.start()
+    assert fake.started.wait(5)
+    # Same call once the defaults are filled in
+    followers = [threading.Thread(target=lambda: results.append(fake.sync_identical_calls('ATL', k=5)))
+                 for _ in range(CALLERS - 1)]
+    for thread in followers:
+        thread.start()
+    wait_for_coalesced('sync_identical_calls', CALLERS - 1)
+    fake.release.set()
+    for thread in [first] + followers:
+        thread.join(5)
+
+    assert fake.executions == 1
+    assert len(results) == CALLERS
+    assert all(result is results[0] for result in results)
+
+
+def test_different_calls_are_not_coalesced():
+    fake = FakeData()
+    fake.release.set()
+    assert fake.sync_identical_calls('ATL') == ['ATL', 5]
+    assert fake.sync_identical_calls('ATL', k=10) == ['ATL', 10]
+    assert fake.executions == 2
+
+
+def test_followers_get_base_exceptions_of_the_owner():
+    fake = FakeData()
+    errors = []
+
+    def call():
+        try:
+            fake.sync_interrupted_call('ATL')
+        except KeyboardInterrupt as e:
+            errors.append(e)
+
+    # Daemon threads, so a follower left waiting fails the test instead of hanging it
+    first = threading.Thread(target=call, daemon=True)
+    first.start()
+    assert fake.started.wait(5)
+    follower = threading.Thread(target=call, daemon=True)
+    follower.start()
+    wait_for_coalesced('sync_interrupted_call', 1)
+    fake.release.set()
+    for thread in (first, follower):
+        thread.join(5)
+
+    assert not follower.is_alive()
+    assert len(errors) == 2
+
+
+def test_list_arguments_are_coalesced_like_tuples():
+    fake = FakeData()
+    results = []
+    first = threading.Thread(target=lambda: results.append(fake.sync_sequence_call([50, 90])))
+    first.start()
+    assert fake.started.wait(5)
+    follower = threading.Thread(target=lambda: results.append(fake.sync_sequence_call(percentiles=(50, 90))))
+    follower.start()
+    wait_for_coalesced('sync_sequence_call', 1)
+    fake.release.set()
+    for thread in (first, follower):
+        thread.join(5)
+
+    assert fake.executions == 1
+    assert results == [[50, 90], [50, 90]]
+
+
+def test_unhashable_arguments_run_uncoalesced():
+    fake = FakeData()
+    fake.release.set()
+    assert fake.sync_sequence_call({50: 'median'}) == [50]
+    assert fake.sync_sequence_call([{50: 'median'}]) == [{50: 'median'}]
+    assert fake.executions == 2
+
+
+def test_limit_raises_overloaded_after_queue_timeout():
+    fake = FakeData({'range': {'limit': 1, 'queue_timeout': QUEUE_TIMEOUT}})
+    holder = threading.Thread(target=fake.sync_limited_call, args=('first',))
+    holder.start()
+    assert fake.started.wait(5)
+    try:
+        started = time.monotonic()
+        with pytest.raises(coalescing.QueryOverloaded) as raised:
+            fake.sync_limited_call('second')
+        assert time.monotonic() - started >= QUEUE_TIMEOUT - TIMER_SLACK
+        assert raised.value.query_class == 'range'
+    finally:
+        fake.release.set()
+        holder.join(5)
+    # The slot is free again once the running query is done
+    assert fake.sync_limited_call('third') == 'third'
+
+
+def test_async_identical_concurrent_calls_run_once():
+    async def scenario():
+        fake = AsyncFakeData()
+        calls = [asyncio.ensure_future(fake.async_identical_calls('ATL', k=5) if i % 2
+                                       else fake.async_identical_calls('ATL'))
+                 for i in range(CALLERS)]
+        await asyncio.sleep(0)
+        fake.release.set()
+        return fake, await asyncio.gather(*calls)
+
+    fake, results = asyncio.run(scenario())
+    assert fake.executions == 1
+    assert all(result is results[0] for result in results)
+
+
+def test_async_limit_raises_overloaded_after_queue_timeout():
+    async def scenario():
+        fake = AsyncFakeData({'range': {'limit': 1, 'queue_timeout': QUEUE_TIMEOUT}})
+        holder = asyncio.ensure_future(fake.async_limited_call('first'))
+        await asyncio.sleep(0)
+        started = time.monotonic()
+        with pytest.raises(coalescing.QueryOverloaded):
+            await fake.async_limited_call('second')
+        waited = time.monotonic() - started
+        fake.release.set()
+        assert await holder == 'first'
+        assert await fake.async_limited_call('third') == 'third'
+        return waited
+
+    assert asyncio.run(scenario()) >= QUEUE_TIMEOUT - TIMER_SLACK
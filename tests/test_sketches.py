@@ -0,0 +1,107 @@
+from collections import Counter
+import itertools
+import math
+import random
+import string
+import sketches
+
+PERCENTILES = (0, 25, 50, 75, 95, 99, 100)
+
+# Standard error of the HyperLogLog estimate
+HLL_STANDARD_ERROR = 1.04 / math.sqrt(2 ** sketches.HLL_PRECISION)
+
+AIRPORTS = [''.join(code) for code in itertools.product(string.ascii_uppercase, repeat=3)][:2000]
+
+
+def sample_delays(count, seed=42):
+    # Whole minutes like DEPARTURE_DELAY: mostly on time or early, with a long tail of delays
+    rng = random.Random(seed)
+    delays = []
+    for _ in range(count):
+        if rng.random() < 0.6:
+            delays.append(rng.randint(-20, 0))
+        else:
+            delays.append(round(rng.lognormvariate(3, 1.2)))
+    return delays
+
+
+def histogram_rows(delays, group=None):
+    counts = Counter(sketches.delay_bucket(delay) for delay in delays)
+    return [{**({'AIRLINE': group} if group else {}), 'bucket': bucket, 'flight_count': count}
+            for bucket, count in sorted(counts.items())]
+
+
+def exact_percentile(delays, percentile):
+    # The rank sketches.delay_percentiles estimates
+    ordered = sorted(delays)
+    return ordered[int(percentile / 100 * (len(ordered) - 1))]
+
+
+def assert_within_accuracy(estimate, exact):
+    # Estimates are rounded to a tenth of a minute
+    assert abs(estimate - exact) <= sketches.RELATIVE_ACCURACY * abs(exact) + 0.05, (estimate, exact)
+
+
+def registers(routes):
+    merged = {}
+    for origin, destination in routes:
+        register, rank = sketches.route_register(origin, destination)
+        merged[register] = max(merged.get(register, 0), rank)
+    return merged
+
+
+def sample_routes(count):
+    return [(AIRPORTS[i % len(AIRPORTS)], AIRPORTS[i // len(AIRPORTS)]) for i in range(count)]
+
+
+def test_percentiles_within_relative_accuracy():
+    delays = sample_delays(20000)
+    [record] = sketches.delay_percentiles(histogram_rows(delays), percentiles=PERCENTILES)
+    assert record['reported_count'] == len(delays)
+    for percentile in PERCENTILES:
+        assert_within_accuracy(record[sketches.percentile_name(percentile)], exact_percentile(delays, percentile))
+
+
+def test_percentiles_per_group():
+    groups = {'AA': sample_delays(5000, seed=1), 'UA': sample_delays(3000, seed=2)}
+    rows = [row for group, delays in groups.items() for row in histogram_rows(delays, group)]
+    records = sketches.delay_percentiles(rows, 'AIRLINE')
+    assert [record['AIRLINE'] for record in records] == list(groups)
+    for record in records:
+        delays = groups[record['AIRLINE']]
+        for percentile in sketches.DEFAULT_PERCENTILES:
+            assert_within_accuracy(record[sketches.percentile_name(percentile)],
+                                   exact_percentile(delays, percentile))
+
+
+def test_merged_histograms_match_the_whole():
+    delays = sample_delays(10000)
+    days = [delays[i::7] for i in range(7)]
+    merged = Counter()
+    for day in days:
+        for row in histogram_rows(day):
+            merged[row['bucket']] += row['flight_count']
+    rows = [{'bucket': bucket, 'flight_count': count} for bucket, count in sorted(merged.items())]
+    assert sketches.delay_percentiles(rows) == sketches.delay_percentiles(histogram_rows(delays))
+
+
+def test_distinct_routes_within_standard_error():
+    # The hash is fixed, so these sizes always give the same estimates:
+    # they are checked against twice the standard error (about 95% of estimates)
+    for count in (100, 1000, 10000, 50000):
+        estimate = sketches.hll_estimate(registers(sample_routes(count)))
+        assert abs(estimate - count) <= 2 * HLL_STANDARD_ERROR * count, (count, estimate)
+
+
+def test_repeated_routes_are_counted_once():
+    routes = sample_routes(1000)
+    assert sketches.hll_estimate(registers(routes * 3)) == sketches.hll_estimate(registers(routes))
+
+
+def test_merged_registers_match_the_whole():
+    routes = sample_routes(5000)
+    rows = [{'register': register, 'rank': rank}
+            for part in (routes[:3000], routes[2000:])
+            for register, rank in registers(part).items()]
+    [record] = sketches.distinct_routes(rows)
+    assert record['distinct_routes'] == sketches.hll_estimate(registers(routes))